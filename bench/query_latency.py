@@ -0,0 +1,231 @@
+"""
+Measures the latency of each stage of `QueryEngine` (query expansion, retrieval, reranking, postprocessing
+and generation of each pass) and of the whole queries, with a deterministic stand-in for the LLM (no Ollama needed).
+
+The index is built in a temporary directory from a generated corpus (or from the documents in `DOCS`, when set)
+with the same `make_query_engine()` as the app, so the settings (e.g. `RETRIEVAL`, `VECTOR_STORE`, `REFINEMENT_ITERATIONS`) apply.
+The generation stages only take the time of the stand-in (see `--prefill-rate` and `--decode-rate`
+to simulate the LLM speed); their prompt sizes and the paths the queries took are reported instead.
+
+  python bench/query_latency.py [--query-count N] [--save-baseline FILE] [--baseline FILE]
+
+With `--baseline`, the results are compared with the saved ones and the command fails
+when a stage got slower by more than `--tolerance`.
+"""
+
+from argparse import ArgumentParser
+from collections import Counter
+from tempfile import TemporaryDirectory
+from time import perf_counter, sleep
+from typing import Any
+from typing_extensions import override
+import json
+import os
+import os.path as p
+import random
+import statistics
+import sys
+
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.core.llms.types import CompletionResponse, CompletionResponseGen, LLMMetadata
+from llama_index.llms.base import llm_completion_callback
+from llama_index.llms.custom import CustomLLM
+from llama_index.utils import get_tokenizer
+
+from engine import make_query_engine
+from qas.ingestion.local import INGESTION_LOCAL_PATH_ENV
+import config
+
+_SUBJECTS = ["The release process", "The VPN access request", "The on-call rotation", "The build pipeline",
+  "The staging environment", "The access review", "The incident report", "The backup policy", "The API gateway",
+  "The onboarding checklist", "The database migration", "The expense report", "The code review", "The license audit"]
+_VERBS = ["requires", "is owned by", "is described in", "is approved by", "depends on", "is scheduled by",
+  "is documented for", "is tracked in", "is escalated to", "is configured by"]
+_OBJECTS = ["the platform team", "the security team", "a ticket in the service desk", "the release manager",
+  "the team lead", "the quarterly plan", "the infrastructure repository", "the wiki page template",
+  "a two-factor token", "the change advisory board", "the monitoring dashboard", "error code 0x80070005"]
+
+class FakeLLM(CustomLLM):
+  """
+  A deterministic LLM stand-in answering the prompts of `ExpandQueryTransform` (a numbered list),
+  of the expert group (several "Expert N:" paragraphs) and of the answers (of `response_token_count` words).
+
+  The prompt sizes (in tokens) are recorded by the prompt kind. With `prefill_rate` / `decode_rate` (tokens per second),
+  sleeps as long as an LLM of that speed would take.
+  """
+
+  response_token_count: int = 64
+  prefill_rate: float = 0
+  decode_rate: float = 0
+
+  _prompt_token_counts: dict[str, list[int]] = PrivateAttr(default_factory=dict)
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "FakeLLM"
+
+  @property
+  @override
+  def metadata(self) -> LLMMetadata:
+    return LLMMetadata(num_output=self.response_token_count)
+
+  @property
+  def prompt_token_counts(self) -> dict[str, list[int]]:
+    return self._prompt_token_counts
+
+  @override
+  @llm_completion_callback()
+  def complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponse:
+    return CompletionResponse(text=self._generate(prompt))
+
+  @override
+  @llm_completion_callback()
+  def stream_complete(self, prompt: str, formatted: bool = False, **kwargs: Any) -> CompletionResponseGen:
+    text = self._generate(prompt)
+
+    def gen() -> CompletionResponseGen:
+      for i, word in enumerate(text.split(" ")):
+        yield CompletionResponse(text=text, delta=word if i == 0 else " " + word)
+
+    return gen()
+
+  def _generate(self, prompt: str) -> str:
+    prompt_token_count = len(get_tokenizer()(prompt))
+
+    rng = random.Random(prompt)
+    query = next((line for line in reversed(prompt.splitlines()) if line.strip()), "")
+    if "numbered list" in prompt:
+      kind = "query expansion"
+      text = "\n".join(f"{i + 1}. {make_sentence(rng)}" for i in range(3))
+    elif "Three experts" in prompt:
+      kind = "expert group"
+      text = "\n\n".join(f"Expert {i + 1}: {make_sentence(rng)} {query}" for i in range(3))
+    else:
+      kind = "answer"
+      text = " ".join(rng.choice(query.split() or ["answer"]) for _ in range(self.response_token_count))
+    self._prompt_token_counts.setdefault(kind, []).append(prompt_token_count)
+
+    if self.prefill_rate > 0 or self.decode_rate > 0:
+      sleep(
+        (prompt_token_count / self.prefill_rate if self.prefill_rate > 0 else 0)
+        + (self.response_token_count / self.decode_rate if self.decode_rate > 0 else 0)
+      )
+    return text
+
+def make_sentence(rng: random.Random) -> str:
+  return f"{rng.choice(_SUBJECTS)} {rng.choice(_VERBS)} {rng.choice(_OBJECTS)}."
+
+def make_corpus(path: str, document_count: int, seed: int = 1):
+  """
+  Markdown documents with front matter, of a few paragraphs of sentences on the same topics (so there are many
+  similar candidates to rank).
+  """
+
+  rng = random.Random(seed)
+  for i in range(document_count):
+    paragraphs = [" ".join(make_sentence(rng) for _ in range(rng.randint(2, 6))) for _ in range(rng.randint(3, 12))]
+    with open(p.join(path, f"page-{i}.md"), "w") as f:
+      f.write(f"---\ntitle: Page {i}\n---\n\n# Page {i}\n\n" + "\n\n".join(paragraphs) + "\n")
+
+def make_queries(count: int, seed: int = 2) -> list[str]:
+  rng = random.Random(seed)
+  return [f"How is {rng.choice(_SUBJECTS).lower()} related to {rng.choice(_OBJECTS)}?" for _ in range(count)]
+
+def get_percentile(values: list[float], percentile: float) -> float:
+  values = sorted(values)
+  return values[min(int(len(values) * percentile), len(values) - 1)]
+
+def compare(results: dict[str, dict[str, float]], baseline: dict[str, dict[str, float]], tolerance: float) -> list[str]:
+  """
+  The stages slower than in the baseline by more than `tolerance` (relative; the differences below 1 ms are ignored).
+  """
+
+  regressions = []
+  for stage, stats in results.items():
+    baseline_stats = baseline.get(stage)
+    if baseline_stats is None:
+      continue
+    for key in ("p50", "p95"):
+      if stats[key] - baseline_stats[key] > max(tolerance * baseline_stats[key], 0.001):
+        regressions.append(f"{stage} {key}: {baseline_stats[key] * 1000:.1f} ms -> {stats[key] * 1000:.1f} ms")
+  return regressions
+
+def main():
+  arg_parser = ArgumentParser(description="Benchmark the query latency per QueryEngine stage.")
+  arg_parser.add_argument("--document-count", type=int, default=500, help="The size of the generated corpus.")
+  arg_parser.add_argument("--query-count", type=int, default=50)
+  arg_parser.add_argument("--warm-up-count", type=int, default=3, help="The number of the first queries not measured.")
+  arg_parser.add_argument("--prefill-rate", type=float, default=0, help="The simulated LLM prompt processing speed, tokens/s.")
+  arg_parser.add_argument("--decode-rate", type=float, default=0, help="The simulated LLM generation speed, tokens/s.")
+  arg_parser.add_argument("--save-baseline", metavar="FILE")
+  arg_parser.add_argument("--baseline", metavar="FILE")
+  arg_parser.add_argument("--tolerance", type=float, default=0.2)
+  args = arg_parser.parse_args()
+
+  with TemporaryDirectory() as path:
+    if not os.getenv(INGESTION_LOCAL_PATH_ENV):
+      docs_path = p.join(path, "docs")
+      os.makedirs(docs_path)
+      make_corpus(docs_path, args.document_count)
+      os.environ[INGESTION_LOCAL_PATH_ENV] = docs_path
+
+    settings = config.Settings(
+      chroma_path=p.join(path, "chroma"),
+      embedding_cache_path=p.join(path, "embeddings.sqlite3"),
+      answer_cache=False,
+      llm_warm_up=False,
+    )
+    llm = FakeLLM(prefill_rate=args.prefill_rate, decode_rate=args.decode_rate)
+    query_engine = make_query_engine(settings, llm=llm)
+
+    durations: dict[str, list[float]] = {}
+    query_engine.on_stage = lambda stage, duration: durations.setdefault(stage, []).append(duration)
+    paths: Counter[str] = Counter()
+    query_engine.on_path = lambda path: paths.update([path])
+
+    queries = make_queries(args.warm_up_count + args.query_count)
+    for query in queries[:args.warm_up_count]:
+      query_engine.query(query)
+    durations.clear()
+    paths.clear()
+    llm.prompt_token_counts.clear()
+
+    for query in queries[args.warm_up_count:]:
+      started_at = perf_counter()
+      query_engine.query(query)
+      durations.setdefault("total", []).append(perf_counter() - started_at)
+
+  results = {
+    stage: {"p50": statistics.median(values), "p95": get_percentile(values, 0.95), "mean": statistics.mean(values)}
+    for stage, values in durations.items()
+  }
+
+  print(f"\n{len(queries) - args.warm_up_count} queries, retrieval: {settings.retrieval}, vector store: {settings.vector_store}\n")
+  print(f"{'stage':<20} {'p50, ms':>10} {'p95, ms':>10} {'mean, ms':>10}")
+  for stage, stats in results.items():
+    print(f"{stage:<20} {stats['p50'] * 1000:>10.1f} {stats['p95'] * 1000:>10.1f} {stats['mean'] * 1000:>10.1f}")
+
+  for kind, token_counts in llm.prompt_token_counts.items():
+    print(f"Prompt tokens (tiktoken), {kind}: p50 {statistics.median(token_counts):.0f}, max {max(token_counts)}")
+  print("Paths: " + ", ".join(f"{path} {count}" for path, count in paths.most_common()))
+  if query_engine.context_packer is not None:
+    print(query_engine.context_packer.format_stats())
+
+  if args.save_baseline:
+    with open(args.save_baseline, "w") as f:
+      json.dump(results, f, indent=2)
+    print(f"\nSaved the baseline to {args.save_baseline}")
+
+  if args.baseline:
+    with open(args.baseline) as f:
+      regressions = compare(results, json.load(f), args.tolerance)
+    if regressions:
+      print(f"\n🔴 Slower than the baseline by more than {args.tolerance:.0%}:\n\n" + "\n".join(regressions))
+      sys.exit(1)
+    print(f"\n🟢 Within {args.tolerance:.0%} of the baseline")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,159 @@
+"""
+Compares the vector store size and the retrieval latency with the sentence windows stored in the node metadata
+(`SentenceWindowNodeParser`) and rebuilt at query time (`CompactSentenceWindowNodeParser` + `SentenceRecorder`
++ `SentenceWindowExpander`; the size includes the `SentenceStore`), on the documents in `DOCS`
+(or on a generated corpus, when not set).
+
+  env DOCS="path/to/txt/or/md/docs" python bench/sentence_windows.py [--query-count N] [--top-k N] [--fake-embeddings]
+
+With `--fake-embeddings`, the texts are embedded with deterministic bag-of-words vectors of the same size
+as `BAAI/bge-small-en-v1.5` ones (no model download needed; the retrieved nodes differ, the sizes and latencies hardly do).
+"""
+
+from argparse import ArgumentParser
+from hashlib import blake2b
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Any
+from typing_extensions import override
+import os
+import os.path as p
+import random
+import re
+import statistics
+import sys
+
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
+
+from llama_index.embeddings import BaseEmbedding, FastEmbedEmbedding
+from llama_index.embeddings.base import Embedding
+from llama_index.ingestion import run_transformations
+from llama_index.node_parser import NodeParser, SentenceWindowNodeParser
+from llama_index.schema import MetadataMode, NodeWithScore
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.vector_stores.types import VectorStoreQuery
+import chromadb
+import llama_index.node_parser.text.sentence_window as sentence_window
+import numpy as np
+
+from qas.embedding_cache import CachedEmbedding, EmbeddingCache
+from qas.ingestion.compact_sentence_window import CompactSentenceWindowNodeParser
+from qas.ingestion.local import INGESTION_LOCAL_PATH_ENV, load_data
+from qas.ingestion.sentence_recorder import SentenceRecorder
+from qas.ingestion.sync import group_by_source
+from qas.ingestion.text_clean_up import TextCleanUp
+from qas.sentence_store import SentenceStore
+from qas.sentence_window_expander import SentenceWindowExpander
+from query_latency import make_corpus
+
+_word = re.compile(r"\w+")
+
+class FakeEmbedding(BaseEmbedding):
+  """
+  A deterministic stand-in for the embedding model: the normalized sum of the random vectors of the words.
+  """
+
+  dimension: int = 384
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "FakeEmbedding"
+
+  @override
+  def _get_query_embedding(self, query: str) -> Embedding:
+    return self._embed(query)
+
+  @override
+  async def _aget_query_embedding(self, query: str) -> Embedding:
+    return self._embed(query)
+
+  @override
+  def _get_text_embedding(self, text: str) -> Embedding:
+    return self._embed(text)
+
+  def _embed(self, text: str) -> Embedding:
+    embedding = np.zeros(self.dimension)
+    for word in _word.findall(text.lower()):
+      seed = int.from_bytes(blake2b(word.encode(), digest_size=8).digest(), "little")
+      embedding += np.random.default_rng(seed).normal(size=self.dimension)
+    norm = np.linalg.norm(embedding)
+    return (embedding / norm if norm else embedding).tolist()
+
+def get_dir_size(path: str) -> int:
+  return sum(p.getsize(p.join(dir_path, file_name)) for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+
+def run(name: str, node_parser: NodeParser, embed_model: BaseEmbedding, query_embeddings: list[list[float]], top_k: int, top_n: int):
+  documents = load_data()
+  group_by_source(documents)
+
+  with TemporaryDirectory() as chroma_path:
+    collection = chromadb.PersistentClient(path=chroma_path).get_or_create_collection("context")
+    vector_store = ChromaVectorStore(chroma_collection=collection)
+
+    sentence_store = SentenceStore(p.join(chroma_path, "sentences.sqlite3")) if isinstance(node_parser, CompactSentenceWindowNodeParser) else None
+    transformations: list[Any] = [
+      node_parser,
+      *([SentenceRecorder(sentence_store)] if sentence_store is not None else []),
+      TextCleanUp(),
+    ]
+    nodes = run_transformations(documents, transformations)
+    embeddings = embed_model.get_text_embedding_batch([node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes])
+    for node, embedding in zip(nodes, embeddings):
+      node.embedding = embedding
+    for i in range(0, len(nodes), 1024):
+      vector_store.add(nodes[i:i + 1024])
+
+    expander = SentenceWindowExpander(vector_store=vector_store, sentence_store=sentence_store)
+
+    latencies = []
+    window_lengths = []
+    for query_embedding in query_embeddings:
+      started_at = perf_counter()
+      result = vector_store.query(VectorStoreQuery(query_embedding=query_embedding, similarity_top_k=top_k))
+      # The reranker (not measured) keeps the `top_n` nodes; their windows are needed for the prompt.
+      top_nodes = [NodeWithScore(node=node) for node in (result.nodes or [])[:top_n]]
+      expander.postprocess_nodes(top_nodes)
+      latencies.append(perf_counter() - started_at)
+      window_lengths.extend(len(node.node.metadata.get(sentence_window.DEFAULT_WINDOW_METADATA_KEY, "")) for node in top_nodes)
+
+    latencies.sort()
+    print(
+      f"{name:<10} {len(nodes):>8} nodes  {get_dir_size(chroma_path) / 2**20:>9.1f} MiB  "
+      f"retrieval p50 {statistics.median(latencies) * 1000:>7.1f} ms, "
+      f"p95 {latencies[int(len(latencies) * 0.95)] * 1000:>7.1f} ms, "
+      f"window {statistics.mean(window_lengths or [0]):>6.0f} chars"
+    )
+
+def main():
+  arg_parser = ArgumentParser(description="Benchmark the sentence window storage.")
+  arg_parser.add_argument("--document-count", type=int, default=500, help="The size of the generated corpus.")
+  arg_parser.add_argument("--query-count", type=int, default=100)
+  arg_parser.add_argument("--top-k", type=int, default=128)
+  arg_parser.add_argument("--top-n", type=int, default=10)
+  arg_parser.add_argument("--fake-embeddings", action="store_true", help="Embed with a deterministic stand-in for the model.")
+  args = arg_parser.parse_args()
+
+  with TemporaryDirectory() as path:
+    if not os.getenv(INGESTION_LOCAL_PATH_ENV):
+      docs_path = p.join(path, "docs")
+      os.makedirs(docs_path)
+      make_corpus(docs_path, args.document_count)
+      os.environ[INGESTION_LOCAL_PATH_ENV] = docs_path
+
+    # Both runs embed the same sentences; only compute the embeddings once.
+    embed_model = CachedEmbedding(
+      FakeEmbedding() if args.fake_embeddings else FastEmbedEmbedding(model_name="BAAI/bge-small-en-v1.5", max_length=512),
+      cache=EmbeddingCache(p.join(path, "embeddings.sqlite3")),
+    )
+
+    # Random sentences of the corpus as queries.
+    sentences = [node.get_content() for node in run_transformations(load_data(), [SentenceWindowNodeParser.from_defaults()])]
+    queries = random.Random(1).sample(sentences, min(args.query_count, len(sentences)))
+    query_embeddings = [embed_model.get_query_embedding(query) for query in queries]
+
+    run("metadata", SentenceWindowNodeParser.from_defaults(), embed_model, query_embeddings, args.top_k, args.top_n)
+    run("compact", CompactSentenceWindowNodeParser.from_defaults(), embed_model, query_embeddings, args.top_k, args.top_n)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,89 @@
+"""
+Compares `qas.text_normalizer` with the regex chains of `TextCleanUp.clean_up_text()` (which it replaced)
+and `confluence_md.clean_text()`.
+
+  python bench/text_normalizer.py [--node-count N] [--repeat N]
+"""
+
+from argparse import ArgumentParser
+from time import perf_counter
+from typing import Callable
+import os.path as p
+import random
+import re
+import sys
+
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
+
+from qas.text_normalizer import has_min_word_count, normalize_text, normalize_texts
+
+_leading_empty_lines = re.compile(r"^([^\S\n]*\n)+")
+_excessive_empty_lines = re.compile(r"([^\S\n]*\n){2,}")
+_rouge_line_break = re.compile(r"(?<=[\w ])\n(?=[\w])")
+_trailing_whitespace = re.compile(r"\s+$")
+_word = re.compile(r"\w+")
+
+def regex_clean_up_text(s: str) -> str:
+  s = _leading_empty_lines.sub("", s)
+  s = _excessive_empty_lines.sub("\n\n", s)
+  s = _rouge_line_break.sub(" ", s)
+  s = _trailing_whitespace.sub("", s)
+  return s
+
+def regex_is_not_tiny(s: str) -> bool:
+  return len(_word.findall(s)) > 3
+
+_TRAILING_WHITESPACE = re.compile(r"[^\S\n]+$", flags=re.MULTILINE)
+_REDUNDANT_LINE_BREAKS = re.compile(r"\n{3,}")
+
+def regex_clean_text(s: str) -> str:
+  s = _TRAILING_WHITESPACE.sub("", s)
+  s = _REDUNDANT_LINE_BREAKS.sub("\n\n", s)
+  return s.strip()
+
+def make_texts(count: int, seed: int = 1) -> list[str]:
+  """
+  Sentence window-sized texts with the whitespace typical of Markdown converted from HTML:
+  lines of several words, sometimes with trailing whitespace, and paragraphs separated by (multiple) empty lines.
+  """
+
+  rng = random.Random(seed)
+  words = ["the", "page", "describes", "release", "process", "of", "VPN", "access", "request", "team", "owner", "template"]
+  line_ends = ["\n"] * 6 + [" \n", "  \n", "\n\n", "\n\n", "\n\n\n", " \n \n\n", "\n  "]
+
+  texts = []
+  for _ in range(count):
+    parts = ["\n" * rng.randint(0, 2)]
+    for _ in range(rng.randint(2, 8)):
+      parts.append(" ".join(rng.choice(words) for _ in range(rng.randint(3, 15))))
+      parts.append(rng.choice(line_ends))
+    texts.append("".join(parts))
+  return texts
+
+def measure(name: str, f: Callable[[], object], repeat: int, text_count: int) -> float:
+  best = float("inf")
+  for _ in range(repeat):
+    started_at = perf_counter()
+    f()
+    best = min(best, perf_counter() - started_at)
+  print(f"{name:<48} {best * 1000:>9.1f} ms  {text_count / best:>12,.0f} texts/s")
+  return best
+
+def main():
+  arg_parser = ArgumentParser(description="Benchmark the text normalizer against the regex chains.")
+  arg_parser.add_argument("--node-count", type=int, default=50_000)
+  arg_parser.add_argument("--repeat", type=int, default=5)
+  args = arg_parser.parse_args()
+
+  texts = make_texts(args.node_count)
+  print(f"{len(texts)} texts, {sum(map(len, texts)) / len(texts):.0f} characters on average, best of {args.repeat}\n")
+
+  measure("TextCleanUp: regex chain + word count", lambda: [regex_clean_up_text(s) for s in texts if regex_is_not_tiny(s)], args.repeat, len(texts))
+  measure("TextCleanUp: normalize_text + word count", lambda: [r.text for r in (normalize_text(s, join_lines=True) for s in texts) if has_min_word_count(r.text, 4)], args.repeat, len(texts))
+  measure("TextCleanUp: normalize_texts (parallel)", lambda: normalize_texts(texts, join_lines=True), args.repeat, len(texts))
+  print()
+  measure("clean_text: regex chain", lambda: [regex_clean_text(s) for s in texts], args.repeat, len(texts))
+  measure("clean_text: normalize_text", lambda: [normalize_text(s).text for s in texts], args.repeat, len(texts))
+
+if __name__ == "__main__":
+  main()
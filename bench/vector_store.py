@@ -0,0 +1,142 @@
+"""
+Compares `MmapVectorStore` with Chroma on synthetic `BAAI/bge-small-en-v1.5`-sized (384-dimensional) embeddings:
+the ingestion time, the size on disk, the time to open the store, the query latency and the recall
+(of the exact cosine similarity top-k).
+
+  python bench/vector_store.py [--node-counts 100000,1000000] [--query-count N] [--top-k N]
+"""
+
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+from time import perf_counter
+from typing import Callable, Iterator
+import os
+import os.path as p
+import statistics
+import sys
+
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
+
+from llama_index.schema import NodeRelationship, RelatedNodeInfo, TextNode
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery
+import chromadb
+import numpy as np
+
+from qas.batch_query import query_vector_store
+from qas.mmap_vector_store import MmapVectorStore
+
+DIMENSION = 384
+BATCH_SIZE = 5000
+CLUSTER_COUNT = 2000
+
+def make_embeddings(batch_index: int) -> np.ndarray:
+  """
+  A batch of normalized embeddings clustered around the same centers (like the sentences of similar pages).
+  """
+
+  centers = np.random.default_rng(0).normal(size=(CLUSTER_COUNT, DIMENSION)).astype(np.float32)
+  rng = np.random.default_rng(batch_index + 1)
+  embeddings = centers[rng.integers(CLUSTER_COUNT, size=BATCH_SIZE)] + rng.normal(scale=0.6, size=(BATCH_SIZE, DIMENSION))
+  return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(np.float32)
+
+def iter_batches(node_count: int) -> Iterator[tuple[int, np.ndarray]]:
+  for batch_index in range(node_count // BATCH_SIZE):
+    yield batch_index * BATCH_SIZE, make_embeddings(batch_index)
+
+def make_nodes(offset: int, embeddings: np.ndarray) -> list[TextNode]:
+  return [
+    TextNode(
+      id_=f"node-{offset + i}",
+      text=f"Sentence {offset + i} of a synthetic document.",
+      embedding=embedding.tolist(),
+      relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id=f"document-{(offset + i) // 20}")},
+    )
+    for i, embedding in enumerate(embeddings)
+  ]
+
+def get_exact_top_k(node_count: int, queries: np.ndarray, top_k: int) -> list[set[str]]:
+  best_rows = np.empty((len(queries), 0), dtype=np.int64)
+  best_scores = np.empty((len(queries), 0), dtype=np.float32)
+  for offset, embeddings in iter_batches(node_count):
+    rows = np.concatenate([best_rows, np.broadcast_to(np.arange(offset, offset + len(embeddings)), (len(queries), len(embeddings)))], axis=1)
+    scores = np.concatenate([best_scores, queries @ embeddings.T], axis=1)
+    best = np.argsort(-scores, axis=1)[:, :top_k]
+    best_rows = np.take_along_axis(rows, best, axis=1)
+    best_scores = np.take_along_axis(scores, best, axis=1)
+  return [{f"node-{i}" for i in rows} for rows in best_rows]
+
+def get_dir_size(path: str) -> int:
+  return sum(p.getsize(p.join(dir_path, file_name)) for dir_path, _, file_names in os.walk(path) for file_name in file_names)
+
+def run(
+  name: str,
+  open_store: Callable[[str], BasePydanticVectorStore],
+  node_count: int,
+  queries: np.ndarray,
+  exact_top_k: list[set[str]],
+  top_k: int,
+):
+  with TemporaryDirectory() as path:
+    vector_store = open_store(path)
+    started_at = perf_counter()
+    for offset, embeddings in iter_batches(node_count):
+      vector_store.add(make_nodes(offset, embeddings))
+    ingestion_duration = perf_counter() - started_at
+    del vector_store
+
+    started_at = perf_counter()
+    vector_store = open_store(path)
+    open_duration = perf_counter() - started_at
+
+    latencies = []
+    recalls = []
+    for query, exact_ids in zip(queries, exact_top_k):
+      started_at = perf_counter()
+      result = vector_store.query(VectorStoreQuery(query_embedding=query.tolist(), similarity_top_k=top_k))
+      latencies.append(perf_counter() - started_at)
+      recalls.append(len(exact_ids.intersection(result.ids or [])) / top_k)
+
+    # The expanded queries of a request (see `MultiQueryRetriever`).
+    batch_latencies = []
+    for i in range(0, len(queries) - 3, 4):
+      started_at = perf_counter()
+      query_vector_store(vector_store, [query.tolist() for query in queries[i:i + 4]], top_k)
+      batch_latencies.append(perf_counter() - started_at)
+
+    latencies.sort()
+    batch_latencies.sort()
+    print(
+      f"{name:<14} {node_count:>9} nodes  ingestion {ingestion_duration:>7.1f} s  {get_dir_size(path) / 2**20:>8.1f} MiB  "
+      f"open {open_duration * 1000:>7.1f} ms  "
+      f"query p50 {statistics.median(latencies) * 1000:>7.1f} ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:>7.1f} ms  "
+      f"4 queries p50 {statistics.median(batch_latencies) * 1000:>7.1f} ms  "
+      f"recall@{top_k} {statistics.mean(recalls):.3f}"
+    )
+
+def open_chroma(path: str) -> BasePydanticVectorStore:
+  return ChromaVectorStore(chroma_collection=chromadb.PersistentClient(path=path).get_or_create_collection("context"))
+
+def main():
+  arg_parser = ArgumentParser(description="Benchmark the memory-mapped vector store against Chroma.")
+  arg_parser.add_argument("--node-counts", default="100000,1000000")
+  arg_parser.add_argument("--query-count", type=int, default=200)
+  arg_parser.add_argument("--top-k", type=int, default=64)
+  args = arg_parser.parse_args()
+
+  for node_count in (int(count) for count in args.node_counts.split(",")):
+    node_count = max(node_count // BATCH_SIZE, 1) * BATCH_SIZE
+
+    # Perturbed stored embeddings as queries (the query is usually close to some of the sentences).
+    rng = np.random.default_rng(node_count)
+    queries = make_embeddings(0)[:args.query_count] + rng.normal(scale=0.02, size=(args.query_count, DIMENSION))
+    queries = (queries / np.linalg.norm(queries, axis=1, keepdims=True)).astype(np.float32)
+    exact_top_k = get_exact_top_k(node_count, queries, args.top_k)
+
+    run("chroma", open_chroma, node_count, queries, exact_top_k, args.top_k)
+    run("mmap", lambda path: MmapVectorStore(path, rescore=False), node_count, queries, exact_top_k, args.top_k)
+    run("mmap+rescore", lambda path: MmapVectorStore(path, rescore=True), node_count, queries, exact_top_k, args.top_k)
+    print()
+
+if __name__ == "__main__":
+  main()
@@ -1,4 +1,235 @@
+from typing import Literal
+
 from llama_index.schema import Document
+from pydantic_settings import BaseSettings, SettingsConfigDict
+
+class Settings(BaseSettings):
+  model_config = SettingsConfigDict(extra="ignore", env_file=".env")
+
+  chroma_path: str = "./chroma"
+  """
+  The directory to persist the vector store in.
+  """
+
+  sync: bool = False
+  """
+  Synchronize the vector store with the documents returned by `load_data()` on start,
+  re-indexing only new and changed sources. The synchronization is always performed
+  when the vector store is empty.
+  """
+
+  vector_store: Literal["chroma", "mmap"] = "chroma"
+  """
+  - "chroma": a persistent Chroma collection
+  - "mmap": an in-process store of int8-quantized embeddings in memory-mapped files (see `MmapVectorStore`)
+
+  The ingestion manifest (and the other files kept alongside the vector store) is not kept per store:
+  remove `chroma_path` when switching to a store populated before.
+  """
+
+  mmap_vector_store_dir_name: str = "mmap_vector_store"
+  """
+  The directory name of the "mmap" vector store (stored alongside the vector store, see `chroma_path`).
+  """
+
+  mmap_vector_store_rescore: bool = True
+  """
+  Keep a float32 copy of the embeddings to re-score the best candidates found with the quantized ones
+  (only applies to a new "mmap" vector store).
+  """
+
+  sharding: Literal["none", "space", "hash"] = "none"
+  """
+  - "none": a single collection (or "mmap" vector store)
+  - "space": a shard (a collection or an "mmap" vector store) per Confluence space (the `space` front matter key;
+    the documents without one go to the "default" shard)
+  - "hash": `shard_count` shards, by a hash of the source
+
+  The shards are searched concurrently (see `ShardedVectorStore`). Remove `chroma_path` when changing the sharding.
+  """
+
+  shard_count: int = 8
+  """
+  The number of the "hash" shards.
+  """
+
+  shard_query_concurrency: int = 8
+  """
+  The max. number of shards searched at the same time.
+  """
+
+  rebuild_shards: str | None = None
+  """
+  The comma-separated names of the shards to remove and ingest again on start (e.g. "ENG,OPS"), leaving the other shards as is.
+  """
+
+  manifest_file_name: str = "ingestion_manifest.json"
+  """
+  The ingestion manifest file name (stored alongside the vector store, see `chroma_path`).
+  """
+
+  compact_sentence_windows: bool = True
+  """
+  Only store the position of each sentence instead of a copy of its window (see `CompactSentenceWindowNodeParser`);
+  the windows are rebuilt from the neighbouring sentences at query time. Only applies to the (re-)ingested documents.
+  """
+
+  sentence_store_file_name: str = "sentences.sqlite3"
+  """
+  The file name of the sentences of the documents ingested with `compact_sentence_windows`, to rebuild the windows from
+  (stored alongside the vector store, see `chroma_path`).
+  """
+
+  node_dedup_file_name: str = "node_dedup.sqlite3"
+  """
+  The file name of the digests of the ingested nodes (stored alongside the vector store, see `chroma_path`).
+  """
+
+  node_dedup_near_duplicates: bool = False
+  """
+  Also drop the nodes almost identical to the nodes ingested before (e.g. template paragraphs), see `NodeDedup`.
+  """
+
+  node_dedup_near_duplicate_threshold: float = 0.8
+
+  retrieval: Literal["dense", "hybrid"] = "hybrid"
+  """
+  - "dense": the vector store only
+  - "hybrid": the vector store and a BM25 index fused with reciprocal rank fusion (see `HybridRetriever`)
+  """
+
+  bm25_file_name: str = "bm25.sqlite3"
+  """
+  The BM25 index file name (stored alongside the vector store, see `chroma_path`).
+  """
+
+  hybrid_similarity_top_k: int = 32
+  """
+  The number of the fused nodes passed on to the reranker in the hybrid retrieval mode.
+  """
+
+  refinement_iterations: int = 1
+  """
+  The max. number of the refinement passes after the first (expert group) one, each answering again given
+  the previous response and the context retrieved for it; with 0, a single pass answers directly (the fastest).
+  """
+
+  refinement_confidence_threshold: float | None = None
+  """
+  Answer directly in the first pass (skipping the expert group discussion) when the best reranker score
+  of the context reaches this (the `cross-encoder/ms-marco-MiniLM-L-12-v2` scores are logits, e.g. 5.0);
+  a refinement pass follows only if it finds new context (see `refinement_novelty_top_k`).
+  """
+
+  refinement_novelty_top_k: int = 3
+  """
+  Keep the previous answer instead of refining it when none of the best this many nodes of a refinement pass
+  were in the context before.
+  """
+
+  context_token_budget: int | None = None
+  """
+  The max. number of tokens of the context in each prompt (e.g. 1536): the windows of the reranked nodes are merged
+  and the most relevant ones that fit are kept (see `ContextPacker`). Only merged, not limited, when not set.
+  """
+
+  context_tokenizer: str | None = None
+  """
+  The Hugging Face tokenizer to count the context tokens with (the one of the LLM, e.g. an ungated copy of the Mistral
+  tokenizer); the llama_index default (tiktoken) is used when not set or when it fails to load.
+  """
+
+  embedding_cache_path: str | None = "./cache/embeddings.sqlite3"
+  """
+  The embedding cache database path; set to an empty value to disable the cache.
+  """
+
+  embedding_cache_max_entries: int = 500_000
+  """
+  The max. number of cached embeddings (about 1.5 KB each for `BAAI/bge-small-en-v1.5`).
+  """
+
+  background_startup: bool = True
+  """
+  Show the query prompt right away and make the query engine (load the models, open the vector store)
+  in the background; the first query waits for it. The ingestion progress, if any, is printed meanwhile.
+  """
+
+  llm_warm_up: bool = True
+  """
+  Send a warm-up request to Ollama on start, so the model weights are loaded before the first query.
+  """
+
+  stream: bool = True
+  """
+  Print the response tokens as they are generated.
+  """
+
+  stream_expert_response: bool = False
+  """
+  Print the first-pass (expert group) response tokens as they are generated too (requires `stream`).
+  """
+
+  answer_cache: bool = False
+  """
+  Answer the queries similar enough to the ones answered before with the stored answers.
+  The stored answers are dropped when the index changes.
+  """
+
+  answer_cache_path: str | None = "./cache/answers.sqlite3"
+  """
+  The answer cache database path; keep the answer cache in memory only when not set.
+  """
+
+  answer_cache_similarity_threshold: float = 0.92
+  """
+  The min. cosine similarity of the query embeddings to consider the queries equivalent.
+  """
+
+  answer_cache_ttl: float = 24 * 60 * 60
+  """
+  The answer cache entry lifetime, in seconds.
+  """
+
+  answer_cache_max_entries: int = 1024
+
+  tracing_jsonl_path: str | None = None
+  """
+  Append the timed spans (of the ingestion and of each query stage, with their counters) to this file
+  as JSON lines (see `qas.tracing`); not recorded when neither this nor `tracing_prometheus_path` is set.
+  """
+
+  tracing_prometheus_path: str | None = None
+  """
+  Write the span durations and the counters (nodes, tokens, cache hits) to this file in the Prometheus text format.
+  """
+
+  slow_query_profiling_threshold: float | None = None
+  """
+  Sample the stacks while the queries run and dump the ones of the queries slower than this (in seconds)
+  to `slow_query_profile_dir`; no profiling when not set.
+  """
+
+  slow_query_profile_dir: str = "./traces/profiles"
+
+  llm_concurrency_limit: int = 2
+  """
+  The max. number of concurrent LLM (Ollama) calls made by the HTTP server.
+  """
+
+  server_host: str = "127.0.0.1"
+  server_port: int = 8000
+
+  server_worker_count: int = 8
+  """
+  The max. number of queries processed concurrently by the HTTP server.
+  """
+
+  server_queue_size: int = 32
+  """
+  The max. number of queries waiting to be processed; the HTTP server rejects new queries
+  with "503 Service Unavailable" when the queue is full.
+  """
 
 def load_data() -> list[Document]:
   import qas.ingestion.local
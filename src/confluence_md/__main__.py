@@ -1,89 +1,301 @@
-import os.path as p
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from threading import Event, Lock, local
+from time import perf_counter
 from typing import Tuple
 from urllib.parse import urljoin
+import os
+import os.path as p
+import sys
 
 from atlassian.confluence import Confluence
 
-import frontmatter
-
+from .batch_size import BatchSizeController
+from .checkpoint import Checkpoint
 from .config import Config
-from .client import Client
-from .types import Space
-from .html2md import make_html2md
-from .clean_text import clean_text
+from .client import Client, Cursor
+from .convert import ConversionItem, convert_pages, init_worker
+from .types import Content, Space
+from .progress import Progress, StageStats
+from .sync_state import PageState, SpaceState, SyncState
+
+EXPAND = "ancestors,body.export_view,version"
+BATCH_SIZE = 100
+SYNC_STATE_FILE_NAME = ".sync_state.json"
+CHECKPOINT_FILE_NAME = ".checkpoint.json"
+PARTIAL_PAGE_SUFFIX = ".tmp"
+
+arg_parser = ArgumentParser(prog="confluence_md", description="Download Confluence pages as Markdown files.")
+arg_parser.add_argument(
+  "--delta",
+  action="store_true",
+  help="only download the pages modified since the last successful run and delete the files of the removed pages",
+)
+arg_parser.add_argument(
+  "--resume",
+  action="store_true",
+  help="continue an interrupted run from the last checkpoint instead of starting over",
+)
+args = arg_parser.parse_args()
 
 config = Config()
 
-client = Client(Confluence(
-  url=str(config.url),
-  oauth2={
-    "client_id": config.client_id,
-    "token": {
-      "access_token": config.access_token,
-      "token_type": "Bearer",
-    },
-  }
-))
+sync_state_path = p.join(config.dump_dir, SYNC_STATE_FILE_NAME)
+sync_state = SyncState.load(sync_state_path)
+sync_state_lock = Lock()
 
-spaces = client.get_all_spaces()
+checkpoint_path = p.join(config.dump_dir, CHECKPOINT_FILE_NAME)
+checkpoint = Checkpoint.load(checkpoint_path) if args.resume else Checkpoint(delta=args.delta)
+if checkpoint.delta != args.delta:
+  print(f"The checkpoint was made {'with' if checkpoint.delta else 'without'} --delta; starting over.")
+  checkpoint = Checkpoint(delta=args.delta)
 
-spaces_ext: list[Tuple[int, Space]] = [(client.get_space_page_count(scope.key) or 0, scope) for scope in spaces]
-spaces_ext.sort(key=lambda item: item[0], reverse=True) # Start with the largest spaces.
+# Set on Ctrl-C: the workers stop after the batch in progress, keeping the checkpoint consistent.
+stop_event = Event()
 
-expected_page_count = sum([page_count for page_count, _ in spaces_ext])
-loaded_page_count = 0
+def make_client() -> Client:
+  return Client(Confluence(
+    url=str(config.url),
+    oauth2={
+      "client_id": config.client_id,
+      "token": {
+        "access_token": config.access_token,
+        "token_type": "Bearer",
+      },
+    }
+  ))
+
+_thread_local = local()
+
+def get_thread_client() -> Client:
+  """
+  A client per worker thread (the underlying HTTP session is not meant to be shared between threads).
+  """
+
+  client = getattr(_thread_local, "client", None)
+  if client is None:
+    client = make_client()
+    _thread_local.client = client
+  return client
+
+def load_space(space: Space, space_page_count: int, progress: Progress) -> bool | None:
+  """
+  Returns `None` if the space was skipped or the loading was stopped.
+  """
 
-failed_spaces: List[Tuple[int, Space]] = []
+  with sync_state_lock:
+    if checkpoint.is_space_completed(space.key) or stop_event.is_set():
+      return None
+    cursor = checkpoint.spaces.get(space.key, Cursor()).model_copy()
+    space_state = sync_state.spaces.get(space.key) if args.delta else None
 
-# for i, space in enumerate(spaces):
-for i, (space_page_count, space) in enumerate(spaces_ext):
-  print(f"[{i + 1:>3}/{len(spaces):>3}] Loading {space.key}, {space_page_count} page(s)...")
+  progress.space_started(space, space_page_count)
+  if cursor.offset:
+    print(f"{space.key}: resuming at offset {cursor.offset} ({cursor.skip_count} page(s) skipped before).")
+
+  started_at = datetime.now(timezone.utc)
+  is_resumed = cursor.offset > 0
 
   try:
-    pages = client.get_space_content(space.key, batch_size=100, expand="ancestors,body.export_view")
+    client = get_thread_client()
+
+    if space_state:
+      since = space_state.synced_at - timedelta(hours=config.delta_overlap_hours)
+      batches = client.iter_space_content_modified_since(space.key, since, batch_size=BATCH_SIZE, expand=EXPAND, cursor=cursor)
+    else:
+      batches = client.iter_space_content(space.key, batch_size=BATCH_SIZE, expand=EXPAND, batch_size_controller=batch_size_controller, cursor=cursor)
+
+    base_url = str(space.links.base) if space.links.base else str(config.url)
+
+    # Only the IDs of the pages are kept in memory; the pages are written as they arrive.
+    loaded_page_ids: set[str] = set()
+
+    # The stages of a batch are sequential, but the stages of the batches of different spaces overlap.
+    fetch_started_at = perf_counter()
+    for pages in batches:
+      stage_stats.add("fetch", len(pages), perf_counter() - fetch_started_at)
+
+      loaded_page_ids.update(page.id for page in pages)
+      if space_state:
+        # The overlap results in some pages fetched again.
+        pages = [page for page in pages if is_page_updated(page)]
+
+      convert_started_at = perf_counter()
+      contents = convert_pages(
+        conversion_executor,
+        [make_conversion_item(space, page, base_url=base_url) for page in pages],
+        worker_count=conversion_worker_count,
+      )
+      stage_stats.add("convert", len(pages), perf_counter() - convert_started_at)
 
-    page_count = len(pages)
-    loaded_page_count += page_count
+      write_started_at = perf_counter()
+      for page, content in zip(pages, contents):
+        write_page(space, page, content)
+      stage_stats.add("write", len(pages), perf_counter() - write_started_at)
 
-    print(f"Loaded {page_count} page(s).")
-    print("Saving as files...")
+      progress.pages_loaded(space, len(pages))
 
-    base_url = str(space.links.base) if space.links.base else config.url
-    html2md = make_html2md(str(base_url))
+      # The pages of the batch are on disk; commit the position after it.
+      with sync_state_lock:
+        checkpoint.spaces[space.key] = cursor.model_copy()
+        checkpoint.save(checkpoint_path)
+        sync_state.save(sync_state_path)
 
-    for page in pages:
-      meta: dict[str, object] = {
-        # Using "page_id" over just "id" for compatibility with `llama_hub.confluence.ConfluenceReader`.
-        "page_id": page.id,
-        "title": page.title,
-        "url": urljoin(str(base_url), page.links.tinyui),
-        "space": space.key,
-      }
-      if page.ancestors and len(page.ancestors) > 1:
-        meta["ancestors"] = [ancestor.id for ancestor in page.ancestors[1:]] # Skip the space front-page.
+      if stop_event.is_set():
+        return None
 
-      assert page.body is not None
+      fetch_started_at = perf_counter()
 
-      html = page.body["export_view"]["value"]
-      md = clean_text(html2md.handle(html))
+    if space_state:
+      page_ids = {page.id for page in client.get_space_content(space.key, batch_size=500)}
+      # Only trust a complete listing (the listing is interrupted by errors rather than failed).
+      is_complete = len(page_ids) >= (client.get_space_page_count(space.key) or 0)
+    else:
+      page_ids = loaded_page_ids
+      # Some pages could have been skipped due to errors; only consider the space synchronized when none were.
+      is_complete = cursor.item_count >= space_page_count
 
-      post = frontmatter.Post(md, **meta)
+    # The pages loaded before resuming are not known, so they'd all look removed.
+    if is_complete and (space_state or not is_resumed):
+      remove_pages(space, page_ids)
 
-      # NB: The file will be overwritten.
-      fname = p.join(config.dump_dir, f"{page.id}.md")
-      with open(fname, mode="wb") as f:
-        frontmatter.dump(post, f)
+    with sync_state_lock:
+      if is_complete:
+        sync_state.spaces[space.key] = SpaceState(synced_at=started_at)
+      sync_state.save(sync_state_path)
+      checkpoint.complete_space(space.key)
+      checkpoint.save(checkpoint_path)
 
   except Exception as e:
-    failed_spaces.append((space_page_count, space))
-    print(f"❌ Skipping space {space.key} due to errors.")
-    continue
+    progress.space_failed(space)
+    return False
+
+  progress.space_finished(space)
+  return True
+
+def make_conversion_item(space: Space, page: Content, base_url: str) -> ConversionItem:
+  meta: dict[str, object] = {
+    # Using "page_id" over just "id" for compatibility with `llama_hub.confluence.ConfluenceReader`.
+    "page_id": page.id,
+    "title": page.title,
+    "url": urljoin(base_url, page.links.tinyui),
+    "space": space.key,
+  }
+  if page.ancestors and len(page.ancestors) > 1:
+    meta["ancestors"] = [ancestor.id for ancestor in page.ancestors[1:]] # Skip the space front-page.
+
+  assert page.body is not None
+
+  return ConversionItem(html=page.body["export_view"]["value"], base_url=base_url, meta=meta)
+
+def write_page(space: Space, page: Content, content: bytes):
+  # NB: The file will be overwritten. Writing to a temporary file first, so an interrupted run never leaves
+  # a truncated page behind (the leftover temporary files are removed on the next run, see `remove_partial_pages()`).
+  fname = p.join(config.dump_dir, f"{page.id}.md")
+  tmp_fname = f"{fname}{PARTIAL_PAGE_SUFFIX}"
+  with open(tmp_fname, mode="wb") as f:
+    f.write(content)
+  os.replace(tmp_fname, fname)
+
+  with sync_state_lock:
+    sync_state.pages[page.id] = PageState(
+      space=space.key,
+      version=page.version.number if page.version else None,
+      when=page.version.when if page.version else None,
+    )
+
+def is_page_updated(page: Content) -> bool:
+  with sync_state_lock:
+    page_state = sync_state.pages.get(page.id)
+  return page_state is None or page.version is None or page_state.version != page.version.number
+
+def remove_pages(space: Space, existing_page_ids: set[str]):
+  """
+  Delete the files of the pages of the space that no longer exist.
+  """
+
+  with sync_state_lock:
+    removed_page_ids = sync_state.get_space_page_ids(space.key) - existing_page_ids
+
+  for page_id in removed_page_ids:
+    fname = p.join(config.dump_dir, f"{page_id}.md")
+    if p.exists(fname):
+      os.remove(fname)
+
+  with sync_state_lock:
+    for page_id in removed_page_ids:
+      sync_state.pages.pop(page_id, None)
+
+  if removed_page_ids:
+    print(f"{space.key}: removed {len(removed_page_ids)} deleted page(s).")
+
+def remove_partial_pages():
+  """
+  Delete the pages left partially written by an interrupted run; they are fetched and written again.
+  """
+
+  fnames = [fname for fname in os.listdir(config.dump_dir) if fname.endswith(f".md{PARTIAL_PAGE_SUFFIX}")]
+  for fname in fnames:
+    os.remove(p.join(config.dump_dir, fname))
+
+  if fnames:
+    print(f"Removed {len(fnames)} partially written page(s).")
+
+if p.isdir(config.dump_dir):
+  remove_partial_pages()
+
+client = make_client()
+
+spaces = client.get_all_spaces()
+
+spaces_ext: list[Tuple[int, Space]] = [(client.get_space_page_count(scope.key) or 0, scope) for scope in spaces]
+spaces_ext.sort(key=lambda item: item[0], reverse=True) # Start with the largest spaces.
+
+expected_page_count = sum([page_count for page_count, _ in spaces_ext])
+
+# Shared by all the workers, since the server load is shared as well.
+batch_size_controller = BatchSizeController(max_size=BATCH_SIZE)
+
+# HTML to Markdown conversion is CPU-bound (`html2text` is pure Python), so it's done by a process pool
+# shared by all the workers.
+conversion_worker_count = config.conversion_workers or os.cpu_count() or 1
+conversion_executor = ProcessPoolExecutor(max_workers=conversion_worker_count, initializer=init_worker)
+
+stage_stats = StageStats()
+
+progress = Progress(
+  space_count=len(spaces_ext),
+  expected_page_count=expected_page_count,
+  batch_size_controller=batch_size_controller,
+  stage_stats=stage_stats,
+)
+
+if checkpoint.completed_spaces:
+  print(f"Skipping {len(checkpoint.completed_spaces)} space(s) completed before.")
+
+executor = ThreadPoolExecutor(max_workers=config.concurrency)
+try:
+  # The spaces are picked up by the workers in the submission order.
+  results = list(executor.map(lambda item: load_space(item[1], item[0], progress), spaces_ext))
+except KeyboardInterrupt:
+  print("Interrupted; finishing the batches in progress. Run with --resume to continue.")
+  stop_event.set()
+  executor.shutdown(wait=True, cancel_futures=True)
+  conversion_executor.shutdown()
+  sys.exit(130)
+executor.shutdown()
+conversion_executor.shutdown()
+
+failed_spaces: list[Tuple[int, Space]] = [item for item, ok in zip(spaces_ext, results) if ok is False]
 
-  print(f"Done.")
+if not failed_spaces:
+  Checkpoint.remove(checkpoint_path)
 
 if failed_spaces:
   print("The following spaces couldn't be processed due to errors:")
   for page_count, space in failed_spaces:
     print(f"- {space.key}, {page_count} page(s)")
 
-print(f"Successfully loaded {loaded_page_count / expected_page_count * 100:.2f}% of all pages")
\ No newline at end of file
+print(f"Throughput: {stage_stats.format_stats()}")
+print(f"Successfully loaded {progress.loaded_page_count / expected_page_count * 100:.2f}% of all pages")
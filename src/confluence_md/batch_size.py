@@ -0,0 +1,83 @@
+from threading import Lock
+
+class BatchSizeController:
+  """
+  An additive-increase/multiplicative-decrease (AIMD) batch size controller.
+
+  The batch size grows by `increase_step` after each successful batch and shrinks by `decrease_factor`
+  after each failure (HTTP 5xx errors and read timeouts, see `client._default_retry`). The controller
+  is meant to persist across batches and spaces, so the batch size that works for the server is kept,
+  instead of hitting the same errors at the start of each batch. Thread-safe.
+  """
+
+  min_size: int
+  max_size: int
+  increase_step: int
+  decrease_factor: float
+  latency_smoothing: float
+
+  _size: float
+  _latency: float | None
+  _last_latency: float | None
+  _success_count: int
+  _failure_count: int
+  _lock: Lock
+
+  def __init__(
+    self,
+    max_size: int,
+    initial_size: int | None = None,
+    min_size: int = 1,
+    increase_step: int | None = None,
+    decrease_factor: float = 3.0,
+    latency_smoothing: float = 0.2,
+  ):
+    self.min_size = min_size
+    self.max_size = max_size
+    self.increase_step = increase_step or max(max_size // 10, 1)
+    self.decrease_factor = decrease_factor
+    self.latency_smoothing = latency_smoothing
+
+    self._size = float(initial_size or max_size)
+    self._latency = None
+    self._last_latency = None
+    self._success_count = 0
+    self._failure_count = 0
+    self._lock = Lock()
+
+  @property
+  def size(self) -> int:
+    with self._lock:
+      return int(self._size)
+
+  @property
+  def latency(self) -> float | None:
+    """
+    The smoothed (exponential moving average) latency per batch, in seconds.
+    """
+
+    with self._lock:
+      return self._latency
+
+  def on_success(self, latency: float):
+    with self._lock:
+      self._success_count += 1
+      self._size = min(self._size + self.increase_step, self.max_size)
+      self._last_latency = latency
+      if self._latency is None:
+        self._latency = latency
+      else:
+        self._latency += self.latency_smoothing * (latency - self._latency)
+
+  def on_failure(self):
+    with self._lock:
+      self._failure_count += 1
+      self._size = max(self._size / self.decrease_factor, self.min_size)
+
+  def format_state(self) -> str:
+    with self._lock:
+      latency = f"{self._latency:.2f} s (last {self._last_latency:.2f} s)" if self._latency is not None and self._last_latency is not None else "n/a"
+      return (
+        f"batch size {int(self._size)} ({self.min_size}..{self.max_size}), latency {latency}, "
+        f"{self._success_count} batch(es) succeeded, {self._failure_count} failed"
+      )
@@ -0,0 +1,45 @@
+import os
+
+from pydantic import BaseModel
+
+from .client import Cursor
+
+class Checkpoint(BaseModel):
+  """
+  The progress of a run: the completed spaces and the position within the spaces in progress
+  (only advanced after a batch of pages has been written).
+  """
+
+  delta: bool = False
+  """
+  Whether the run is a delta one (the positions within the spaces refer to different listings).
+  """
+  completed_spaces: list[str] = []
+  spaces: dict[str, Cursor] = {}
+
+  @classmethod
+  def load(cls, path: str) -> "Checkpoint":
+    if not os.path.exists(path):
+      return cls()
+    with open(path, mode="r", encoding="utf-8") as f:
+      return cls.model_validate_json(f.read())
+
+  def save(self, path: str):
+    # Write to a temporary file first, so an interrupted write never leaves a truncated checkpoint behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as f:
+      f.write(self.model_dump_json(indent=1))
+    os.replace(tmp_path, path)
+
+  @staticmethod
+  def remove(path: str):
+    if os.path.exists(path):
+      os.remove(path)
+
+  def is_space_completed(self, space_key: str) -> bool:
+    return space_key in self.completed_spaces
+
+  def complete_space(self, space_key: str):
+    self.spaces.pop(space_key, None)
+    if space_key not in self.completed_spaces:
+      self.completed_spaces.append(space_key)
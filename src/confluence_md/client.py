@@ -1,10 +1,12 @@
-from time import sleep
-from typing import Callable
+from datetime import datetime
+from time import perf_counter, sleep
+from typing import Callable, Iterator
 
 from atlassian.confluence import Confluence
 from requests import HTTPError, ReadTimeout
 
 from .types import *
+from .batch_size import BatchSizeController
 from .retry import RetryInfo, exp_backoff, retry
 
 # Confluence Server REST API docs: https://docs.atlassian.com/ConfluenceServer/rest/latest/
@@ -14,6 +16,22 @@ SKIP_LIMIT = 300
 class _Skip(BaseModel):
   skip_count: int
 
+class Cursor(BaseModel):
+  """
+  The position within a paginated collection: the number of the items processed so far
+  and the number of the items skipped due to errors (see `Client.get_space_content()`).
+
+  It is advanced as each batch is yielded, so once the consumer is done with the batch,
+  the cursor can be saved to resume the iteration after it later on.
+  """
+
+  item_count: int = 0
+  skip_count: int = 0
+
+  @property
+  def offset(self) -> int:
+    return self.item_count + self.skip_count
+
 def _default_retry(f: Callable):
   def on_failure(retry_info: RetryInfo):
     if isinstance(retry_info.failure_reason, HTTPError) and retry_info.failure_reason.response.status_code in range(500, 600):
@@ -94,17 +112,56 @@ class Client:
     batch_size: int = 50,
     limit: int | None = None,
     expand: str | None = None,
+    batch_size_controller: BatchSizeController | None = None,
   ) -> list[Content]:
+    return [
+      page
+      for batch in self.iter_space_content(
+        space_key,
+        batch_size=batch_size,
+        limit=limit,
+        expand=expand,
+        batch_size_controller=batch_size_controller,
+      )
+      for page in batch
+    ]
+
+  def iter_space_content(
+    self,
+    space_key: str,
+    batch_size: int = 50,
+    limit: int | None = None,
+    expand: str | None = None,
+    batch_size_controller: BatchSizeController | None = None,
+    cursor: Cursor | None = None,
+  ) -> Iterator[list[Content]]:
+    """
+    Same as `get_space_content()`, but yields the pages batch by batch, as they are fetched.
+
+    Pass a shared `batch_size_controller` to keep the adjusted batch size across calls;
+    otherwise the adjusted batch size is kept across the batches of this call only.
+
+    Pass a `cursor` to track the position (or to resume from a saved one).
+    """
+
+    controller = batch_size_controller or BatchSizeController(max_size=batch_size)
 
     @_default_retry
     def fetch(start: int, retry_info: RetryInfo) -> Response[Content] | _Skip:
-      adjusted_batch_size = max(batch_size // (3 ** retry_info.failure_count), 1)
+      if retry_info.failure_count > 0:
+        # Each retry follows a server error or a read timeout.
+        controller.on_failure()
+
+      # The shared size may have been shrunk by the failures elsewhere (other offsets, spaces or workers),
+      # so only the failures at this offset make it ready to skip.
+      offset_batch_size = max(int(batch_size / controller.decrease_factor ** retry_info.failure_count), controller.min_size)
+      adjusted_batch_size = min(controller.size, offset_batch_size)
 
       if retry_info.failure_count > 0:
         print(f"At offset {start}.")
 
         print(f"Reducing batch size to {adjusted_batch_size} (default is {batch_size}).")
-        if adjusted_batch_size == 1:
+        if offset_batch_size <= controller.min_size:
           if retry_info.extra.get("ready_to_skip"):
             # Skipping 1 page doesn't really help, at least not on
             # the particular problematic Confluence instance used for testing.
@@ -113,7 +170,8 @@ class Client:
 
           retry_info.extra["ready_to_skip"] = True
 
-      return Response[Content].model_validate(
+      started_at = perf_counter()
+      response = Response[Content].model_validate(
         self._confluence.get_all_pages_from_space_raw(
           space=space_key,
           start=start,
@@ -121,22 +179,85 @@ class Client:
           expand=expand,
         )
       )
+      controller.on_success(latency=perf_counter() - started_at)
 
-    return self._collect(fetch, limit=limit)
+      return response
+
+    return self._iter_batches(fetch, limit=limit, cursor=cursor)
+
+  def get_space_content_modified_since(
+    self,
+    space_key: str,
+    since: datetime,
+    batch_size: int = 50,
+    limit: int | None = None,
+    expand: str | None = None,
+  ) -> list[Content]:
+    """
+    Pages of the space modified at or after `since` (at minute resolution).
+
+    Note that CQL interprets the date in the time zone of the user, so it's best to allow some overlap.
+
+    Unlike `get_space_content()`, never returns partial results.
+    """
+
+    return [page for batch in self.iter_space_content_modified_since(space_key, since, batch_size=batch_size, limit=limit, expand=expand) for page in batch]
+
+  def iter_space_content_modified_since(
+    self,
+    space_key: str,
+    since: datetime,
+    batch_size: int = 50,
+    limit: int | None = None,
+    expand: str | None = None,
+    cursor: Cursor | None = None,
+  ) -> Iterator[list[Content]]:
+    """
+    Same as `get_space_content_modified_since()`, but yields the pages batch by batch, as they are fetched.
+    Raises on errors (after the batches fetched so far have been yielded).
+
+    Pass a `cursor` to track the position (or to resume from a saved one).
+    """
+
+    cql = f"space=\"{space_key}\" and type=page and lastmodified >= \"{since:%Y/%m/%d %H:%M}\""
+
+    @_default_retry
+    def fetch(start: int, retry_info: RetryInfo) -> Response[Content]:
+      return Response[Content].model_validate(
+        self._confluence.get(
+          "rest/api/content/search",
+          params={
+            "cql": cql,
+            "start": start,
+            "limit": batch_size,
+            "expand": expand,
+          },
+        )
+      )
+
+    return self._iter_batches(fetch, limit=limit, allow_partial=False, cursor=cursor)
 
   def _collect(
     self,
     fetch: Callable[[int], Response[_T] | _Skip],
     limit: int | None
   ) -> list[_T]:
-    items: list[_T] = []
-    skip_count = 0
-    while limit is None or len(items) < limit:
+    return [item for batch in self._iter_batches(fetch, limit=limit) for item in batch]
+
+  def _iter_batches(
+    self,
+    fetch: Callable[[int], Response[_T] | _Skip],
+    limit: int | None,
+    allow_partial: bool = True,
+    cursor: Cursor | None = None,
+  ) -> Iterator[list[_T]]:
+    cursor = cursor or Cursor()
+    item_count = 0
+    while limit is None or item_count < limit:
       try:
-        response = fetch(len(items) + skip_count)
+        response = fetch(cursor.offset)
       except Exception as e:
-        item_count = len(items)
-        if item_count > 0:
+        if item_count > 0 and allow_partial:
           print(f"Loading interrupted due to an error: {e}")
           print(f"Returning {item_count} loaded item(s).")
           break
@@ -144,16 +265,18 @@ class Client:
           raise
 
       if isinstance(response, _Skip):
-        skip_count += response.skip_count
+        cursor.skip_count += response.skip_count
 
-        if skip_count >= SKIP_LIMIT:
-          print(f"🟠 Skip limit ({SKIP_LIMIT}) reached. Returning {len(items)} loaded item(s).")
+        if cursor.skip_count >= SKIP_LIMIT:
+          print(f"🟠 Skip limit ({SKIP_LIMIT}) reached. Returning {item_count} loaded item(s).")
           break
       else:
-        items.extend(response.results)
+        results = response.results if limit is None else response.results[:limit - item_count]
+        item_count += len(results)
+        cursor.item_count += len(results)
+        if results:
+          yield results
 
         has_more = bool(response.links.next)
         if not response.size or not has_more:
           break
-
-    return items
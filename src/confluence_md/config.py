@@ -22,4 +22,20 @@ class Config(BaseSettings):
   dump_dir: str
   """
   An existing path to save pages to.
-  """
\ No newline at end of file
+  """
+
+  concurrency: int = 4
+  """
+  The number of spaces to download and write in parallel.
+  """
+
+  conversion_workers: int | None = None
+  """
+  The number of processes converting the pages to Markdown (shared by all the spaces); the number of CPUs by default.
+  """
+
+  delta_overlap_hours: float = 24.0
+  """
+  In the delta mode, also fetch the pages modified this many hours before the last successful synchronization
+  (CQL interprets dates in the time zone of the user).
+  """
@@ -0,0 +1,48 @@
+from concurrent.futures import Executor
+from typing import NamedTuple
+import signal
+
+import frontmatter
+
+from .html2md import make_html2md
+from .clean_text import clean_text
+
+class ConversionItem(NamedTuple):
+  html: str
+  base_url: str
+  meta: dict[str, object]
+  """
+  Written to the front matter.
+  """
+
+def init_worker():
+  """
+  The initializer of the conversion worker processes.
+  """
+
+  # Ctrl-C is handled by the main process, which lets the batches in progress finish (the conversions included).
+  signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def convert_page(item: ConversionItem) -> bytes:
+  """
+  Convert the page HTML to a Markdown file with YAML front matter.
+
+  Runs in a worker process, so takes and returns plain (picklable) data.
+  """
+
+  # `HTML2Text` keeps state between the calls, so a fresh one per page (it's cheap to make).
+  md = clean_text(make_html2md(item.base_url).handle(item.html))
+  post = frontmatter.Post(md, **item.meta)
+
+  return frontmatter.dumps(post).encode("utf-8")
+
+def convert_pages(executor: Executor, items: list[ConversionItem], worker_count: int) -> list[bytes]:
+  """
+  Convert the pages in parallel with the `executor` (a process pool of `worker_count` workers);
+  the results are in the order of the items.
+  """
+
+  # Several pages per task, to amortize the inter-process communication.
+  chunk_size = max(len(items) // (4 * worker_count), 1)
+
+  return list(executor.map(convert_page, items, chunksize=chunk_size))
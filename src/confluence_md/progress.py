@@ -0,0 +1,96 @@
+from threading import Lock
+
+from .batch_size import BatchSizeController
+from .types import Space
+
+class StageStats:
+  """
+  The throughput of the pipeline stages (fetch, convert, write), aggregated across the workers (thread-safe).
+
+  The throughput is the number of pages over the time spent in the stage, summed across the workers
+  (i.e. per worker).
+  """
+
+  _page_counts: dict[str, int]
+  _durations: dict[str, float]
+  _lock: Lock
+
+  def __init__(self):
+    self._page_counts = {}
+    self._durations = {}
+    self._lock = Lock()
+
+  def add(self, stage: str, page_count: int, duration: float):
+    with self._lock:
+      self._page_counts[stage] = self._page_counts.get(stage, 0) + page_count
+      self._durations[stage] = self._durations.get(stage, 0.0) + duration
+
+  def format_stats(self) -> str:
+    with self._lock:
+      return ", ".join(
+        f"{stage} {self._page_counts[stage] / duration if duration > 0 else 0.0:.1f} pages/s"
+        for stage, duration in self._durations.items()
+      )
+
+class Progress:
+  """
+  The download progress aggregated across the workers (thread-safe).
+  """
+
+  space_count: int
+  expected_page_count: int
+
+  started_space_count: int = 0
+  finished_space_count: int = 0
+  failed_space_count: int = 0
+  loaded_page_count: int = 0
+
+  batch_size_controller: BatchSizeController | None
+  stage_stats: StageStats | None
+
+  _lock: Lock
+
+  def __init__(
+    self,
+    space_count: int,
+    expected_page_count: int,
+    batch_size_controller: BatchSizeController | None = None,
+    stage_stats: StageStats | None = None,
+  ):
+    self.space_count = space_count
+    self.expected_page_count = expected_page_count
+    self.batch_size_controller = batch_size_controller
+    self.stage_stats = stage_stats
+    self._lock = Lock()
+
+  def space_started(self, space: Space, space_page_count: int):
+    with self._lock:
+      self.started_space_count += 1
+      print(f"[{self.started_space_count:>3}/{self.space_count:>3}] Loading {space.key}, {space_page_count} page(s)...")
+
+  def pages_loaded(self, space: Space, page_count: int):
+    with self._lock:
+      self.loaded_page_count += page_count
+      print(f"{space.key}: loaded {page_count} page(s). {self._format_totals()}")
+      if self.batch_size_controller:
+        print(f"Fetching: {self.batch_size_controller.format_state()}")
+      if self.stage_stats:
+        print(f"Throughput: {self.stage_stats.format_stats()}")
+
+  def space_finished(self, space: Space):
+    with self._lock:
+      self.finished_space_count += 1
+      print(f"{space.key}: done. {self._format_totals()}")
+
+  def space_failed(self, space: Space):
+    with self._lock:
+      self.finished_space_count += 1
+      self.failed_space_count += 1
+      print(f"❌ Skipping space {space.key} due to errors. {self._format_totals()}")
+
+  def _format_totals(self) -> str:
+    page_percentage = self.loaded_page_count / self.expected_page_count * 100 if self.expected_page_count else 100.0
+    return (
+      f"Total: {self.finished_space_count}/{self.space_count} space(s) finished ({self.failed_space_count} failed), "
+      f"{self.loaded_page_count}/{self.expected_page_count} page(s) ({page_percentage:.2f}%)"
+    )
@@ -0,0 +1,40 @@
+from datetime import datetime
+import os
+
+from pydantic import BaseModel
+
+class PageState(BaseModel):
+  space: str
+  version: int | None = None
+  when: str | None = None
+
+class SpaceState(BaseModel):
+  synced_at: datetime
+  """
+  The time the last successful synchronization of the space has started at.
+  """
+
+class SyncState(BaseModel):
+  """
+  The versions of the dumped pages and the last successful synchronization time of each space.
+  """
+
+  spaces: dict[str, SpaceState] = {}
+  pages: dict[str, PageState] = {}
+
+  @classmethod
+  def load(cls, path: str) -> "SyncState":
+    if not os.path.exists(path):
+      return cls()
+    with open(path, mode="r", encoding="utf-8") as f:
+      return cls.model_validate_json(f.read())
+
+  def save(self, path: str):
+    # Write to a temporary file first, so an interrupted write never leaves a truncated state behind.
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as f:
+      f.write(self.model_dump_json(indent=1))
+    os.replace(tmp_path, path)
+
+  def get_space_page_ids(self, space_key: str) -> set[str]:
+    return {page_id for page_id, page in self.pages.items() if page.space == space_key}
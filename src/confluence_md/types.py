@@ -42,6 +42,13 @@ class Space(BaseModel):
   Only the URL path.
   """
 
+class Version(BaseModel):
+  number: int
+  when: str | None = None
+  """
+  The ISO 8601 modification timestamp, e.g. "2024-01-31T13:45:00.000+01:00".
+  """
+
 class Content(BaseModel):
   id: str
   type: str
@@ -66,7 +73,7 @@ class Content(BaseModel):
   children: dict[str, "Content"] | None = None
   descendants: dict[str, "Content"] | None = None
   metadata: dict | None = None
-  version: list[Any] | None = None
+  version: Version | None = None
 
 _T = TypeVar("_T")
 
@@ -0,0 +1,352 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Sequence
+import os
+import os.path as p
+import shutil
+
+from llama_index.embeddings import BaseEmbedding, FastEmbedEmbedding
+from llama_index.indices import VectorStoreIndex
+from llama_index.llms import LLM, Ollama
+from llama_index.node_parser import SentenceWindowNodeParser
+from llama_index.prompts import PromptTemplate
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import BaseNode, Document
+from llama_index.service_context import ServiceContext
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.vector_stores.types import BasePydanticVectorStore
+
+import chromadb
+import httpx
+
+from qas.answer_cache import SemanticAnswerCache
+from qas.bm25 import BM25Index, BM25Retriever, index_vector_store
+from qas.cached_rerank import CachedSentenceTransformerRerank
+from qas.context_packer import ContextPacker
+from qas.embedding_cache import CachedEmbedding, EmbeddingCache
+from qas.expand_query_transform import ExpandQueryTransform
+from qas.hybrid_retriever import HybridRetriever
+from qas.ingestion.bm25_indexer import BM25Indexer
+from qas.ingestion.compact_sentence_window import CompactSentenceWindowNodeParser
+from qas.ingestion.manifest import IngestionManifest
+from qas.ingestion.markdown_with_front_matter_reader import SPACE_KEY
+from qas.ingestion.node_dedup import NodeDedup
+from qas.ingestion.sentence_recorder import SentenceRecorder
+from qas.ingestion.sync import get_source_id, sync_index
+from qas.ingestion.text_clean_up import TextCleanUp
+from qas.multi_query_retriever import MultiQueryRetriever
+from qas.mmap_vector_store import MmapVectorStore
+from qas.messages_to_prompt import make_mistral_messages_to_prompt_converter
+from qas.query_engine import QueryEngine, RefinementPolicy
+from qas.sentence_store import SentenceStore
+from qas.sentence_window_expander import SentenceWindowExpander
+from qas.sharded_vector_store import ShardedVectorStore
+from qas.tracing import SlowSpanProfiler, tracer
+from qas.utils import PhaseTimer
+import config
+
+def make_query_engine(
+  settings: config.Settings,
+  startup_timer: PhaseTimer | None = None,
+  llm: LLM | None = None,
+) -> QueryEngine:
+  """
+  Load the models, open (and synchronize, if needed) the vector store and make the query engine.
+
+  The models are loaded in background threads while the vector store is opened. The LLM is warmed up
+  in the background as well, without waiting for it. The durations of the phases are recorded in `startup_timer`.
+
+  - `llm`: the LLM to use instead of Ollama (e.g. a stand-in for benchmarking)
+  """
+
+  configure_tracing(settings)
+
+  timer = startup_timer or PhaseTimer()
+  model_id = "mistral"
+  llm = llm or Ollama(model=model_id, request_timeout=60.0)
+
+  model_loader = ThreadPoolExecutor(max_workers=4, thread_name_prefix="model_loader")
+  embed_model_future = model_loader.submit(timer.measure, "embedding model", load_embed_model, settings)
+  reranker_future = model_loader.submit(
+    timer.measure,
+    "reranker",
+    CachedSentenceTransformerRerank,
+    top_n=10,
+    # Find suitable model list at https://www.sbert.net/docs/pretrained-models/ce-msmarco.html
+    model="cross-encoder/ms-marco-MiniLM-L-12-v2",
+  )
+  tokenizer_future = model_loader.submit(timer.measure, "tokenizer", load_tokenizer, settings)
+  if settings.llm_warm_up and isinstance(llm, Ollama):
+    model_loader.submit(timer.measure, "LLM warm-up", warm_up_llm, llm)
+  # Not waiting for the warm-up.
+  model_loader.shutdown(wait=False)
+
+  with timer.phase("vector store"):
+    bm25_index = BM25Index(p.join(settings.chroma_path, settings.bm25_file_name)) if settings.retrieval == "hybrid" else None
+    sentence_store = SentenceStore(p.join(settings.chroma_path, settings.sentence_store_file_name)) if settings.compact_sentence_windows else None
+    node_dedup = NodeDedup(
+      path=p.join(settings.chroma_path, settings.node_dedup_file_name),
+      near_duplicates=settings.node_dedup_near_duplicates,
+      near_duplicate_threshold=settings.node_dedup_near_duplicate_threshold,
+    )
+
+    vector_store = open_vector_store(settings)
+    manifest = IngestionManifest(p.join(settings.chroma_path, settings.manifest_file_name))
+
+  # The nodes ingested before the index existed (before the synchronization, which only indexes the new nodes),
+  # or before the index kept the shards of the nodes.
+  if bm25_index is not None and count_nodes(vector_store) > 0 and (
+    len(bm25_index) == 0 or (isinstance(vector_store, ShardedVectorStore) and bm25_index.count_unsharded() > 0)
+  ):
+    print("Building the BM25 index of the vector store...")
+    with timer.phase("BM25 index"):
+      bm25_index.clear()
+      index_vector_store(bm25_index, vector_store)
+
+  node_parser = (CompactSentenceWindowNodeParser if settings.compact_sentence_windows else SentenceWindowNodeParser).from_defaults()
+  embed_model = embed_model_future.result()
+  service_ctx = ServiceContext.from_defaults(
+    llm=llm,
+    node_parser=node_parser,
+    embed_model=embed_model,
+    transformations=[
+      log_node_count("Initial node count: {count}", "initial"),
+      node_parser,
+      *([SentenceRecorder(sentence_store)] if sentence_store is not None else []),
+      log_node_count("Node count after applying the node parser: {count}", "node_parser"),
+      TextCleanUp(),
+      log_node_count("Node count after removing tiny nodes: {count}", "text_clean_up"),
+      node_dedup,
+      log_node_count("Node count after deduplication: {count}", "node_dedup"),
+      *([BM25Indexer(bm25_index, vector_store=vector_store)] if bm25_index is not None else []),
+    ],
+  )
+
+  # Attaches the existing store (nothing is ingested).
+  vector_index = VectorStoreIndex.from_vector_store(vector_store, service_context=service_ctx)
+
+  rebuilt_shard_names = [name.strip() for name in (settings.rebuild_shards or "").split(",") if name.strip()]
+  if rebuilt_shard_names and not isinstance(vector_store, ShardedVectorStore):
+    print("🟠 The vector store is not sharded (see `SHARDING`), nothing to rebuild.")
+    rebuilt_shard_names = []
+
+  if settings.sync or rebuilt_shard_names or count_nodes(vector_store) == 0:
+    if len(manifest) == 0 and count_nodes(vector_store) > 0:
+      # The nodes of such a store cannot be matched to their sources.
+      print("🟠 The vector store was populated without an ingestion manifest; remove it to enable synchronization.")
+    else:
+      with timer.phase("synchronization"):
+        if count_nodes(vector_store) == 0:
+          manifest.clear()
+          node_dedup.clear()
+          if bm25_index is not None:
+            bm25_index.clear()
+          if sentence_store is not None:
+            sentence_store.clear()
+
+        documents = config.load_data()
+        print(f"Total document count: {len(documents)}")
+
+        if rebuilt_shard_names:
+          assert isinstance(vector_store, ShardedVectorStore)
+          remove_shards(vector_store, manifest, documents, rebuilt_shard_names)
+
+        sync_index(
+          vector_index,
+          documents,
+          manifest=manifest,
+          transformations=service_ctx.transformations,
+          show_progress=True,
+        )
+
+      if isinstance(embed_model, CachedEmbedding):
+        print(embed_model.format_stats())
+
+  retriever: BaseRetriever = MultiQueryRetriever(vector_store=vector_store, embed_model=embed_model, similarity_top_k=128)
+  if bm25_index is not None:
+    retriever = HybridRetriever(
+      dense_retriever=MultiQueryRetriever(vector_store=vector_store, embed_model=embed_model, similarity_top_k=64),
+      lexical_retriever=BM25Retriever(bm25_index, vector_store=vector_store, similarity_top_k=64),
+      similarity_top_k=settings.hybrid_similarity_top_k,
+    )
+
+  answer_cache = None
+  if settings.answer_cache:
+    answer_cache = SemanticAnswerCache(
+      embed_model=embed_model,
+      similarity_threshold=settings.answer_cache_similarity_threshold,
+      ttl=settings.answer_cache_ttl,
+      max_entries=settings.answer_cache_max_entries,
+      # The entries stored for another version of the index are dropped.
+      index_version=manifest.digest(),
+      path=settings.answer_cache_path,
+    )
+
+  return QueryEngine(
+    query_transform=ExpandQueryTransform(llm=service_ctx.llm),
+    context_entry_template="From document \"{source}\":\n\n{content}",
+    augmented_query_template0=PromptTemplate(
+      "Below are pieces of the context information followed by the text \"End of context.\"\n\n"
+      "{context}\n\n"
+      "End of context.\n\n"
+      "Given the context information and not prior knowledge, answer the following query concise and to the point:\n\n"
+      "{query}\n"
+    ),
+    augmented_query_template1=PromptTemplate(
+      "Below are pieces of the context information followed by the text \"End of context.\"\n\n"
+      "{context}\n\n"
+      "End of context.\n\n"
+
+      # A Tree of Thought-like prompt.
+      "Three experts with different mindsets who rarely agree with each other are reading the context and answering the following request by writing down one step of their independent thinking and sharing it with the group in turns, until they reach a conclusion.\n\n"
+
+      "{query}\n"
+    ),
+    augmented_query_template2=PromptTemplate(
+      "Below are pieces of the context information followed by the text \"End of context.\"\n\n"
+      "{context}\n\n"
+      "End of context.\n\n"
+      "The opinions of other experts to consider critically:\n\n"
+      "{response}\n\n"
+      "Given the context information and not prior knowledge, answer the following query concise and to the point:\n\n"
+      "{query}\n"
+    ),
+    refinement_policy=RefinementPolicy(
+      max_iterations=settings.refinement_iterations,
+      confidence_threshold=settings.refinement_confidence_threshold,
+      novelty_top_k=settings.refinement_novelty_top_k,
+    ),
+    messages_to_prompt=make_mistral_messages_to_prompt_converter(),
+    retriever=retriever,
+    reranker=reranker_future.result(),
+    # Rebuilds the windows of the compact nodes (the nodes ingested with their windows are left as is).
+    node_postprocessors=[SentenceWindowExpander(vector_store=vector_store, sentence_store=sentence_store)],
+    llm=service_ctx.llm, 
+    context_packer=ContextPacker(token_budget=settings.context_token_budget, tokenize=tokenizer_future.result()),
+    answer_cache=answer_cache,
+    shard_names=(lambda: vector_store.shard_names) if isinstance(vector_store, ShardedVectorStore) else None,
+    llm_concurrency_limit=settings.llm_concurrency_limit,
+  )
+
+def configure_tracing(settings: config.Settings):
+  profiler = None
+  if settings.slow_query_profiling_threshold is not None:
+    profiler = SlowSpanProfiler(settings.slow_query_profiling_threshold, settings.slow_query_profile_dir)
+  tracer.configure(
+    jsonl_path=settings.tracing_jsonl_path,
+    prometheus_path=settings.tracing_prometheus_path,
+    profiler=profiler,
+  )
+
+def load_embed_model(settings: config.Settings) -> BaseEmbedding:
+  embed_model: BaseEmbedding = FastEmbedEmbedding(model_name="BAAI/bge-small-en-v1.5", max_length=512)
+  if settings.embedding_cache_path:
+    embed_model = CachedEmbedding(
+      embed_model,
+      cache=EmbeddingCache(settings.embedding_cache_path, max_entries=settings.embedding_cache_max_entries),
+    )
+  return embed_model
+
+def load_tokenizer(settings: config.Settings) -> Callable[[str], Sequence] | None:
+  """
+  The tokenizer of the LLM (see `context_tokenizer`), or `None` to use the llama_index default.
+  """
+
+  if not settings.context_tokenizer:
+    return None
+
+  try:
+    from transformers import AutoTokenizer
+
+    tokenizer = AutoTokenizer.from_pretrained(settings.context_tokenizer)
+  except Exception as e:
+    print(f"🟠 Failed to load the {settings.context_tokenizer} tokenizer, counting the context tokens with tiktoken: {e}")
+    return None
+
+  return lambda text: tokenizer.encode(text, add_special_tokens=False)
+
+def warm_up_llm(llm: Ollama):
+  """
+  Make Ollama load the model weights (a request with an empty prompt), so the first query does not wait for it.
+  """
+
+  try:
+    with httpx.Client(timeout=httpx.Timeout(llm.request_timeout)) as client:
+      client.post(f"{llm.base_url}/api/generate", json={"model": llm.model, "prompt": ""}).raise_for_status()
+  except httpx.HTTPError as e:
+    print(f"🟠 Failed to warm up the LLM: {e}")
+
+def open_vector_store(settings: config.Settings) -> ChromaVectorStore | MmapVectorStore | ShardedVectorStore:
+  if settings.vector_store == "mmap":
+    mmap_path = p.join(settings.chroma_path, settings.mmap_vector_store_dir_name)
+    if settings.sharding == "none":
+      return MmapVectorStore(mmap_path, rescore=settings.mmap_vector_store_rescore)
+
+    # A directory per shard.
+    return ShardedVectorStore(
+      open_shard=lambda name: MmapVectorStore(p.join(mmap_path, name), rescore=settings.mmap_vector_store_rescore),
+      remove_shard=lambda name: shutil.rmtree(p.join(mmap_path, name), ignore_errors=True),
+      shard_names=sorted(os.listdir(mmap_path)) if p.isdir(mmap_path) else [],
+      concurrency=settings.shard_query_concurrency,
+      **get_sharding_kwargs(settings),
+    )
+
+  chroma_client = chromadb.PersistentClient(path=settings.chroma_path)
+  if settings.sharding == "none":
+    chroma_collection = chroma_client.get_or_create_collection(
+      "context", 
+    )
+    return ChromaVectorStore(chroma_collection=chroma_collection)
+
+  # A collection per shard.
+  prefix = "context_"
+  collection_names = [collection.name for collection in chroma_client.list_collections()]
+  return ShardedVectorStore(
+    open_shard=lambda name: ChromaVectorStore(chroma_collection=chroma_client.get_or_create_collection(prefix + name)),
+    remove_shard=lambda name: chroma_client.delete_collection(prefix + name),
+    shard_names=sorted(name[len(prefix):] for name in collection_names if name.startswith(prefix)),
+    concurrency=settings.shard_query_concurrency,
+    **get_sharding_kwargs(settings),
+  )
+
+def get_sharding_kwargs(settings: config.Settings) -> dict[str, Any]:
+  if settings.sharding == "hash":
+    return {"bucket_count": settings.shard_count}
+  return {"shard_key": SPACE_KEY}
+
+def remove_shards(
+  vector_store: ShardedVectorStore,
+  manifest: IngestionManifest,
+  documents: list[Document],
+  shard_names: list[str],
+):
+  """
+  Remove the shards and forget their sources, so the synchronization ingests them again.
+  """
+
+  print(f"Rebuilding the shard(s): {', '.join(shard_names)}")
+  for name in shard_names:
+    vector_store.remove_shard(name)
+  for doc in documents:
+    source_id = get_source_id(doc)
+    if vector_store.get_shard_name(doc.metadata, source_id) in shard_names:
+      manifest.remove(source_id)
+  manifest.save()
+
+def count_nodes(vector_store: BasePydanticVectorStore) -> int:
+  if isinstance(vector_store, (MmapVectorStore, ShardedVectorStore)):
+    return len(vector_store)
+  return vector_store.client.count()
+
+def log_node_count(msg: str = "Node count: {count}", stage: str | None = None) -> Callable[[list[BaseNode]], list[BaseNode]]:
+  """
+  - `stage`: also count the nodes (as "ingestion_nodes", labeled with the stage) with the tracer
+  """
+
+  def _log_node_count(nodes: list[BaseNode], **kwargs: Any) -> list[BaseNode]:
+    del kwargs
+    print(msg.format(count=len(nodes)))
+    if stage is not None:
+      tracer.count("ingestion_nodes", len(nodes), stage=stage)
+    return nodes
+
+  return _log_node_count
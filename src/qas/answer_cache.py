@@ -0,0 +1,180 @@
+from array import array
+from threading import Lock
+import os
+import sqlite3
+import time
+
+from llama_index.embeddings.base import BaseEmbedding
+import numpy as np
+
+from qas.embeddings import embed_queries
+from qas.tracing import tracer
+
+class SemanticAnswerCache:
+  """
+  Answers the queries similar enough to the ones answered before (e.g. "how do I request VPN access"
+  and "VPN access request process") with the stored answers.
+
+  The queries are compared by the cosine similarity of their embeddings. The entries expire after `ttl` seconds;
+  when the number of entries exceeds `max_entries`, the least recently used ones are evicted.
+
+  The entries are only valid for the `index_version` they were stored with (see `IngestionManifest.digest()`):
+  the entries stored for another version are dropped on load, `invalidate()` drops all the entries.
+  """
+
+  similarity_threshold: float
+  ttl: float
+  max_entries: int
+  index_version: str
+
+  hit_count: int
+  miss_count: int
+
+  _embed_model: BaseEmbedding
+  _connection: sqlite3.Connection | None
+  _lock: Lock
+
+  _ids: list[int]
+  _answers: list[str]
+  _created_at: list[float]
+  _used_at: list[float]
+  _embeddings: np.ndarray
+  _next_id: int
+
+  def __init__(
+    self,
+    embed_model: BaseEmbedding,
+    similarity_threshold: float = 0.92,
+    ttl: float = 24 * 60 * 60,
+    max_entries: int = 1024,
+    index_version: str = "",
+    path: str | None = None,
+  ):
+    """
+    - `path`: the SQLite database to persist the entries in; in-memory only when not set
+    """
+
+    self.similarity_threshold = similarity_threshold
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.index_version = index_version
+    self.hit_count = 0
+    self.miss_count = 0
+
+    self._embed_model = embed_model
+    self._lock = Lock()
+    self._ids = []
+    self._answers = []
+    self._created_at = []
+    self._used_at = []
+    self._embeddings = np.zeros((0, 0), dtype=np.float32)
+    self._next_id = 0
+    self._connection = None
+
+    if path:
+      dir_name = os.path.dirname(path)
+      if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+      self._connection = sqlite3.connect(path, check_same_thread=False)
+      self._connection.execute(
+        "CREATE TABLE IF NOT EXISTS answers ("
+        "id INTEGER PRIMARY KEY, index_version TEXT NOT NULL, query TEXT NOT NULL, answer TEXT NOT NULL, "
+        "embedding BLOB NOT NULL, created_at REAL NOT NULL)"
+      )
+      self._connection.execute("DELETE FROM answers WHERE index_version != ? OR created_at < ?", (index_version, time.time() - ttl))
+      self._connection.commit()
+      self._load()
+
+  def __len__(self) -> int:
+    return len(self._ids)
+
+  def lookup(self, query: str) -> str | None:
+    embedding = self._embed(query)
+    now = time.time()
+
+    with self._lock:
+      self._drop_expired(now)
+
+      if self._ids:
+        similarities = self._embeddings @ embedding
+        i = int(np.argmax(similarities))
+        if similarities[i] >= self.similarity_threshold:
+          self._used_at[i] = now
+          self.hit_count += 1
+          tracer.count("answer_cache_hits")
+          return self._answers[i]
+
+      self.miss_count += 1
+      tracer.count("answer_cache_misses")
+      return None
+
+  def store(self, query: str, answer: str):
+    embedding = self._embed(query)
+    now = time.time()
+
+    with self._lock:
+      entry_id = self._next_id
+      self._append(entry_id, answer, embedding, created_at=now)
+
+      if self._connection is not None:
+        self._connection.execute(
+          "INSERT INTO answers (id, index_version, query, answer, embedding, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+          (entry_id, self.index_version, query, answer, array("f", embedding.tolist()).tobytes(), now),
+        )
+        self._connection.commit()
+
+      if len(self._ids) > self.max_entries:
+        self._remove([int(np.argmin(self._used_at))])
+
+  def invalidate(self, index_version: str | None = None):
+    """
+    Drop all the entries, e.g. after the index has been synchronized.
+    """
+
+    with self._lock:
+      if index_version is not None:
+        self.index_version = index_version
+      self._remove(list(range(len(self._ids))))
+
+  def format_stats(self) -> str:
+    return f"Answer cache: {self.hit_count} hit(s), {self.miss_count} miss(es), {len(self._ids)} entries"
+
+  def _embed(self, query: str) -> np.ndarray:
+    embedding = np.array(embed_queries(self._embed_model, [query])[0], dtype=np.float32)
+    return embedding / max(float(np.linalg.norm(embedding)), 1e-12)
+
+  def _load(self):
+    assert self._connection is not None
+    rows = self._connection.execute("SELECT id, answer, embedding, created_at FROM answers ORDER BY id").fetchall()
+    for entry_id, answer, embedding, created_at in rows:
+      self._append(entry_id, answer, np.frombuffer(embedding, dtype=np.float32), created_at=created_at)
+
+  def _append(self, entry_id: int, answer: str, embedding: np.ndarray, created_at: float):
+    self._ids.append(entry_id)
+    self._answers.append(answer)
+    self._created_at.append(created_at)
+    self._used_at.append(created_at)
+    self._embeddings = np.vstack([self._embeddings, embedding[np.newaxis, :]]) if len(self._embeddings) else embedding[np.newaxis, :].copy()
+    self._next_id = max(self._next_id, entry_id + 1)
+
+  def _drop_expired(self, now: float):
+    expired = [i for i, created_at in enumerate(self._created_at) if now - created_at > self.ttl]
+    if expired:
+      self._remove(expired)
+
+  def _remove(self, indices: list[int]):
+    if not indices:
+      return
+
+    removed = set(indices)
+    if self._connection is not None:
+      self._connection.executemany("DELETE FROM answers WHERE id = ?", [(self._ids[i],) for i in removed])
+      self._connection.commit()
+
+    kept = [i for i in range(len(self._ids)) if i not in removed]
+    self._ids = [self._ids[i] for i in kept]
+    self._answers = [self._answers[i] for i in kept]
+    self._created_at = [self._created_at[i] for i in kept]
+    self._used_at = [self._used_at[i] for i in kept]
+    self._embeddings = self._embeddings[kept] if kept else np.zeros((0, 0), dtype=np.float32)
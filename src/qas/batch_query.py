@@ -0,0 +1,150 @@
+from typing import Any, Iterator
+import math
+
+from llama_index.embeddings.base import Embedding
+from llama_index.schema import BaseNode
+from llama_index.vector_stores import ChromaVectorStore
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStore, VectorStoreQuery, VectorStoreQueryResult
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+from qas.ingestion.compact_sentence_window import SENTENCE_INDEX_METADATA_KEY
+
+def query_vector_store(
+  vector_store: VectorStore | BasePydanticVectorStore,
+  embeddings: list[Embedding],
+  similarity_top_k: int,
+) -> list[VectorStoreQueryResult]:
+  """
+  Query the vector store with multiple embeddings at once, in a single round-trip where supported.
+
+  Returns one result per embedding.
+  """
+
+  if not embeddings:
+    return []
+
+  query_batch = getattr(vector_store, "query_batch", None)
+  if query_batch is not None:
+    return query_batch(embeddings, similarity_top_k)
+
+  if isinstance(vector_store, ChromaVectorStore):
+    return _query_chroma(vector_store.client, embeddings, similarity_top_k)
+
+  return [
+    vector_store.query(VectorStoreQuery(query_embedding=embedding, similarity_top_k=similarity_top_k))
+    for embedding in embeddings
+  ]
+
+def _query_chroma(collection: Any, embeddings: list[Embedding], similarity_top_k: int) -> list[VectorStoreQueryResult]:
+  results = collection.query(
+    query_embeddings=embeddings,
+    n_results=similarity_top_k,
+    include=["documents", "metadatas", "distances"],
+  )
+
+  query_results = []
+  for ids, texts, metadatas, distances in zip(
+    results["ids"],
+    results["documents"],
+    results["metadatas"],
+    results["distances"],
+  ):
+    nodes: list[BaseNode] = []
+    for text, metadata in zip(texts, metadatas):
+      node = metadata_dict_to_node(metadata)
+      node.set_content(text)
+      nodes.append(node)
+
+    query_results.append(
+      VectorStoreQueryResult(
+        nodes=nodes,
+        # The same conversion as in `ChromaVectorStore.query()`.
+        similarities=[math.exp(-distance) for distance in distances],
+        ids=ids,
+      )
+    )
+
+  return query_results
+
+def get_nodes(vector_store: VectorStore | BasePydanticVectorStore, node_ids: list[str]) -> list[BaseNode]:
+  """
+  The stored nodes by their IDs (in the order of the IDs, the missing ones are skipped).
+  """
+
+  if not node_ids:
+    return []
+
+  get_nodes_by_id = getattr(vector_store, "get_nodes", None)
+  if get_nodes_by_id is not None:
+    return get_nodes_by_id(node_ids)
+
+  if isinstance(vector_store, ChromaVectorStore):
+    result = vector_store.client.get(ids=node_ids, include=["documents", "metadatas"])
+    nodes_by_id: dict[str, BaseNode] = {}
+    for node_id, text, metadata in zip(result["ids"], result["documents"], result["metadatas"]):
+      node = metadata_dict_to_node(metadata)
+      node.set_content(text)
+      nodes_by_id[node_id] = node
+    return [nodes_by_id[node_id] for node_id in node_ids if node_id in nodes_by_id]
+
+  raise NotImplementedError(f"Getting nodes by ID is not supported by {type(vector_store).__name__}")
+
+def get_sentences(vector_store: VectorStore | BasePydanticVectorStore, ranges: dict[str, list[tuple[int, int]]]) -> dict[str, dict[int, str]]:
+  """
+  The stored sentences (see `CompactSentenceWindowNodeParser`) of the documents within the `[start, end)` ranges,
+  by the document ID and the sentence index.
+  """
+
+  if not ranges:
+    return {}
+
+  get_sentences_in_ranges = getattr(vector_store, "get_sentences", None)
+  if get_sentences_in_ranges is not None:
+    return get_sentences_in_ranges(ranges)
+
+  if isinstance(vector_store, ChromaVectorStore):
+    clauses: list[dict[str, Any]] = [
+      {"$and": [
+        {"document_id": document_id},
+        {SENTENCE_INDEX_METADATA_KEY: {"$gte": start}},
+        {SENTENCE_INDEX_METADATA_KEY: {"$lt": end}},
+      ]}
+      for document_id, document_ranges in ranges.items()
+      for start, end in document_ranges
+    ]
+
+    result = vector_store.client.get(
+      where=clauses[0] if len(clauses) == 1 else {"$or": clauses},
+      include=["documents", "metadatas"],
+    )
+
+    sentences: dict[str, dict[int, str]] = {}
+    for document, metadata in zip(result["documents"] or [], result["metadatas"] or []):
+      sentences.setdefault(str(metadata["document_id"]), {})[int(metadata[SENTENCE_INDEX_METADATA_KEY])] = document
+    return sentences
+
+  raise NotImplementedError(f"Getting sentences is not supported by {type(vector_store).__name__}")
+
+def iter_nodes(vector_store: VectorStore | BasePydanticVectorStore, batch_size: int = 5000) -> Iterator[list[BaseNode]]:
+  """
+  All the stored nodes, in batches.
+  """
+
+  iter_nodes_in_batches = getattr(vector_store, "iter_nodes", None)
+  if iter_nodes_in_batches is not None:
+    yield from iter_nodes_in_batches(batch_size)
+    return
+
+  if isinstance(vector_store, ChromaVectorStore):
+    collection = vector_store.client
+    for offset in range(0, collection.count(), batch_size):
+      result = collection.get(offset=offset, limit=batch_size, include=["documents", "metadatas"])
+      nodes: list[BaseNode] = []
+      for text, metadata in zip(result["documents"], result["metadatas"]):
+        node = metadata_dict_to_node(metadata)
+        node.set_content(text)
+        nodes.append(node)
+      yield nodes
+    return
+
+  raise NotImplementedError(f"Iterating over the nodes is not supported by {type(vector_store).__name__}")
@@ -0,0 +1,270 @@
+from collections import Counter
+from threading import Lock
+from typing import Collection, Iterable
+from typing_extensions import override
+import asyncio
+import math
+import os
+import re
+import sqlite3
+
+from llama_index.callbacks.base import CallbackManager
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import BaseNode, MetadataMode, NodeWithScore, QueryBundle
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStore
+
+from qas.batch_query import get_nodes, iter_nodes
+from qas.sharded_vector_store import ShardedVectorStore, get_selected_shards
+
+# Keeps compound tokens (e.g. ticket keys "PROJ-1234", versions "1.2.3", error codes "0x80070005") together.
+_token = re.compile(r"\w+(?:[-.:/]\w+)*")
+_token_part = re.compile(r"[^\W_]+")
+
+def tokenize(s: str) -> list[str]:
+  """
+  Lowercase word tokens; the compound tokens are followed by their parts.
+  """
+
+  tokens = []
+  for match in _token.finditer(s.lower()):
+    token = match.group()
+    tokens.append(token)
+    if not token.isalnum():
+      parts = _token_part.findall(token)
+      if len(parts) > 1 or (parts and parts[0] != token):
+        tokens.extend(parts)
+  return tokens
+
+class BM25Index:
+  """
+  A persistent (SQLite) inverted index of the nodes, scored with Okapi BM25.
+
+  The postings are clustered by term, so a query only reads the postings of its terms.
+  The terms occurring in more than `max_df_ratio` of the nodes are ignored at query time
+  (they contribute little to the ranking, but have the longest postings).
+  The nodes of a `ShardedVectorStore` are indexed with their shard, so the searches limited to some of the shards
+  take their top-k from these shards only.
+  """
+
+  k1: float
+  b: float
+  max_df_ratio: float
+
+  _connection: sqlite3.Connection
+  _lock: Lock
+  _node_count: int
+  _total_length: int
+
+  def __init__(self, path: str | None = None, k1: float = 1.2, b: float = 0.75, max_df_ratio: float = 0.5):
+    """
+    - `path`: the SQLite database to persist the index in; in-memory only when not set
+    """
+
+    self.k1 = k1
+    self.b = b
+    self.max_df_ratio = max_df_ratio
+
+    if path:
+      dir_name = os.path.dirname(path)
+      if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+    self._lock = Lock()
+    self._connection = sqlite3.connect(path or ":memory:", check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute(
+      "CREATE TABLE IF NOT EXISTS nodes (id INTEGER PRIMARY KEY, node_id TEXT NOT NULL UNIQUE, source_id TEXT NOT NULL, length INTEGER NOT NULL, shard TEXT)"
+    )
+    # The indexes made before the sharding (the shards of their nodes are not known, see `count_unsharded()`).
+    if "shard" not in {row[1] for row in self._connection.execute("PRAGMA table_info(nodes)")}:
+      self._connection.execute("ALTER TABLE nodes ADD COLUMN shard TEXT")
+    self._connection.execute("CREATE INDEX IF NOT EXISTS nodes_source_id ON nodes (source_id)")
+    self._connection.execute(
+      "CREATE TABLE IF NOT EXISTS postings (term TEXT NOT NULL, node INTEGER NOT NULL, tf INTEGER NOT NULL, PRIMARY KEY (term, node)) WITHOUT ROWID"
+    )
+    # The postings of the removed nodes are looked up by node.
+    self._connection.execute("CREATE INDEX IF NOT EXISTS postings_node ON postings (node)")
+    self._connection.execute("CREATE TABLE IF NOT EXISTS terms (term TEXT PRIMARY KEY, df INTEGER NOT NULL) WITHOUT ROWID")
+    self._connection.execute("CREATE TEMP TABLE removed_nodes (id INTEGER PRIMARY KEY)")
+    self._connection.execute("CREATE TEMP TABLE removed_terms (term TEXT PRIMARY KEY, count INTEGER NOT NULL) WITHOUT ROWID")
+    self._connection.commit()
+    self._update_stats()
+
+  def __len__(self) -> int:
+    return self._node_count
+
+  def count_unsharded(self) -> int:
+    """
+    The number of the nodes indexed without a shard.
+    """
+
+    with self._lock:
+      return self._connection.execute("SELECT COUNT(*) FROM nodes WHERE shard IS NULL").fetchone()[0]
+
+  def add(self, nodes: Iterable[tuple[str, str, str, str | None]]):
+    """
+    Index the nodes given as (node ID, source ID, text, shard name); the nodes indexed before are replaced.
+    """
+
+    # The last one of the repeated nodes wins.
+    nodes_by_id = {node_id: (source_id, text, shard) for node_id, source_id, text, shard in nodes}
+
+    with self._lock:
+      self._remove_nodes("node_id", nodes_by_id)
+
+      for node_id, (source_id, text, shard) in nodes_by_id.items():
+        term_counts = Counter(tokenize(text))
+        cursor = self._connection.execute(
+          "INSERT INTO nodes (node_id, source_id, length, shard) VALUES (?, ?, ?, ?)",
+          (node_id, source_id, sum(term_counts.values()), shard),
+        )
+        node = cursor.lastrowid
+        self._connection.executemany(
+          "INSERT INTO postings (term, node, tf) VALUES (?, ?, ?)",
+          [(term, node, tf) for term, tf in term_counts.items()],
+        )
+        self._connection.executemany(
+          "INSERT INTO terms (term, df) VALUES (?, 1) ON CONFLICT (term) DO UPDATE SET df = df + 1",
+          [(term,) for term in term_counts],
+        )
+
+      self._connection.commit()
+      self._update_stats()
+
+  def remove_sources(self, source_ids: Iterable[str]):
+    with self._lock:
+      self._remove_nodes("source_id", source_ids)
+      self._connection.commit()
+      self._update_stats()
+
+  def clear(self):
+    with self._lock:
+      self._connection.execute("DELETE FROM postings")
+      self._connection.execute("DELETE FROM terms")
+      self._connection.execute("DELETE FROM nodes")
+      self._connection.commit()
+      self._update_stats()
+
+  def search(self, query: str, top_k: int, shards: Collection[str] | None = None) -> list[tuple[str, float]]:
+    """
+    The IDs of the best matching nodes (of the shards, when given) with their scores, best first.
+    """
+
+    shard_filter = f" AND n.shard IN ({','.join('?' * len(shards))})" if shards is not None else ""
+    shard_params = list(shards) if shards is not None else []
+
+    with self._lock:
+      if not self._node_count or (shards is not None and not shards):
+        return []
+
+      average_length = self._total_length / self._node_count
+      scores: dict[int, float] = {}
+
+      for term, query_tf in Counter(tokenize(query)).items():
+        row = self._connection.execute("SELECT df FROM terms WHERE term = ?", (term,)).fetchone()
+        if row is None or row[0] > self.max_df_ratio * self._node_count:
+          continue
+
+        df = row[0]
+        idf = math.log(1 + (self._node_count - df + 0.5) / (df + 0.5))
+        postings = self._connection.execute(
+          f"SELECT p.node, p.tf, n.length FROM postings p JOIN nodes n ON n.id = p.node WHERE p.term = ?{shard_filter}",
+          [term, *shard_params],
+        )
+        for node, tf, length in postings:
+          norm = self.k1 * (1 - self.b + self.b * length / average_length)
+          scores[node] = scores.get(node, 0.0) + query_tf * idf * tf * (self.k1 + 1) / (tf + norm)
+
+      best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:top_k]
+      if not best:
+        return []
+
+      node_ids = dict(self._connection.execute(
+        f"SELECT id, node_id FROM nodes WHERE id IN ({','.join('?' * len(best))})",
+        [node for node, _ in best],
+      ).fetchall())
+      return [(node_ids[node], score) for node, score in best]
+
+  def _remove_nodes(self, column: str, values: Iterable[str]):
+    """
+    Remove the nodes with any of the values of the (indexed) column, all at once.
+    """
+
+    self._connection.execute("DELETE FROM removed_nodes")
+    self._connection.executemany(
+      f"INSERT OR IGNORE INTO removed_nodes (id) SELECT id FROM nodes WHERE {column} = ?",
+      [(value,) for value in values],
+    )
+    if not self._connection.execute("SELECT EXISTS (SELECT 1 FROM removed_nodes)").fetchone()[0]:
+      return
+
+    self._connection.execute("DELETE FROM removed_terms")
+    self._connection.execute(
+      "INSERT INTO removed_terms (term, count) SELECT term, COUNT(*) FROM postings WHERE node IN (SELECT id FROM removed_nodes) GROUP BY term"
+    )
+    self._connection.execute(
+      "UPDATE terms SET df = df - (SELECT count FROM removed_terms r WHERE r.term = terms.term) WHERE term IN (SELECT term FROM removed_terms)"
+    )
+    self._connection.execute("DELETE FROM terms WHERE term IN (SELECT term FROM removed_terms) AND df <= 0")
+    self._connection.execute("DELETE FROM postings WHERE node IN (SELECT id FROM removed_nodes)")
+    self._connection.execute("DELETE FROM nodes WHERE id IN (SELECT id FROM removed_nodes)")
+
+  def _update_stats(self):
+    self._node_count, self._total_length = self._connection.execute("SELECT COUNT(*), COALESCE(SUM(length), 0) FROM nodes").fetchone()
+
+class BM25Retriever(BaseRetriever):
+  """
+  Retrieves the nodes lexically matching the query string (see `BM25Index`), loading them from the vector store.
+
+  Complements the dense retrieval with the exact token matches (e.g. ticket keys, error codes).
+  """
+
+  _index: BM25Index
+  _vector_store: VectorStore | BasePydanticVectorStore
+  _similarity_top_k: int
+
+  def __init__(
+    self,
+    index: BM25Index,
+    vector_store: VectorStore | BasePydanticVectorStore,
+    similarity_top_k: int = 64,
+    callback_manager: CallbackManager | None = None,
+  ):
+    self._index = index
+    self._vector_store = vector_store
+    self._similarity_top_k = similarity_top_k
+    super().__init__(callback_manager=callback_manager)
+
+  @override
+  def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+    return self.retrieve_str(query_bundle.query_str)
+
+  @override
+  async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+    return await asyncio.to_thread(self.retrieve_str, query_bundle.query_str)
+
+  def retrieve_str(self, query_str: str) -> list[NodeWithScore]:
+    # The nodes of the shards not searched would be missing from the vector store (see `select_shards()`).
+    shards = get_selected_shards() if isinstance(self._vector_store, ShardedVectorStore) else None
+    matches = self._index.search(query_str, self._similarity_top_k, shards=shards)
+    scores = dict(matches)
+    nodes = get_nodes(self._vector_store, [node_id for node_id, _ in matches])
+    return [NodeWithScore(node=node, score=scores[node.node_id]) for node in nodes]
+
+def index_vector_store(index: BM25Index, vector_store: VectorStore | BasePydanticVectorStore, batch_size: int = 5000):
+  """
+  Add the nodes stored in the vector store to the index (e.g. ingested before the index existed).
+  """
+
+  for nodes in iter_nodes(vector_store, batch_size):
+    index.add(
+      (node.node_id, node.ref_doc_id or "None", node.get_content(metadata_mode=MetadataMode.EMBED), get_shard_name(vector_store, node))
+      for node in nodes
+    )
+
+def get_shard_name(vector_store: VectorStore | BasePydanticVectorStore | None, node: BaseNode) -> str | None:
+  """
+  The shard of the node in the vector store, when sharded.
+  """
+
+  return vector_store.get_shard_name(node.metadata, node.ref_doc_id) if isinstance(vector_store, ShardedVectorStore) else None
@@ -0,0 +1,125 @@
+from collections import OrderedDict
+from hashlib import sha256
+from threading import Lock
+from typing_extensions import override
+
+from llama_index.bridge.pydantic import Field, PrivateAttr
+from llama_index.callbacks import CBEventType, EventPayload
+from llama_index.postprocessor import SentenceTransformerRerank
+from llama_index.schema import MetadataMode, NodeWithScore, QueryBundle
+
+from qas.tracing import tracer
+
+class CachedSentenceTransformerRerank(SentenceTransformerRerank):
+  """
+  A `SentenceTransformerRerank` that keeps the cross-encoder scores of (query text, node content hash) pairs
+  in a bounded LRU cache, shared between the rerank passes of a query and across queries.
+
+  Only the uncached pairs are sent to the cross-encoder (in one batch).
+  """
+
+  cache_size: int = Field(default=65_536, description="The max. number of cached scores.")
+  verbose: bool = Field(default=False, description="Print the number of scored and skipped pairs on each call.")
+
+  _cache: OrderedDict[tuple[str, bytes], float] = PrivateAttr()
+  _lock: Lock = PrivateAttr()
+  _scored_pair_count: int = PrivateAttr(default=0)
+  _skipped_pair_count: int = PrivateAttr(default=0)
+
+  def __init__(
+    self,
+    top_n: int = 2,
+    model: str = "cross-encoder/stsb-distilroberta-base",
+    device: str | None = None,
+    keep_retrieval_score: bool = False,
+    cache_size: int = 65_536,
+    verbose: bool = False,
+  ):
+    super().__init__(top_n=top_n, model=model, device=device, keep_retrieval_score=keep_retrieval_score)
+    self.cache_size = cache_size
+    self.verbose = verbose
+    self._cache = OrderedDict()
+    self._lock = Lock()
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "CachedSentenceTransformerRerank"
+
+  @property
+  def scored_pair_count(self) -> int:
+    return self._scored_pair_count
+
+  @property
+  def skipped_pair_count(self) -> int:
+    return self._skipped_pair_count
+
+  def format_stats(self) -> str:
+    return f"Reranking: {self._scored_pair_count} pair(s) scored, {self._skipped_pair_count} skipped (cached)"
+
+  @override
+  def _postprocess_nodes(
+    self,
+    nodes: list[NodeWithScore],
+    query_bundle: QueryBundle | None = None,
+  ) -> list[NodeWithScore]:
+    if query_bundle is None:
+      raise ValueError("Missing query bundle in extra info.")
+    if len(nodes) == 0:
+      return []
+
+    query = query_bundle.query_str
+    contents = [node.node.get_content(metadata_mode=MetadataMode.EMBED) for node in nodes]
+    keys = [(query, sha256(content.encode()).digest()) for content in contents]
+
+    with self.callback_manager.event(
+      CBEventType.RERANKING,
+      payload={
+        EventPayload.NODES: nodes,
+        EventPayload.MODEL_NAME: self.model,
+        EventPayload.QUERY_STR: query,
+        EventPayload.TOP_K: self.top_n,
+      },
+    ) as event:
+      scores = self._get_cached_scores(keys)
+
+      # Identical contents (e.g. the same sentence in different documents) are only scored once.
+      missing = {key: content for key, content in zip(keys, contents) if key not in scores}
+      if missing:
+        predicted = self._model.predict([(query, content) for content in missing.values()])
+        computed = {key: float(score) for key, score in zip(missing.keys(), predicted)}
+        self._put_scores(computed)
+        scores.update(computed)
+
+      self._scored_pair_count += len(missing)
+      self._skipped_pair_count += len(nodes) - len(missing)
+      tracer.count("rerank_pairs_scored", len(missing))
+      tracer.count("rerank_cache_hits", len(nodes) - len(missing))
+      if self.verbose:
+        print(self.format_stats())
+
+      for node, key in zip(nodes, keys):
+        if self.keep_retrieval_score:
+          node.node.metadata["retrieval_score"] = node.score
+        node.score = scores[key]
+
+      new_nodes = sorted(nodes, key=lambda x: -x.score if x.score else 0)[:self.top_n]
+      event.on_end(payload={EventPayload.NODES: new_nodes})
+
+    return new_nodes
+
+  def _get_cached_scores(self, keys: list[tuple[str, bytes]]) -> dict[tuple[str, bytes], float]:
+    scores = {}
+    with self._lock:
+      for key in keys:
+        score = self._cache.get(key)
+        if score is not None:
+          self._cache.move_to_end(key)
+          scores[key] = score
+    return scores
+
+  def _put_scores(self, scores: dict[tuple[str, bytes], float]):
+    with self._lock:
+      self._cache.update(scores)
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
@@ -0,0 +1,300 @@
+from threading import Lock
+from typing import Callable, NamedTuple, Sequence
+
+from llama_index.schema import BaseNode, NodeWithScore
+import llama_index.node_parser.text.sentence_window as sentence_window
+
+from qas.ingestion.compact_sentence_window import SENTENCE_INDEX_METADATA_KEY
+
+class PackedContext(NamedTuple):
+  entries: list[str]
+  """
+  The formatted context entries, the most relevant last.
+  """
+
+  token_count: int
+  """
+  The number of tokens of the joined entries.
+  """
+
+  unpacked_token_count: int
+  """
+  The number of tokens of the entries of all the nodes, as they would be joined without packing.
+  """
+
+  @property
+  def saved_token_count(self) -> int:
+    return self.unpacked_token_count - self.token_count
+
+class _Window(NamedTuple):
+  rank: int
+  node: BaseNode
+  content: str
+
+class _Span:
+  """
+  The merged windows of the nodes of a source.
+  """
+
+  source_id: str
+  node: BaseNode
+  content: str
+  rank: int
+  start: int | None
+  end: int | None
+  windows: list[_Window]
+  """
+  The unmerged windows, the most relevant first.
+  """
+
+  def __init__(self, source_id: str, node: BaseNode, content: str, rank: int, start: int | None, end: int | None):
+    self.source_id = source_id
+    self.node = node
+    self.content = content
+    self.rank = rank
+    self.start = start
+    self.end = end
+    self.windows = [_Window(rank, node, content)]
+
+class ContextPacker:
+  """
+  Packs the windows of the reranked nodes into the context entries of a prompt:
+
+  - the overlapping or adjacent windows of the same source are merged into one entry (the nearby sentences
+    of a document have nearly identical windows)
+  - the exact repeats (e.g. a template paragraph found in several documents) are dropped
+  - the entries are added, most relevant first, while they fit in `token_budget` (measured with `tokenize`);
+    the unmerged windows of a merged entry that does not fit are tried one by one instead, and the most relevant
+    window is truncated around the sentence of its node if it does not fit on its own
+
+  The entries keep the order of the nodes: the most relevant last.
+  """
+
+  token_budget: int | None
+  tokenize: Callable[[str], Sequence]
+  window_size: int
+  min_overlap: int
+  separator: str
+
+  _lock: Lock
+  _packed_count: int
+  _token_count: int
+  _unpacked_token_count: int
+
+  def __init__(
+    self,
+    token_budget: int | None = None,
+    tokenize: Callable[[str], Sequence] | None = None,
+    window_size: int = sentence_window.DEFAULT_WINDOW_SIZE,
+    min_overlap: int = 16,
+    separator: str = "\n\n",
+  ):
+    """
+    - `token_budget`: the max. number of tokens of the joined entries; not limited when not set
+    - `tokenize`: the tokenizer of the LLM; the llama_index default (tiktoken) when not set
+    - `window_size`: the window size of the compact nodes (see `SentenceWindowExpander`), to tell the adjacent windows
+    - `min_overlap`: the min. number of characters the end of a window and the start of another one must share to be merged
+    """
+
+    if tokenize is None:
+      from llama_index.utils import get_tokenizer
+
+      tokenize = get_tokenizer()
+
+    self.token_budget = token_budget
+    self.tokenize = tokenize
+    self.window_size = window_size
+    self.min_overlap = min_overlap
+    self.separator = separator
+
+    self._lock = Lock()
+    self._packed_count = 0
+    self._token_count = 0
+    self._unpacked_token_count = 0
+
+  def format_stats(self) -> str:
+    saved_ratio = 1 - self._token_count / self._unpacked_token_count if self._unpacked_token_count else 0.0
+    return (
+      f"Context packing: {self._packed_count} context(s), {self._token_count} token(s), "
+      f"{self._unpacked_token_count - self._token_count} saved ({saved_ratio * 100:.1f}%)"
+    )
+
+  def pack(self, nodes: list[NodeWithScore], format_entry: Callable[[BaseNode, str], str]) -> PackedContext:
+    """
+    - `nodes`: the nodes, the most relevant first
+    - `format_entry`: makes the entry of a node (the first node of a merged span) with the given content
+    """
+
+    separator_token_count = len(self.tokenize(self.separator))
+
+    unpacked_token_count = 0
+    for node_with_score in nodes:
+      unpacked_token_count += len(self.tokenize(format_entry(node_with_score.node, get_window(node_with_score.node))))
+    unpacked_token_count += separator_token_count * max(len(nodes) - 1, 0)
+
+    packed: list[str] = []
+    packed_contents: set[str] = set()
+    token_count = 0
+
+    def add(node: BaseNode, content: str) -> bool:
+      nonlocal token_count
+
+      if content in packed_contents:
+        return True
+
+      entry = format_entry(node, content)
+      entry_token_count = len(self.tokenize(entry)) + (separator_token_count if packed else 0)
+      if self.token_budget is not None and token_count + entry_token_count > self.token_budget:
+        return False
+
+      packed.append(entry)
+      packed_contents.add(content)
+      token_count += entry_token_count
+      return True
+
+    for span in self._merge_spans(nodes):
+      if add(span.node, span.content):
+        continue
+
+      # The windows of a merged span that does not fit may fit on their own.
+      for window in span.windows if len(span.windows) > 1 else []:
+        if not add(window.node, window.content) and not packed:
+          break
+
+      if not packed:
+        # The most relevant window does not fit on its own.
+        window = span.windows[0]
+        entry = self._truncate(window.node, window.content, format_entry)
+        packed.append(entry)
+        packed_contents.add(window.content)
+        token_count += len(self.tokenize(entry))
+
+    with self._lock:
+      self._packed_count += 1
+      self._token_count += token_count
+      self._unpacked_token_count += unpacked_token_count
+
+    return PackedContext(entries=packed[::-1], token_count=token_count, unpacked_token_count=unpacked_token_count)
+
+  def _merge_spans(self, nodes: list[NodeWithScore]) -> list[_Span]:
+    """
+    The merged spans of the nodes without the repeats, the most relevant first.
+    """
+
+    spans_by_source: dict[str, list[_Span]] = {}
+    for rank, node_with_score in enumerate(nodes):
+      node = node_with_score.node
+      source_id = node.ref_doc_id or node.node_id
+      sentence_index = node.metadata.get(SENTENCE_INDEX_METADATA_KEY)
+      span = _Span(
+        source_id,
+        node,
+        get_window(node),
+        rank,
+        sentence_index - self.window_size if sentence_index is not None else None,
+        sentence_index + self.window_size if sentence_index is not None else None,
+      )
+
+      # A merged span may now overlap with another one.
+      source_spans = spans_by_source.setdefault(source_id, [])
+      merged = True
+      while merged:
+        merged = False
+        for other in source_spans:
+          if self._merge(other, span):
+            source_spans.remove(other)
+            merged = True
+            break
+      source_spans.append(span)
+
+    spans = sorted((span for source_spans in spans_by_source.values() for span in source_spans), key=lambda span: span.rank)
+
+    contents: set[str] = set()
+    unique_spans = []
+    for span in spans:
+      if span.content not in contents:
+        contents.add(span.content)
+        unique_spans.append(span)
+    return unique_spans
+
+  def _merge(self, other: _Span, span: _Span) -> bool:
+    """
+    Merge `other` into `span` (of the same source) if their windows overlap or are adjacent.
+    """
+
+    content: str | None
+    start = end = None
+    if span.start is not None and span.end is not None and other.start is not None and other.end is not None:
+      if other.start <= span.start:
+        first, second, first_end, second_start = other, span, other.end, span.start
+      else:
+        first, second, first_end, second_start = span, other, span.end, other.start
+      if second_start > first_end:
+        return False
+      # Adjacent, or only overlapping in the sentences missing from the windows (e.g. dropped as tiny).
+      content = merge_windows(first.content, second.content, self.min_overlap) or f"{first.content} {second.content}"
+      start, end = min(span.start, other.start), max(span.end, other.end)
+    else:
+      content = merge_windows(other.content, span.content, self.min_overlap) or merge_windows(span.content, other.content, self.min_overlap)
+      if content is None:
+        return False
+
+    if other.rank < span.rank:
+      span.node = other.node
+      span.rank = other.rank
+    span.content = content
+    span.start = start
+    span.end = end
+    span.windows = sorted(span.windows + other.windows, key=lambda window: window.rank)
+    return True
+
+  def _truncate(self, node: BaseNode, content: str, format_entry: Callable[[BaseNode, str], str]) -> str:
+    """
+    The entry of the node with the window cut down to the budget around the sentence of the node
+    (the start of the window is kept when the sentence is not found in it).
+    """
+
+    assert self.token_budget is not None
+
+    sentence = node.get_content()
+    sentence_start = content.find(sentence) if sentence else -1
+    center = sentence_start + len(sentence) // 2 if sentence_start != -1 else 0
+
+    start, end = 0, len(content)
+    entry = format_entry(node, content)
+    while start < end:
+      token_count = len(self.tokenize(entry))
+      if token_count <= self.token_budget:
+        break
+      length = int((end - start) * self.token_budget / token_count * 0.95)
+      start = max(min(center - length // 2, len(content) - length), 0)
+      end = start + length
+      entry = format_entry(node, content[start:end])
+    return entry
+
+def get_window(node: BaseNode) -> str:
+  """
+  The sentence window of the node (see `SentenceWindowExpander`), or its content.
+  """
+
+  return node.metadata.get(sentence_window.DEFAULT_WINDOW_METADATA_KEY) or node.get_content()
+
+def merge_windows(first: str, second: str, min_overlap: int = 16) -> str | None:
+  """
+  The two windows merged, when one contains the other or the end of `first` is the start of `second`
+  (of at least `min_overlap` characters); `None` otherwise.
+  """
+
+  if second in first:
+    return first
+  if first in second:
+    return second
+
+  # The longest overlap starts at the first position the whole rest of `first` matches.
+  probe = second[:min_overlap]
+  position = first.find(probe, max(len(first) - len(second), 0))
+  while position != -1:
+    if second.startswith(first[position:]):
+      return first + second[len(first) - position:]
+    position = first.find(probe, position + 1)
+  return None
@@ -0,0 +1,220 @@
+from array import array
+from hashlib import sha256
+from threading import Lock
+from typing import Any, Callable, Iterable, Literal
+from typing_extensions import override
+import os
+import sqlite3
+import time
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+
+from qas.embeddings import embed_queries
+from qas.tracing import tracer
+
+EmbeddingKind = Literal["query", "text"]
+
+class EmbeddingCache:
+  """
+  A persistent (SQLite) content-addressed embedding store.
+
+  When the number of entries exceeds `max_entries`, the least recently used entries
+  are evicted (down to `max_entries * (1 - eviction_ratio)` entries at once).
+  """
+
+  max_entries: int
+  eviction_ratio: float
+
+  _connection: sqlite3.Connection
+  _lock: Lock
+  _entry_count: int
+
+  def __init__(self, path: str, max_entries: int = 500_000, eviction_ratio: float = 0.1):
+    dir_name = os.path.dirname(path)
+    if dir_name:
+      os.makedirs(dir_name, exist_ok=True)
+
+    self.max_entries = max_entries
+    self.eviction_ratio = eviction_ratio
+
+    self._lock = Lock()
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute(
+      "CREATE TABLE IF NOT EXISTS embeddings (key BLOB PRIMARY KEY, vector BLOB NOT NULL, used_at REAL NOT NULL)"
+    )
+    self._connection.execute("CREATE INDEX IF NOT EXISTS embeddings_used_at ON embeddings (used_at)")
+    self._connection.commit()
+    self._entry_count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+  def __len__(self) -> int:
+    return self._entry_count
+
+  def get_many(self, keys: list[bytes]) -> dict[bytes, Embedding]:
+    found: dict[bytes, Embedding] = {}
+    with self._lock:
+      for key, vector in self._select("key, vector", keys):
+        found[key] = array("f", vector).tolist()
+
+      if found:
+        now = time.time()
+        self._connection.executemany(
+          "UPDATE embeddings SET used_at = ? WHERE key = ?",
+          [(now, key) for key in found],
+        )
+        self._connection.commit()
+    return found
+
+  def put_many(self, items: Iterable[tuple[bytes, Embedding]]):
+    now = time.time()
+    vectors = {key: array("f", vector).tobytes() for key, vector in items}
+    with self._lock:
+      # Only the new keys add entries (e.g. another thread may have stored the same texts meanwhile).
+      existing_count = sum(1 for _ in self._select("key", list(vectors)))
+      self._connection.executemany(
+        "INSERT INTO embeddings (key, vector, used_at) VALUES (?, ?, ?) "
+        "ON CONFLICT (key) DO UPDATE SET vector = excluded.vector, used_at = excluded.used_at",
+        [(key, vector, now) for key, vector in vectors.items()],
+      )
+      self._entry_count += len(vectors) - existing_count
+
+      if self._entry_count > self.max_entries:
+        self._evict()
+
+      self._connection.commit()
+
+  def _select(self, columns: str, keys: list[bytes]) -> Iterable[tuple]:
+    """
+    The rows of the entries with the keys (the missing ones are skipped).
+    """
+
+    # Stay well below the SQLite host parameter limit.
+    for i in range(0, len(keys), 500):
+      chunk = keys[i:i + 500]
+      yield from self._connection.execute(
+        f"SELECT {columns} FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+        chunk,
+      ).fetchall()
+
+  def _evict(self):
+    target_count = int(self.max_entries * (1 - self.eviction_ratio))
+    self._connection.execute(
+      "DELETE FROM embeddings WHERE key IN (SELECT key FROM embeddings ORDER BY used_at LIMIT ?)",
+      (self._entry_count - target_count,),
+    )
+    self._entry_count = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+class CachedEmbedding(BaseEmbedding):
+  """
+  Wraps an embedding model to skip the inference for the texts embedded before.
+
+  The cache is keyed by the model name, the max. input length (when the model has such a setting)
+  and the text hash.
+  """
+
+  _hit_count: int = PrivateAttr(default=0)
+  _miss_count: int = PrivateAttr(default=0)
+  _embed_model: BaseEmbedding = PrivateAttr()
+  _cache: EmbeddingCache = PrivateAttr()
+  _key_prefix: str = PrivateAttr()
+
+  def __init__(self, embed_model: BaseEmbedding, cache: EmbeddingCache, **kwargs: Any):
+    super().__init__(
+      model_name=embed_model.model_name,
+      embed_batch_size=embed_model.embed_batch_size,
+      callback_manager=embed_model.callback_manager,
+      **kwargs,
+    )
+    self._embed_model = embed_model
+    self._cache = cache
+    self._key_prefix = f"{embed_model.class_name()}\0{embed_model.model_name}\0{getattr(embed_model, 'max_length', None)}\0"
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "CachedEmbedding"
+
+  @property
+  def embed_model(self) -> BaseEmbedding:
+    return self._embed_model
+
+  @property
+  def hit_count(self) -> int:
+    return self._hit_count
+
+  @property
+  def miss_count(self) -> int:
+    return self._miss_count
+
+  def format_stats(self) -> str:
+    total_count = self._hit_count + self._miss_count
+    hit_rate = self._hit_count / total_count * 100 if total_count else 0.0
+    return f"Embedding cache: {self._hit_count} hit(s), {self._miss_count} miss(es) ({hit_rate:.1f}% hit rate), {len(self._cache)} entries"
+
+  def get_query_embeddings(self, queries: list[str]) -> list[Embedding]:
+    return self._get_embeddings("query", queries, lambda queries: embed_queries(self._embed_model, queries))
+
+  @override
+  def _get_query_embedding(self, query: str) -> Embedding:
+    return self._get_embeddings("query", [query], lambda queries: [self._embed_model._get_query_embedding(q) for q in queries])[0]
+
+  @override
+  async def _aget_query_embedding(self, query: str) -> Embedding:
+    key = self._get_key("query", query)
+    cached = self._lookup([key])
+    if key in cached:
+      return cached[key]
+    embedding = await self._embed_model._aget_query_embedding(query)
+    self._store([(key, embedding)])
+    return embedding
+
+  @override
+  def _get_text_embedding(self, text: str) -> Embedding:
+    return self._get_text_embeddings([text])[0]
+
+  @override
+  async def _aget_text_embedding(self, text: str) -> Embedding:
+    return (await self._aget_text_embeddings([text]))[0]
+
+  @override
+  def _get_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+    return self._get_embeddings("text", texts, self._embed_model._get_text_embeddings)
+
+  @override
+  async def _aget_text_embeddings(self, texts: list[str]) -> list[Embedding]:
+    keys = [self._get_key("text", text) for text in texts]
+    cached = self._lookup(keys)
+    missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+    if missing:
+      embeddings = await self._embed_model._aget_text_embeddings(list(missing.values()))
+      computed = dict(zip(missing.keys(), embeddings))
+      self._store(computed.items())
+      cached.update(computed)
+    return [cached[key] for key in keys]
+
+  def _get_embeddings(self, kind: EmbeddingKind, texts: list[str], embed: Callable[[list[str]], list[Embedding]]) -> list[Embedding]:
+    keys = [self._get_key(kind, text) for text in texts]
+    cached = self._lookup(keys)
+    # Repeated texts within the batch are only embedded once.
+    missing = {key: text for key, text in zip(keys, texts) if key not in cached}
+    if missing:
+      computed = dict(zip(missing.keys(), embed(list(missing.values()))))
+      self._store(computed.items())
+      cached.update(computed)
+    return [cached[key] for key in keys]
+
+  def _get_key(self, kind: EmbeddingKind, text: str) -> bytes:
+    return sha256(f"{self._key_prefix}{kind}\0{text}".encode()).digest()
+
+  def _lookup(self, keys: list[bytes]) -> dict[bytes, Embedding]:
+    cached = self._cache.get_many(list(set(keys)))
+    hit_count = sum(1 for key in keys if key in cached)
+    self._hit_count += hit_count
+    self._miss_count += len(keys) - hit_count
+    tracer.count("embedding_cache_hits", hit_count)
+    tracer.count("embedding_cache_misses", len(keys) - hit_count)
+    return cached
+
+  def _store(self, items: Iterable[tuple[bytes, Embedding]]):
+    self._cache.put_many(items)
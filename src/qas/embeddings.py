@@ -0,0 +1,20 @@
+from llama_index.embeddings import FastEmbedEmbedding
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+
+def embed_queries(embed_model: BaseEmbedding, queries: list[str]) -> list[Embedding]:
+  """
+  Embed the queries in a single batch, when the model allows that.
+  """
+
+  if not queries:
+    return []
+
+  get_query_embeddings = getattr(embed_model, "get_query_embeddings", None)
+  if get_query_embeddings is not None:
+    return get_query_embeddings(queries)
+
+  if isinstance(embed_model, FastEmbedEmbedding):
+    # `FlagEmbedding.query_embed()` only takes a single query; this is its batched equivalent.
+    return [embedding.tolist() for embedding in embed_model._model.embed([f"query: {q}" for q in queries])]
+
+  return [embed_model.get_query_embedding(q) for q in queries]
@@ -8,6 +8,8 @@ from llama_index.llms.base import BaseLLM
 from llama_index.prompts import BasePromptTemplate, PromptTemplate
 from llama_index.schema import QueryBundle
 
+from qas.tracing import count_llm_tokens
+
 EXPAND_QUERY_TEMPLATE = PromptTemplate(
   "A search engine optimization expert is rephrasing the following request "
   "by writing down a few similar questions or requests in a numbered list:\n\n"
@@ -46,7 +48,9 @@ class ExpandQueryTransform(BaseQueryTransform):
   def _run(self, query_bundle: QueryBundle, metadata: dict) -> QueryBundle:
     del metadata
     prompt = self._prompt_template.format(query=query_bundle.query_str)
-    response = str(self._llm.complete(prompt)).strip()
+    completion = self._llm.complete(prompt)
+    count_llm_tokens(prompt, completion, stage="query_expansion")
+    response = str(completion).strip()
     alt_queries = self._split_response(response)
     return QueryBundle(
       query_str=query_bundle.query_str,
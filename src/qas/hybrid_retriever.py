@@ -0,0 +1,76 @@
+from typing_extensions import override
+import asyncio
+
+from llama_index.callbacks.base import CallbackManager
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+
+from qas.bm25 import BM25Retriever
+from qas.multi_query_retriever import MultiQueryRetriever, RetrievalContext, dedup_query_strs
+
+class HybridRetriever(BaseRetriever):
+  """
+  Fuses the dense (`MultiQueryRetriever`) and the lexical (`BM25Retriever`, one search per query embedding string)
+  rankings with reciprocal rank fusion and keeps the `similarity_top_k` best nodes.
+
+  The nodes found by both retrievers rank higher, so a smaller candidate set can be passed on (e.g. to a reranker)
+  than with the dense retrieval alone.
+  """
+
+  _dense_retriever: MultiQueryRetriever
+  _lexical_retriever: BM25Retriever
+  _similarity_top_k: int
+  _rrf_k: int
+
+  def __init__(
+    self,
+    dense_retriever: MultiQueryRetriever,
+    lexical_retriever: BM25Retriever,
+    similarity_top_k: int = 32,
+    rrf_k: int = 60,
+    callback_manager: CallbackManager | None = None,
+  ):
+    self._dense_retriever = dense_retriever
+    self._lexical_retriever = lexical_retriever
+    self._similarity_top_k = similarity_top_k
+    self._rrf_k = rrf_k
+    super().__init__(callback_manager=callback_manager)
+
+  @override
+  def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+    return self.retrieve_in_context(query_bundle, RetrievalContext())
+
+  @override
+  async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+    return await self.aretrieve_in_context(query_bundle, RetrievalContext())
+
+  async def aretrieve_in_context(self, query_bundle: QueryBundle, context: RetrievalContext) -> list[NodeWithScore]:
+    return await asyncio.to_thread(self.retrieve_in_context, query_bundle, context)
+
+  def retrieve_in_context(self, query_bundle: QueryBundle, context: RetrievalContext) -> list[NodeWithScore]:
+    """
+    Same as `MultiQueryRetriever.retrieve_in_context()`: only the strings not seen in the context are searched.
+    """
+
+    dense_nodes = self._dense_retriever.retrieve_in_context(query_bundle, context)
+
+    for query_str in dedup_query_strs(query_bundle.embedding_strs, seen_keys=context.lexical_query_str_keys):
+      context.lexical_results.append(self._lexical_retriever.retrieve_str(query_str))
+
+    # The per-string lexical rankings are fused first, so both retrievers have the same weight.
+    lexical_nodes = self._fuse(context.lexical_results)
+
+    return self._fuse([dense_nodes, lexical_nodes])[:self._similarity_top_k]
+
+  def _fuse(self, rankings: list[list[NodeWithScore]]) -> list[NodeWithScore]:
+    nodes: dict[str, NodeWithScore] = {}
+    for ranking in rankings:
+      for rank, node_with_score in enumerate(ranking):
+        score = 1.0 / (self._rrf_k + rank + 1)
+        fused = nodes.get(node_with_score.node.node_id)
+        if fused is None:
+          nodes[node_with_score.node.node_id] = NodeWithScore(node=node_with_score.node, score=score)
+        else:
+          fused.score = (fused.score or 0.0) + score
+
+    return sorted(nodes.values(), key=lambda node_with_score: node_with_score.score or 0.0, reverse=True)
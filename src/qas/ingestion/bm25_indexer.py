@@ -0,0 +1,41 @@
+from typing import Any, Iterable
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.schema import TransformComponent, BaseNode, MetadataMode
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStore
+
+from qas.bm25 import BM25Index, get_shard_name
+
+class BM25Indexer(TransformComponent):
+  """
+  Adds the nodes to a `BM25Index` (the same text as embedded, i.e. with the embedding metadata) and passes them on.
+
+  Meant to be the last transformation, so only the nodes that make it to the vector store are indexed.
+  """
+
+  _index: BM25Index = PrivateAttr()
+  _vector_store: VectorStore | BasePydanticVectorStore | None = PrivateAttr(default=None)
+
+  def __init__(self, index: BM25Index, vector_store: VectorStore | BasePydanticVectorStore | None = None, **kwargs: Any):
+    """
+    - `vector_store`: the vector store the nodes are added to, to index the nodes with their shard (see `ShardedVectorStore`)
+    """
+
+    super().__init__(**kwargs)
+    self._index = index
+    self._vector_store = vector_store
+
+  def __call__(self, nodes: list["BaseNode"], **kwargs: Any) -> list["BaseNode"]:
+      del kwargs
+      self._index.add(
+        (node.node_id, node.ref_doc_id or "None", node.get_content(metadata_mode=MetadataMode.EMBED), get_shard_name(self._vector_store, node))
+        for node in nodes
+      )
+      return nodes
+
+  def forget_sources(self, source_ids: Iterable[str]):
+    """
+    Remove the nodes of the sources (e.g. removed from the index or about to be ingested again).
+    """
+
+    self._index.remove_sources(source_ids)
@@ -0,0 +1,41 @@
+from typing import Sequence
+from typing_extensions import override
+
+from llama_index.node_parser import SentenceWindowNodeParser
+from llama_index.node_parser.node_utils import build_nodes_from_splits
+from llama_index.schema import BaseNode, Document
+
+SENTENCE_INDEX_METADATA_KEY = "sentence_index"
+
+class CompactSentenceWindowNodeParser(SentenceWindowNodeParser):
+  """
+  A `SentenceWindowNodeParser` that only stores the position of the sentence within its document
+  (`SENTENCE_INDEX_METADATA_KEY`) instead of a copy of the surrounding window (and of the sentence itself).
+
+  The windows are rebuilt from the neighbouring sentences at query time (see `SentenceWindowExpander`).
+  """
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "CompactSentenceWindowNodeParser"
+
+  @override
+  def build_window_nodes_from_documents(self, documents: Sequence[Document]) -> list[BaseNode]:
+    all_nodes: list[BaseNode] = []
+    # The documents of a source share its ID (see `sync.group_by_source()`), e.g. the pages of a PDF file:
+    # their sentences are numbered in a row.
+    sentence_counts: dict[str, int] = {}
+    for doc in documents:
+      nodes = build_nodes_from_splits(self.sentence_splitter(doc.text), doc, id_func=self.id_func)
+
+      first_sentence_index = sentence_counts.get(doc.doc_id, 0)
+      for i, node in enumerate(nodes):
+        node.metadata[SENTENCE_INDEX_METADATA_KEY] = first_sentence_index + i
+        node.excluded_embed_metadata_keys.append(SENTENCE_INDEX_METADATA_KEY)
+        node.excluded_llm_metadata_keys.append(SENTENCE_INDEX_METADATA_KEY)
+      sentence_counts[doc.doc_id] = first_sentence_index + len(nodes)
+
+      all_nodes.extend(nodes)
+
+    return all_nodes
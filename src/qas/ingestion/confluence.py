@@ -6,6 +6,7 @@ from llama_hub.confluence import ConfluenceReader
 from llama_index.schema import Document
 from requests import HTTPError
 
+from qas.tracing import tracer
 from qas.utils import Mark
 
 def load_data(
@@ -35,11 +36,12 @@ def load_data(
     for space_key in space_keys:
       for retry in range(retry_limit):
         try:
-          with Mark(f"Fetching Confluence space {space_key}... "):
+          with Mark(f"Fetching Confluence space {space_key}... "), tracer.span("confluence.fetch", space=space_key, retry=retry):
             result = reader.load_data(
               space_key=space_key,
               include_attachments=False,
             )
+            tracer.count("confluence_documents", len(result))
           print(f"Fetched {len(result)} document(s)")
           docs.extend(result)
         except:
@@ -50,13 +52,14 @@ def load_data(
     for q in cql_queries:
       for retry in range(retry_limit):
         try:
-          with Mark(f"Querying Confluence with \"{q}\"..."):
+          with Mark(f"Querying Confluence with \"{q}\"..."), tracer.span("confluence.fetch", cql=q, retry=retry):
             # CQL results seem to be limited to 4k entries
             # (or it's and issue with the particular Confluence instance used for testing)
             result = reader.load_data(
               cql=q,
               include_attachments=False,
             )
+            tracer.count("confluence_documents", len(result))
           print(f"Fetched {len(result)} document(s)")
           docs.extend(result)
         except:
@@ -0,0 +1,56 @@
+from hashlib import sha256
+import json
+import os
+
+class IngestionManifest:
+  """
+  A persistent mapping from source identifiers (see `qas.ingestion.sync.get_source_id`)
+  to the content hashes of the documents ingested into the vector store.
+  """
+
+  path: str
+  entries: dict[str, str]
+
+  def __init__(self, path: str):
+    self.path = path
+    self.entries = {}
+
+    if os.path.exists(path):
+      with open(path, mode="r", encoding="utf-8") as f:
+        self.entries = json.load(f)
+
+  def __len__(self) -> int:
+    return len(self.entries)
+
+  def __contains__(self, source_id: str) -> bool:
+    return source_id in self.entries
+
+  def get(self, source_id: str) -> str | None:
+    return self.entries.get(source_id)
+
+  def set(self, source_id: str, content_hash: str):
+    self.entries[source_id] = content_hash
+
+  def remove(self, source_id: str):
+    self.entries.pop(source_id, None)
+
+  def digest(self) -> str:
+    """
+    A hash of the whole manifest, i.e. a version of the index contents.
+    """
+
+    return sha256(json.dumps(self.entries, sort_keys=True).encode()).hexdigest()
+
+  def clear(self):
+    self.entries.clear()
+
+  def save(self):
+    dir_name = os.path.dirname(self.path)
+    if dir_name:
+      os.makedirs(dir_name, exist_ok=True)
+
+    # Write to a temporary file first, so an interrupted write never leaves a truncated manifest behind.
+    tmp_path = f"{self.path}.tmp"
+    with open(tmp_path, mode="w", encoding="utf-8") as f:
+      json.dump(self.entries, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, self.path)
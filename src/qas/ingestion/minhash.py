@@ -0,0 +1,114 @@
+from hashlib import blake2b
+from typing import Callable
+import re
+
+import numpy as np
+
+# The largest prime below 2^32: the permuted hashes are computed in 64 bits without overflowing.
+_PRIME = np.uint64(4_294_967_291)
+
+_word = re.compile(r"\w+")
+
+class MinHasher:
+  """
+  MinHash signatures of texts (over the word shingles), estimating the Jaccard similarity of the shingle sets.
+  """
+
+  shingle_size: int
+  permutation_count: int
+
+  _a: np.ndarray
+  _b: np.ndarray
+
+  def __init__(self, permutation_count: int = 128, shingle_size: int = 3, seed: int = 1):
+    self.shingle_size = shingle_size
+    self.permutation_count = permutation_count
+
+    # Fixed seed: the signatures are persisted, so the permutations must be the same across runs.
+    rng = np.random.default_rng(seed)
+    self._a = rng.integers(1, int(_PRIME), size=permutation_count, dtype=np.uint64)
+    self._b = rng.integers(0, int(_PRIME), size=permutation_count, dtype=np.uint64)
+
+  def signature(self, text: str) -> np.ndarray:
+    words = _word.findall(text.lower())
+    shingles = {
+      " ".join(words[i:i + self.shingle_size])
+      for i in range(max(len(words) - self.shingle_size + 1, 1))
+    }
+    hashes = np.fromiter(
+      (int.from_bytes(blake2b(shingle.encode(), digest_size=4).digest(), "little") for shingle in shingles),
+      dtype=np.uint64,
+      count=len(shingles),
+    )
+
+    permuted = (hashes[:, np.newaxis] * self._a + self._b) % _PRIME
+    return permuted.min(axis=0).astype(np.uint32)
+
+  @staticmethod
+  def similarity(signature1: np.ndarray, signature2: np.ndarray) -> float:
+    return float(np.mean(signature1 == signature2))
+
+class LSHIndex:
+  """
+  Locality-sensitive hashing (banding) of MinHash signatures: the signatures are split into `band_count` bands,
+  and the signatures sharing any band are candidates for being near-duplicates.
+
+  With `b` bands of `r` rows, the pairs with the similarity `s` become candidates with the probability
+  `1 - (1 - s^r)^b` (a steep S-curve around `(1 / b)^(1 / r)`).
+  """
+
+  band_count: int
+
+  _buckets: dict[bytes, list[int]]
+  _signatures: dict[int, np.ndarray]
+
+  def __init__(self, band_count: int = 16):
+    self.band_count = band_count
+    self._buckets = {}
+    self._signatures = {}
+
+  def __len__(self) -> int:
+    return len(self._signatures)
+
+  def add(self, key: int, signature: np.ndarray):
+    self._signatures[key] = signature
+    for band_key in self._get_band_keys(signature):
+      self._buckets.setdefault(band_key, []).append(key)
+
+  def remove(self, key: int):
+    signature = self._signatures.pop(key, None)
+    if signature is None:
+      return
+
+    for band_key in self._get_band_keys(signature):
+      bucket = self._buckets.get(band_key)
+      if bucket is not None:
+        bucket.remove(key)
+        if not bucket:
+          del self._buckets[band_key]
+
+  def clear(self):
+    self._buckets.clear()
+    self._signatures.clear()
+
+  def find_similar(self, signature: np.ndarray, threshold: float, exclude: Callable[[int], bool] | None = None) -> int | None:
+    """
+    The key of a stored signature with the estimated similarity of at least `threshold`, if any
+    (skipping the keys `exclude` returns `True` for).
+    """
+
+    checked: set[int] = set()
+    for band_key in self._get_band_keys(signature):
+      for key in self._buckets.get(band_key, ()):
+        if key in checked:
+          continue
+        checked.add(key)
+        if exclude is not None and exclude(key):
+          continue
+        if MinHasher.similarity(signature, self._signatures[key]) >= threshold:
+          return key
+    return None
+
+  def _get_band_keys(self, signature: np.ndarray) -> list[bytes]:
+    # The band index is a part of the key: equal values in different bands don't make a match.
+    return [bytes([i]) + band.tobytes() for i, band in enumerate(np.array_split(signature, self.band_count))]
@@ -1,27 +1,144 @@
-from typing import Any
+from hashlib import blake2b
+from typing import Any, Iterable
+import os
+import sqlite3
 
+from llama_index.bridge.pydantic import PrivateAttr
 from llama_index.schema import TransformComponent, BaseNode
 import llama_index.node_parser.text.sentence_window as sentence_window
+import numpy as np
+
+from qas.ingestion.minhash import LSHIndex, MinHasher
 
 class NodeDedup(TransformComponent):
-  _keys: set[Any] = set()
+  """
+  Drops the nodes of a source with the same content (the sentence window, when present) as a node seen before.
+
+  The nodes are remembered by a fixed-size digest of their source and content. With a `path`, the digests are
+  persisted (SQLite), so the nodes ingested by the previous runs are considered as well; the digests of the sources
+  removed from the index must be forgotten (see `forget_sources()`).
+
+  With `near_duplicates`, also drops the nodes almost identical to a node of another source seen before, e.g.
+  the template paragraphs repeated across many pages. The nodes are compared by the estimated Jaccard similarity
+  of their word shingles (MinHash, with LSH banding to only compare likely candidates). The nodes of the same
+  source are not compared: the windows of the adjacent sentences overlap as much as near-duplicates.
+  Note that when the source of the kept node is removed, the dropped near-duplicates only return
+  once their own sources are ingested again.
+  """
+
+  near_duplicates: bool = False
+  near_duplicate_threshold: float = 0.8
+  """
+  The min. estimated Jaccard similarity of near-duplicates.
+  """
+
+  _connection: sqlite3.Connection = PrivateAttr()
+  _minhasher: MinHasher | None = PrivateAttr(default=None)
+  _lsh_index: LSHIndex | None = PrivateAttr(default=None)
+  _signature_source_ids: dict[int, str] = PrivateAttr(default_factory=dict)
+  _next_signature_id: int = PrivateAttr(default=0)
+
+  def __init__(self, path: str | None = None, **kwargs: Any):
+    """
+    - `path`: the SQLite database to persist the digests in; in-memory only when not set
+    """
+
+    super().__init__(**kwargs)
+
+    if path:
+      dir_name = os.path.dirname(path)
+      if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+    self._connection = sqlite3.connect(path or ":memory:", check_same_thread=False)
+    self._connection.execute("CREATE TABLE IF NOT EXISTS node_keys (key BLOB PRIMARY KEY, source_id TEXT NOT NULL)")
+    self._connection.execute("CREATE INDEX IF NOT EXISTS node_keys_source_id ON node_keys (source_id)")
+    self._connection.execute(
+      "CREATE TABLE IF NOT EXISTS node_signatures (id INTEGER PRIMARY KEY, source_id TEXT NOT NULL, signature BLOB NOT NULL)"
+    )
+    self._connection.execute("CREATE INDEX IF NOT EXISTS node_signatures_source_id ON node_signatures (source_id)")
+    self._connection.commit()
+
+    if self.near_duplicates:
+      self._minhasher = MinHasher()
+      self._lsh_index = LSHIndex()
+      self._load_signatures()
 
   def __call__(self, nodes: list["BaseNode"], **kwargs: Any) -> list["BaseNode"]:
       del kwargs
-      return [node for node in nodes if self._register_node(node)]
+      kept_nodes = [node for node in nodes if self._register_node(node)]
+      self._connection.commit()
+      return kept_nodes
+
+  def forget_sources(self, source_ids: Iterable[str]):
+    """
+    Forget the nodes of the sources (e.g. removed from the index or about to be ingested again).
+    """
+
+    params = [(source_id,) for source_id in source_ids]
+    self._connection.executemany("DELETE FROM node_keys WHERE source_id = ?", params)
+
+    if self._lsh_index is not None:
+      for param in params:
+        for (signature_id,) in self._connection.execute("SELECT id FROM node_signatures WHERE source_id = ?", param).fetchall():
+          self._lsh_index.remove(signature_id)
+          self._signature_source_ids.pop(signature_id, None)
+    self._connection.executemany("DELETE FROM node_signatures WHERE source_id = ?", params)
+
+    self._connection.commit()
+
+  def clear(self):
+    self._connection.execute("DELETE FROM node_keys")
+    self._connection.execute("DELETE FROM node_signatures")
+    self._connection.commit()
+    if self._lsh_index is not None:
+      self._lsh_index.clear()
+    self._signature_source_ids.clear()
 
   def _register_node(self, node: BaseNode) -> bool:
-    key = self._get_key(node)
-    if key in self._keys:
+    source_id = self._get_source_id(node)
+    content = self._get_content(node)
+
+    key = blake2b(f"{source_id}\0{content}".encode(), digest_size=16).digest()
+    cursor = self._connection.execute("INSERT OR IGNORE INTO node_keys (key, source_id) VALUES (?, ?)", (key, source_id))
+    if cursor.rowcount == 0:
       return False
-    else:
-      self._keys.add(key)
-      return True
 
-  def _get_key(self, node: BaseNode):
+    if self._minhasher is not None and self._lsh_index is not None:
+      signature = self._minhasher.signature(content)
+      similar_signature_id = self._lsh_index.find_similar(
+        signature,
+        self.near_duplicate_threshold,
+        exclude=lambda signature_id: self._signature_source_ids.get(signature_id) == source_id,
+      )
+      if similar_signature_id is not None:
+        return False
+
+      signature_id = self._next_signature_id
+      self._next_signature_id += 1
+      self._lsh_index.add(signature_id, signature)
+      self._signature_source_ids[signature_id] = source_id
+      self._connection.execute(
+        "INSERT INTO node_signatures (id, source_id, signature) VALUES (?, ?, ?)",
+        (signature_id, source_id, signature.tobytes()),
+      )
+
+    return True
+
+  def _load_signatures(self):
+    assert self._lsh_index is not None
+    for signature_id, source_id, signature in self._connection.execute("SELECT id, source_id, signature FROM node_signatures"):
+      self._lsh_index.add(signature_id, np.frombuffer(signature, dtype=np.uint32))
+      self._signature_source_ids[signature_id] = source_id
+      self._next_signature_id = max(self._next_signature_id, signature_id + 1)
+
+  def _get_source_id(self, node: BaseNode) -> str:
+    # The source identifier is used as the document ID when synchronizing (see `sync.group_by_source()`).
+    if node.ref_doc_id:
+      return node.ref_doc_id
+
     source_node = node.source_node or node
-    source_id = source_node.metadata.get("file_name") or source_node.metadata.get("page_id")
-    return (
-      source_id,
-      node.metadata.get(sentence_window.DEFAULT_WINDOW_METADATA_KEY) or node.get_content()
-    )
\ No newline at end of file
+    return str(source_node.metadata.get("file_name") or source_node.metadata.get("page_id"))
+
+  def _get_content(self, node: BaseNode) -> str:
+    return node.metadata.get(sentence_window.DEFAULT_WINDOW_METADATA_KEY) or node.get_content()
@@ -0,0 +1,37 @@
+from typing import Any, Iterable
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.schema import TransformComponent, BaseNode
+
+from qas.ingestion.compact_sentence_window import SENTENCE_INDEX_METADATA_KEY
+from qas.sentence_store import SentenceStore
+
+class SentenceRecorder(TransformComponent):
+  """
+  Adds the sentences of the nodes made by `CompactSentenceWindowNodeParser` to a `SentenceStore` and passes the nodes on.
+
+  Meant to follow the node parser, so the sentences dropped by the next transformations (e.g. `TextCleanUp`,
+  `NodeDedup`) are kept for the windows as well.
+  """
+
+  _store: SentenceStore = PrivateAttr()
+
+  def __init__(self, store: SentenceStore, **kwargs: Any):
+    super().__init__(**kwargs)
+    self._store = store
+
+  def __call__(self, nodes: list["BaseNode"], **kwargs: Any) -> list["BaseNode"]:
+      del kwargs
+      self._store.add(
+        (node.ref_doc_id, node.metadata[SENTENCE_INDEX_METADATA_KEY], node.get_content())
+        for node in nodes
+        if node.ref_doc_id and SENTENCE_INDEX_METADATA_KEY in node.metadata
+      )
+      return nodes
+
+  def forget_sources(self, source_ids: Iterable[str]):
+    """
+    Remove the sentences of the sources (e.g. removed from the index or about to be ingested again).
+    """
+
+    self._store.remove_documents(source_ids)
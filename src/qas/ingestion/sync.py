@@ -0,0 +1,148 @@
+from hashlib import sha256
+from typing import Any, Iterable, Sequence
+import json
+
+from llama_index.indices import VectorStoreIndex
+from llama_index.schema import BaseNode, Document, TransformComponent
+from pydantic import BaseModel
+
+from qas.ingestion.manifest import IngestionManifest
+from qas.tracing import tracer
+
+# File system timestamps change without the content changing (e.g. on checkout or copying).
+VOLATILE_METADATA_KEYS = {"creation_date", "last_modified_date", "last_accessed_date"}
+
+class SyncPlan(BaseModel):
+  added: list[str] = []
+  changed: list[str] = []
+  removed: list[str] = []
+  unchanged: list[str] = []
+
+  def is_empty(self) -> bool:
+    return not (self.added or self.changed or self.removed)
+
+def get_source_id(doc: Document) -> str:
+  """
+  A stable identifier of the source (a file or a Confluence page) the document was loaded from.
+  """
+
+  return str(
+    doc.metadata.get("file_path")
+    or doc.metadata.get("file_name")
+    or doc.metadata.get("page_id")
+    or doc.doc_id
+  )
+
+def get_content_hash(docs: Iterable[Document]) -> str:
+  h = sha256()
+  for doc in docs:
+    metadata = {k: v for k, v in doc.metadata.items() if k not in VOLATILE_METADATA_KEYS}
+    h.update(json.dumps(metadata, sort_keys=True, default=str).encode())
+    h.update(doc.text.encode())
+  return h.hexdigest()
+
+def group_by_source(documents: Iterable[Document]) -> dict[str, list[Document]]:
+  """
+  Group the documents by their source and use the source identifier as the document ID,
+  so the nodes derived from a source can be deleted from the vector store by that identifier.
+  """
+
+  sources: dict[str, list[Document]] = {}
+  for doc in documents:
+    source_id = get_source_id(doc)
+    doc.id_ = source_id
+    sources.setdefault(source_id, []).append(doc)
+  return sources
+
+def plan_sync(sources: dict[str, list[Document]], manifest: IngestionManifest) -> SyncPlan:
+  plan = SyncPlan()
+  for source_id, docs in sources.items():
+    known_hash = manifest.get(source_id)
+    if known_hash is None:
+      plan.added.append(source_id)
+    elif known_hash != get_content_hash(docs):
+      plan.changed.append(source_id)
+    else:
+      plan.unchanged.append(source_id)
+  plan.removed = [source_id for source_id in manifest.entries if source_id not in sources]
+  return plan
+
+def sync_index(
+  index: VectorStoreIndex,
+  documents: Iterable[Document],
+  manifest: IngestionManifest,
+  transformations: Sequence[TransformComponent],
+  batch_size: int = 256,
+  show_progress: bool = False,
+) -> SyncPlan:
+  """
+  Bring the vector store behind `index` in line with `documents`: parse and embed only
+  the new and changed sources, replace the nodes of the changed sources
+  and delete the nodes of the sources that no longer exist.
+
+  The manifest is saved after each step, so an interrupted synchronization can be resumed
+  by running it again.
+  """
+
+  with tracer.span("ingestion.sync"):
+    sources = group_by_source(documents)
+    plan = plan_sync(sources, manifest)
+
+    print(
+      f"Sources: {len(plan.added)} new, {len(plan.changed)} changed, "
+      f"{len(plan.removed)} removed, {len(plan.unchanged)} unchanged"
+    )
+    tracer.set(added=len(plan.added), changed=len(plan.changed), removed=len(plan.removed), unchanged=len(plan.unchanged))
+
+    _sync_index(index, sources, plan, manifest, transformations, batch_size, show_progress)
+
+  return plan
+
+def _sync_index(
+  index: VectorStoreIndex,
+  sources: dict[str, list[Document]],
+  plan: SyncPlan,
+  manifest: IngestionManifest,
+  transformations: Sequence[TransformComponent],
+  batch_size: int,
+  show_progress: bool,
+):
+  stale_source_ids = plan.changed + plan.removed
+  with tracer.span("ingestion.delete", source_count=len(stale_source_ids)):
+    for source_id in stale_source_ids:
+      index.delete_ref_doc(source_id)
+      manifest.remove(source_id)
+    if stale_source_ids:
+      manifest.save()
+
+  # The transformations keeping the state of the ingested nodes (see `NodeDedup`, `BM25Indexer`) forget the stale ones,
+  # e.g. otherwise the nodes of the changed sources would be dropped as the duplicates of the deleted ones.
+  for transformation in transformations:
+    forget_sources = getattr(transformation, "forget_sources", None)
+    if forget_sources is not None:
+      forget_sources(stale_source_ids + plan.added)
+
+  pending_source_ids = plan.added + plan.changed
+  for i in range(0, len(pending_source_ids), batch_size):
+    batch = pending_source_ids[i:i + batch_size]
+    docs: list[BaseNode] = [doc for source_id in batch for doc in sources[source_id]]
+
+    with tracer.span("ingestion.batch", source_count=len(batch), document_count=len(docs)):
+      nodes = run_transformations(docs, transformations, show_progress=show_progress)
+      with tracer.span("ingestion.insert", node_count=len(nodes)):
+        index.insert_nodes(nodes, show_progress=show_progress)
+
+      for source_id in batch:
+        manifest.set(source_id, get_content_hash(sources[source_id]))
+      manifest.save()
+
+def run_transformations(nodes: list[BaseNode], transformations: Sequence[TransformComponent], **kwargs: Any) -> list[BaseNode]:
+  """
+  Same as `llama_index.ingestion.run_transformations()` (without the cache), with a span per transformation.
+  """
+
+  for transformation in transformations:
+    name = getattr(transformation, "__name__", None) or type(transformation).__name__
+    with tracer.span("ingestion.transformation", transformation=name):
+      nodes = transformation(nodes, **kwargs)
+  return nodes
@@ -1,39 +1,40 @@
 from typing import Any
-import re
 
 from llama_index.schema import TransformComponent, BaseNode, TextNode
 
+from qas.text_normalizer import NormalizedText, has_min_word_count, normalize_texts
+
 class TextCleanUp(TransformComponent):
   """
-  Cleans the content of `TextNode` nodes up in place (!!).
+  Cleans the content of `TextNode` nodes up in place (!!) and drops the tiny nodes.
+
+  The character indices of the nodes (`start_char_idx`, `end_char_idx`) are narrowed to the span
+  of the document the cleaned up content is derived from (see `text_normalizer.OffsetMap`).
   """
 
-  _leading_empty_lines = re.compile(r"^([^\S\n]*\n)+")
-  _excessive_empty_lines = re.compile(r"([^\S\n]*\n){2,}")
-  _rouge_line_break = re.compile(r"(?<=[\w ])\n(?=[\w])")
-  _trailing_whitespace = re.compile(r"\s+$")
-  _word = re.compile(r"\w+")
+  min_word_count: int = 4
+  worker_count: int | None = None
+  """
+  The number of processes to clean large node lists up with, the number of CPUs by default.
+  """
 
   def __call__(self, nodes: list[BaseNode], **kwargs: Any) -> list[BaseNode]:
       del kwargs
-      return [self.check_node(node) for node in nodes if self.is_not_tiny(node)]
+      text_nodes = [node for node in nodes if isinstance(node, TextNode)]
+      normalized_texts = normalize_texts([node.text for node in text_nodes], join_lines=True, worker_count=self.worker_count)
+      for node, normalized_text in zip(text_nodes, normalized_texts):
+        self.update_node(node, normalized_text)
+      return [node for node in nodes if self.is_not_tiny(node)]
 
-  def check_node(self, node: BaseNode):
-    if isinstance(node, TextNode):
-      # Note that the following clean-up can invalidate
-      # `node.start_char_idx` and `.end_char_idx`.
+  def update_node(self, node: TextNode, normalized_text: NormalizedText):
+    if node.start_char_idx is not None and node.end_char_idx is not None:
+      start_char_idx = node.start_char_idx
+      node.start_char_idx = start_char_idx + normalized_text.offset_map.to_original(0)
+      node.end_char_idx = start_char_idx + normalized_text.offset_map.to_original(len(normalized_text.text))
 
-      node.text = self.clean_up_text(node.text)
-    return node
+    node.text = normalized_text.text
 
   def is_not_tiny(self, node: BaseNode):
     if isinstance(node, TextNode):
-      return len(self._word.findall(node.text)) > 3
+      return has_min_word_count(node.text, self.min_word_count)
     return True
-
-  def clean_up_text(self, s: str):
-    s = self._leading_empty_lines.sub("", s)
-    s = self._excessive_empty_lines.sub("\n\n", s)
-    s = self._rouge_line_break.sub(" ", s)
-    s = self._trailing_whitespace.sub("", s)
-    return s
@@ -0,0 +1,401 @@
+from threading import Lock
+from typing import Any, Iterator
+from typing_extensions import override
+import json
+import os
+import os.path as p
+import sqlite3
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import Embedding
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStoreQuery, VectorStoreQueryResult
+from llama_index.vector_stores.utils import metadata_dict_to_node, node_to_metadata_dict
+import numpy as np
+
+from qas.ingestion.compact_sentence_window import SENTENCE_INDEX_METADATA_KEY
+
+class MmapVectorStore(BasePydanticVectorStore):
+  """
+  An in-process vector store keeping the embeddings as an int8 matrix in a memory-mapped file
+  and the node text and metadata in a SQLite side table, all in the `path` directory.
+
+  The embeddings are normalized and quantized per row (symmetric, with a float32 scale per row), so a store of
+  `BAAI/bge-small-en-v1.5` embeddings takes about 400 bytes per node instead of about 1.5 KB.
+  The queries are answered by an exact scan of the matrix in blocks of `block_size` rows (one matrix product
+  for all the query embeddings of a block), the similarities are cosine similarities. Unlike the HNSW index of Chroma,
+  the search is exact and nothing is built on ingestion, but its cost grows linearly with the number of nodes.
+
+  With `rescore` (chosen when the store is created), a float32 copy of the embeddings is kept in another
+  memory-mapped file; the `rescore_factor` times more candidates than requested are found with the int8 matrix
+  and re-scored exactly. Only the rows of the candidates are read from that file.
+
+  The rows of the deleted nodes are reused by the nodes added later.
+  """
+
+  stores_text: bool = True
+  flat_metadata: bool = False
+
+  path: str
+  block_size: int = 4096
+  """
+  The number of rows converted to float32 at once (small enough for the block to stay in the CPU cache).
+  """
+  rescore_factor: int = 4
+
+  _connection: sqlite3.Connection = PrivateAttr()
+  _lock: Lock = PrivateAttr()
+  _dimension: int | None = PrivateAttr(default=None)
+  _rescore: bool = PrivateAttr(default=True)
+  _vectors: np.memmap | None = PrivateAttr(default=None)
+  _full_vectors: np.memmap | None = PrivateAttr(default=None)
+  _scales: np.memmap | None = PrivateAttr(default=None)
+  _live: np.ndarray = PrivateAttr()
+  _row_count: int = PrivateAttr(default=0)
+  _free_rows: list[int] = PrivateAttr()
+
+  def __init__(self, path: str, rescore: bool = True, **kwargs: Any):
+    """
+    - `path`: the directory to persist the store in
+    - `rescore`: keep a float32 copy of the embeddings to re-score the candidates (only applies to a new store)
+    """
+
+    super().__init__(path=path, **kwargs)
+
+    os.makedirs(path, exist_ok=True)
+
+    self._lock = Lock()
+    self._connection = sqlite3.connect(p.join(path, "nodes.sqlite3"), check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute("CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    self._connection.execute(
+      "CREATE TABLE IF NOT EXISTS nodes ("
+      "row INTEGER PRIMARY KEY, node_id TEXT NOT NULL UNIQUE, document_id TEXT NOT NULL, "
+      "sentence_index INTEGER, text TEXT NOT NULL, metadata TEXT NOT NULL)"
+    )
+    self._connection.execute("CREATE INDEX IF NOT EXISTS nodes_document_id ON nodes (document_id, sentence_index)")
+    self._connection.commit()
+
+    settings = dict(self._connection.execute("SELECT key, value FROM settings").fetchall())
+    self._rescore = bool(int(settings.get("rescore", rescore)))
+    if "dimension" in settings:
+      self._dimension = int(settings["dimension"])
+
+    rows = [row for (row,) in self._connection.execute("SELECT row FROM nodes ORDER BY row")]
+    self._row_count = rows[-1] + 1 if rows else 0
+    self._live = np.zeros(self._row_count, dtype=np.bool_)
+    self._live[rows] = True
+    self._free_rows = np.flatnonzero(~self._live).tolist()[::-1]
+
+    if self._dimension is not None and self._get_capacity() > 0:
+      self._open_matrices(self._get_capacity())
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "MmapVectorStore"
+
+  @property
+  @override
+  def client(self) -> Any:
+    return self._connection
+
+  def __len__(self) -> int:
+    return int(self._live.sum())
+
+  def close(self):
+    """
+    Close the database and unmap the files (e.g. before removing them); the store cannot be used afterwards.
+    """
+
+    with self._lock:
+      self._connection.close()
+      self._vectors = self._full_vectors = self._scales = None
+
+  @override
+  def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+    if not nodes:
+      return []
+
+    embeddings = _normalize(np.array([node.get_embedding() for node in nodes], dtype=np.float32))
+
+    with self._lock:
+      if self._dimension is None:
+        self._dimension = embeddings.shape[1]
+        self._connection.executemany(
+          "INSERT INTO settings (key, value) VALUES (?, ?)",
+          [("dimension", str(self._dimension)), ("rescore", str(int(self._rescore)))],
+        )
+      elif embeddings.shape[1] != self._dimension:
+        raise ValueError(f"The embedding dimension is {embeddings.shape[1]}, the store dimension is {self._dimension}")
+
+      # The nodes added again replace their previous rows.
+      node_ids = [node.node_id for node in nodes]
+      for i in range(0, len(node_ids), 500):
+        batch = node_ids[i:i + 500]
+        self._delete_rows(
+          self._connection.execute(f"SELECT row FROM nodes WHERE node_id IN ({','.join('?' * len(batch))})", batch).fetchall()
+        )
+
+      rows = self._allocate_rows(len(nodes))
+      assert self._vectors is not None and self._scales is not None
+
+      # Written before the rows are committed, so an interrupted write leaves no readable rows behind.
+      scales = np.abs(embeddings).max(axis=1) / 127
+      scales[scales == 0] = 1
+      self._vectors[rows] = np.rint(embeddings / scales[:, None]).astype(np.int8)
+      self._scales[rows] = scales
+      self._vectors.flush()
+      self._scales.flush()
+      if self._full_vectors is not None:
+        self._full_vectors[rows] = embeddings
+        self._full_vectors.flush()
+
+      records = []
+      for row, node in zip(rows, nodes):
+        metadata = node_to_metadata_dict(node, remove_text=True, flat_metadata=self.flat_metadata)
+        sentence_index = node.metadata.get(SENTENCE_INDEX_METADATA_KEY)
+        records.append((
+          int(row),
+          node.node_id,
+          node.ref_doc_id or "None",
+          sentence_index if isinstance(sentence_index, int) else None,
+          node.get_content(),
+          json.dumps(metadata),
+        ))
+      self._connection.executemany(
+        "INSERT INTO nodes (row, node_id, document_id, sentence_index, text, metadata) VALUES (?, ?, ?, ?, ?, ?)",
+        records,
+      )
+      self._connection.commit()
+      self._live[rows] = True
+
+    return node_ids
+
+  @override
+  def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+    with self._lock:
+      self._delete_rows(self._connection.execute("SELECT row FROM nodes WHERE document_id = ?", (ref_doc_id,)).fetchall())
+      self._connection.commit()
+
+  @override
+  def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+    if query.filters is not None or query.doc_ids or query.node_ids:
+      raise NotImplementedError("MmapVectorStore does not support the metadata, document or node filters")
+    if query.query_embedding is None:
+      raise ValueError("Query embedding is required")
+
+    return self.query_batch([query.query_embedding], query.similarity_top_k)[0]
+
+  def query_batch(self, embeddings: list[Embedding], similarity_top_k: int) -> list[VectorStoreQueryResult]:
+    """
+    Query the store with multiple embeddings at once (one scan of the matrix for all of them).
+    """
+
+    with self._lock:
+      # A consistent snapshot; the rows added meanwhile are not seen, the deleted ones are dropped below.
+      vectors, full_vectors, scales = self._vectors, self._full_vectors, self._scales
+      live = self._live.copy()
+
+    if vectors is None or scales is None or not live.any() or not embeddings:
+      return [VectorStoreQueryResult(nodes=[], similarities=[], ids=[]) for _ in embeddings]
+
+    queries = _normalize(np.array(embeddings, dtype=np.float32))
+    candidate_count = similarity_top_k * (self.rescore_factor if full_vectors is not None else 1)
+    rows, scores = self._scan(queries, vectors, scales, live, candidate_count)
+
+    if full_vectors is not None:
+      rescored_rows = np.empty((len(queries), min(similarity_top_k, rows.shape[1])), dtype=np.int64)
+      rescored_scores = np.empty(rescored_rows.shape, dtype=np.float32)
+      for i, (query_rows, query) in enumerate(zip(rows, queries)):
+        # Sorted, so the rows are read from the file in order.
+        query_rows = np.sort(query_rows)
+        exact_scores = full_vectors[query_rows] @ query
+        best = _top_k(exact_scores, rescored_rows.shape[1])
+        order = np.argsort(-exact_scores[best])
+        rescored_rows[i] = query_rows[best][order]
+        rescored_scores[i] = exact_scores[best][order]
+      rows, scores = rescored_rows, rescored_scores
+
+    all_rows = np.unique(rows)
+    nodes_by_row = self._load_nodes(all_rows.tolist())
+
+    results = []
+    for query_rows, query_scores in zip(rows, scores):
+      nodes: list[BaseNode] = []
+      similarities: list[float] = []
+      for row, score in zip(query_rows.tolist(), query_scores.tolist()):
+        node = nodes_by_row.get(row)
+        # Deleted since the snapshot.
+        if node is not None:
+          nodes.append(node)
+          similarities.append(score)
+      results.append(VectorStoreQueryResult(nodes=nodes, similarities=similarities, ids=[node.node_id for node in nodes]))
+    return results
+
+  def get_nodes(self, node_ids: list[str]) -> list[BaseNode]:
+    """
+    The stored nodes by their IDs (in the order of the IDs, the missing ones are skipped).
+    """
+
+    nodes_by_id: dict[str, BaseNode] = {}
+    for i in range(0, len(node_ids), 500):
+      batch = node_ids[i:i + 500]
+      with self._lock:
+        records = self._connection.execute(
+          f"SELECT text, metadata FROM nodes WHERE node_id IN ({','.join('?' * len(batch))})",
+          batch,
+        ).fetchall()
+      for text, metadata in records:
+        node = _make_node(text, metadata)
+        nodes_by_id[node.node_id] = node
+    return [nodes_by_id[node_id] for node_id in node_ids if node_id in nodes_by_id]
+
+  def get_sentences(self, ranges: dict[str, list[tuple[int, int]]]) -> dict[str, dict[int, str]]:
+    """
+    The stored sentences (see `CompactSentenceWindowNodeParser`) of the documents within the `[start, end)` ranges,
+    by the document ID and the sentence index.
+    """
+
+    sentences: dict[str, dict[int, str]] = {}
+    with self._lock:
+      for document_id, document_ranges in ranges.items():
+        for start, end in document_ranges:
+          records = self._connection.execute(
+            "SELECT sentence_index, text FROM nodes WHERE document_id = ? AND sentence_index >= ? AND sentence_index < ?",
+            (document_id, start, end),
+          )
+          sentences.setdefault(document_id, {}).update(records)
+    return sentences
+
+  def iter_nodes(self, batch_size: int = 5000) -> Iterator[list[BaseNode]]:
+    """
+    All the stored nodes, in batches.
+    """
+
+    last_row = -1
+    while True:
+      with self._lock:
+        records = self._connection.execute(
+          "SELECT row, text, metadata FROM nodes WHERE row > ? ORDER BY row LIMIT ?",
+          (last_row, batch_size),
+        ).fetchall()
+      if not records:
+        return
+      last_row = records[-1][0]
+      yield [_make_node(text, metadata) for _, text, metadata in records]
+
+  def _scan(
+    self,
+    queries: np.ndarray,
+    vectors: np.ndarray,
+    scales: np.ndarray,
+    live: np.ndarray,
+    top_k: int,
+  ) -> tuple[np.ndarray, np.ndarray]:
+    """
+    The rows of the `top_k` best matching live rows of each query and their approximate similarities, best first.
+    """
+
+    best_rows = np.empty((len(queries), 0), dtype=np.int64)
+    best_scores = np.empty((len(queries), 0), dtype=np.float32)
+
+    for start in range(0, len(live), self.block_size):
+      end = min(start + self.block_size, len(live))
+      block_live = live[start:end]
+      live_count = int(block_live.sum())
+      if not live_count:
+        continue
+
+      # (queries, rows); the int8 block is converted once for all the queries.
+      block_scores = np.ascontiguousarray((np.asarray(vectors[start:end]).astype(np.float32) @ queries.T).T)
+      block_scores *= scales[start:end]
+      if live_count < end - start:
+        block_scores[:, ~block_live] = -np.inf
+
+      # The best of the block first, so only a few candidates are merged with the best so far.
+      block_best = _top_k(block_scores, min(top_k, live_count))
+      rows = np.concatenate([best_rows, block_best + start], axis=1)
+      scores = np.concatenate([best_scores, np.take_along_axis(block_scores, block_best, axis=1)], axis=1)
+      best = _top_k(scores, min(top_k, scores.shape[1]))
+      best_rows = np.take_along_axis(rows, best, axis=1)
+      best_scores = np.take_along_axis(scores, best, axis=1)
+
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_rows, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+  def _load_nodes(self, rows: list[int]) -> dict[int, BaseNode]:
+    nodes_by_row: dict[int, BaseNode] = {}
+    for i in range(0, len(rows), 500):
+      batch = rows[i:i + 500]
+      with self._lock:
+        records = self._connection.execute(
+          f"SELECT row, text, metadata FROM nodes WHERE row IN ({','.join('?' * len(batch))})",
+          batch,
+        ).fetchall()
+      for row, text, metadata in records:
+        nodes_by_row[row] = _make_node(text, metadata)
+    return nodes_by_row
+
+  def _delete_rows(self, rows: list[tuple[int]]):
+    if not rows:
+      return
+
+    row_list = [row for (row,) in rows]
+    self._connection.executemany("DELETE FROM nodes WHERE row = ?", rows)
+    self._live[row_list] = False
+    self._free_rows.extend(row_list)
+
+  def _allocate_rows(self, count: int) -> np.ndarray:
+    rows = [self._free_rows.pop() for _ in range(min(count, len(self._free_rows)))]
+
+    new_row_count = self._row_count + count - len(rows)
+    rows.extend(range(self._row_count, new_row_count))
+    if new_row_count > self._row_count:
+      capacity = self._get_capacity()
+      if new_row_count > capacity or self._vectors is None:
+        # Grow by doubling, so the files are not extended on every batch.
+        self._open_matrices(max(new_row_count, 2 * capacity, 1024))
+      self._live = np.concatenate([self._live, np.zeros(new_row_count - self._row_count, dtype=np.bool_)])
+      self._row_count = new_row_count
+
+    return np.array(rows, dtype=np.int64)
+
+  def _get_capacity(self) -> int:
+    path = p.join(self.path, "scales.f32")
+    return os.path.getsize(path) // 4 if p.exists(path) else 0
+
+  def _open_matrices(self, capacity: int):
+    assert self._dimension is not None
+
+    def open_matrix(file_name: str, dtype: type, shape: tuple[int, ...]) -> np.memmap:
+      path = p.join(self.path, file_name)
+      size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+      with open(path, "ab") as f:
+        if f.tell() < size:
+          f.truncate(size)
+      return np.memmap(path, dtype=dtype, mode="r+", shape=shape)
+
+    self._vectors = open_matrix("vectors.i8", np.int8, (capacity, self._dimension))
+    self._scales = open_matrix("scales.f32", np.float32, (capacity,))
+    if self._rescore:
+      self._full_vectors = open_matrix("vectors.f32", np.float32, (capacity, self._dimension))
+
+def _normalize(embeddings: np.ndarray) -> np.ndarray:
+  norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+  norms[norms == 0] = 1
+  return embeddings / norms
+
+def _top_k(scores: np.ndarray, k: int) -> np.ndarray:
+  """
+  The indices of the `k` largest scores along the last axis (unordered).
+  """
+
+  if k >= scores.shape[-1]:
+    return np.broadcast_to(np.arange(scores.shape[-1]), scores.shape).copy()
+  return np.argpartition(-scores, k - 1, axis=-1)[..., :k]
+
+def _make_node(text: str, metadata: str) -> BaseNode:
+  node = metadata_dict_to_node(json.loads(metadata))
+  node.set_content(text)
+  return node
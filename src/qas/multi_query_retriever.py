@@ -0,0 +1,150 @@
+from typing import Literal
+from typing_extensions import override
+import asyncio
+import re
+
+from llama_index.callbacks.base import CallbackManager
+from llama_index.embeddings.base import BaseEmbedding, Embedding
+from llama_index.retrievers import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.types import BasePydanticVectorStore, VectorStore, VectorStoreQueryResult
+import numpy as np
+
+from qas.batch_query import query_vector_store
+from qas.embeddings import embed_queries
+
+FusionMode = Literal["rrf", "max"]
+
+_NON_WORD = re.compile(r"[\W_]+")
+
+class RetrievalContext:
+  """
+  The per-request retrieval state: the query strings searched so far with their embeddings
+  and results. Passing the same context to `MultiQueryRetriever.retrieve_in_context()` again
+  only embeds and searches the strings it hasn't seen yet, the stored results are fused with the new ones.
+  """
+
+  query_str_keys: set[str]
+  embeddings: list[Embedding]
+  results: list[VectorStoreQueryResult]
+
+  lexical_query_str_keys: set[str]
+  lexical_results: list[list[NodeWithScore]]
+  """
+  The same for the lexical retrieval (see `HybridRetriever`).
+  """
+
+  def __init__(self):
+    self.query_str_keys = set()
+    self.embeddings = []
+    self.results = []
+    self.lexical_query_str_keys = set()
+    self.lexical_results = []
+
+class MultiQueryRetriever(BaseRetriever):
+  """
+  Retrieves the nodes relevant to any of the query embedding strings (`QueryBundle.embedding_strs`,
+  e.g. the original query and its rephrasings produced by `ExpandQueryTransform`).
+
+  The strings are deduplicated (near-identical ones are dropped), embedded in one batch
+  and the vector store is queried with all the embeddings at once. The per-string results
+  are fused into a single ranking.
+  """
+
+  _vector_store: VectorStore | BasePydanticVectorStore
+  _embed_model: BaseEmbedding
+  _similarity_top_k: int
+  _dedup_similarity_threshold: float
+  _fusion: FusionMode
+  _rrf_k: int
+
+  def __init__(
+    self,
+    vector_store: VectorStore | BasePydanticVectorStore,
+    embed_model: BaseEmbedding,
+    similarity_top_k: int = 128,
+    dedup_similarity_threshold: float = 0.95,
+    fusion: FusionMode = "rrf",
+    rrf_k: int = 60,
+    callback_manager: CallbackManager | None = None,
+  ):
+    """
+    - `similarity_top_k`: the number of nodes to retrieve per query string and in total (after the fusion)
+    - `dedup_similarity_threshold`: the cosine similarity above which a query string is considered a duplicate of a preceding one
+    - `fusion`: "rrf" (reciprocal rank fusion) or "max" (max. similarity)
+    - `rrf_k`: the reciprocal rank fusion constant
+    """
+
+    self._vector_store = vector_store
+    self._embed_model = embed_model
+    self._similarity_top_k = similarity_top_k
+    self._dedup_similarity_threshold = dedup_similarity_threshold
+    self._fusion = fusion
+    self._rrf_k = rrf_k
+    super().__init__(callback_manager=callback_manager)
+
+  @override
+  def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+    return self.retrieve_in_context(query_bundle, RetrievalContext())
+
+  @override
+  async def _aretrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+    return await self.aretrieve_in_context(query_bundle, RetrievalContext())
+
+  async def aretrieve_in_context(self, query_bundle: QueryBundle, context: RetrievalContext) -> list[NodeWithScore]:
+    # The query embedding is CPU-bound and the vector store client is synchronous; keep both off the event loop.
+    return await asyncio.to_thread(self.retrieve_in_context, query_bundle, context)
+
+  def retrieve_in_context(self, query_bundle: QueryBundle, context: RetrievalContext) -> list[NodeWithScore]:
+    query_strs = dedup_query_strs(query_bundle.embedding_strs, seen_keys=context.query_str_keys)
+    embeddings = embed_queries(self._embed_model, query_strs)
+    embeddings = self._dedup_embeddings(embeddings, known_embeddings=context.embeddings)
+    context.embeddings.extend(embeddings)
+    context.results.extend(query_vector_store(self._vector_store, embeddings, self._similarity_top_k))
+    return self._fuse(context.results)
+
+  def _dedup_embeddings(self, embeddings: list[Embedding], known_embeddings: list[Embedding]) -> list[Embedding]:
+    if not embeddings or len(embeddings) + len(known_embeddings) < 2:
+      return embeddings
+
+    m = np.array(known_embeddings + embeddings, dtype=np.float32)
+    m /= np.maximum(np.linalg.norm(m, axis=1, keepdims=True), 1e-12)
+    similarities = m @ m.T
+
+    kept = list(range(len(known_embeddings)))
+    for i in range(len(known_embeddings), len(m)):
+      if all(similarities[i, j] < self._dedup_similarity_threshold for j in kept):
+        kept.append(i)
+    return [embeddings[i - len(known_embeddings)] for i in kept[len(known_embeddings):]]
+
+  def _fuse(self, results: list[VectorStoreQueryResult]) -> list[NodeWithScore]:
+    nodes: dict[str, NodeWithScore] = {}
+    for result in results:
+      for rank, (node, similarity) in enumerate(zip(result.nodes or [], result.similarities or [])):
+        score = 1.0 / (self._rrf_k + rank + 1) if self._fusion == "rrf" else similarity
+        node_with_score = nodes.get(node.node_id)
+        if node_with_score is None:
+          nodes[node.node_id] = NodeWithScore(node=node, score=score)
+        elif self._fusion == "rrf":
+          node_with_score.score = (node_with_score.score or 0.0) + score
+        else:
+          node_with_score.score = max(node_with_score.score or 0.0, score)
+
+    fused = sorted(nodes.values(), key=lambda node_with_score: node_with_score.score or 0.0, reverse=True)
+    return fused[:self._similarity_top_k]
+
+def dedup_query_strs(query_strs: list[str], seen_keys: set[str] | None = None) -> list[str]:
+  """
+  Drop the strings that only differ from a preceding (or a seen before) one in case, punctuation or whitespace.
+
+  The keys of the returned strings are added to `seen_keys`.
+  """
+
+  seen_keys = seen_keys if seen_keys is not None else set()
+  unique = []
+  for s in query_strs:
+    key = _NON_WORD.sub(" ", s.casefold()).strip()
+    if key and key not in seen_keys:
+      seen_keys.add(key)
+      unique.append(s)
+  return unique
@@ -1,5 +1,9 @@
+from contextlib import contextmanager
+from typing import Any, Callable, Generator, Iterator, Literal, NamedTuple, TypeVar
 from typing_extensions import override
+import asyncio
 import os
+import time
 
 from llama_index.indices.query.query_transform.base import BaseQueryTransform
 from llama_index.llms import ChatMessage, MessageRole
@@ -10,8 +14,58 @@ from llama_index.prompts import PromptTemplate
 from llama_index.query_engine.custom import CustomQueryEngine, STR_OR_RESPONSE_TYPE
 from llama_index.retrievers import BaseRetriever
 from llama_index.schema import BaseNode, NodeWithScore, QueryBundle
-from pydantic import Field
-import llama_index.node_parser.text.sentence_window as sentence_window
+from llama_index.bridge.pydantic import BaseModel, Field, PrivateAttr
+
+from qas.answer_cache import SemanticAnswerCache
+from qas.context_packer import ContextPacker, get_window
+from qas.hybrid_retriever import HybridRetriever
+from qas.multi_query_retriever import MultiQueryRetriever, RetrievalContext
+from qas.sharded_vector_store import get_selected_shards
+from qas.tracing import count_llm_tokens, tracer
+
+_T = TypeVar("_T")
+
+class ResponseDelta(NamedTuple):
+  stage: Literal["expert_response", "response"]
+  delta: str
+
+class RefinementPolicy(BaseModel):
+  """
+  Decides on the passes (a retrieval and a generation each) a query takes:
+
+  - the first pass either answers directly ("single_pass", "confident") or makes the expert group discussion ("expert")
+  - each refinement pass answers again, given the previous response and the context retrieved for it
+    ("refinement"), unless the context adds nothing new to an answer ("early_exit", the previous answer is kept)
+  """
+
+  max_iterations: int = 1
+  """
+  The max. number of the refinement passes; with 0, the first pass answers directly (a single generation).
+  """
+
+  confidence_threshold: float | None = None
+  """
+  Answer directly in the first pass when the best (reranker) score of its context reaches this;
+  the expert group discussion is always made first when not set.
+  """
+
+  novelty_top_k: int = 3
+  """
+  Stop refining an answer when none of the best `novelty_top_k` nodes of a refinement pass were in the context before.
+  """
+
+  def get_first_pass(self, context_nodes: list[NodeWithScore]) -> Literal["single_pass", "confident", "expert"]:
+    if self.max_iterations <= 0:
+      return "single_pass"
+    if (
+      self.confidence_threshold is not None
+      and any(node.score is not None and node.score >= self.confidence_threshold for node in context_nodes)
+    ):
+      return "confident"
+    return "expert"
+
+  def has_new_context(self, context_nodes: list[NodeWithScore], seen_node_ids: set[str]) -> bool:
+    return any(node.node.node_id not in seen_node_ids for node in context_nodes[:self.novelty_top_k])
 
 class QueryEngine(CustomQueryEngine):
   """
@@ -28,84 +82,401 @@ class QueryEngine(CustomQueryEngine):
   - `content`: the relevant source fragment
   """
 
+  augmented_query_template0: PromptTemplate
+  """
+  A direct answer template (see `refinement_policy`). Parameters:
+
+  - `context`: the combined context entries
+  - `query`: the original query
+  """
+
   augmented_query_template1: PromptTemplate
   """
-  Template parameters:
+  An expert group discussion template. Parameters:
 
   - `context`: the combined context entries
   - `query`: the original query
   """
 
-  # TODO: Consider supporting multiple refinement iterations.
   augmented_query_template2: PromptTemplate
   """
   A refinement template. Parameters:
 
   - `context`: the combined context entries
-  - `response`: the initial response
+  - `response`: the previous response
   - `query`: the original query
   """
 
+  refinement_policy: RefinementPolicy = Field(default_factory=RefinementPolicy)
+
   messages_to_prompt: MessagesToPromptType = Field(exclude=True)
 
   retriever: BaseRetriever
   reranker: BaseNodePostprocessor | None
+  node_postprocessors: list[BaseNodePostprocessor] = []
+  """
+  Applied to the reranked nodes (e.g. `SentenceWindowExpander`).
+  """
   llm: BaseLLM
 
   messages: list[ChatMessage] = []
 
+  context_packer: ContextPacker | None = None
+  """
+  Merges the overlapping windows of the context nodes and fits them in a token budget (see `ContextPacker`);
+  the windows of all the nodes are joined when not set.
+  """
+
+  answer_cache: SemanticAnswerCache | None = None
+  """
+  Return the stored answers for the queries similar to the ones answered before.
+  Not used by the queries limited to some of the shards (see `select_shards()`).
+  """
+
+  shard_names: Callable[[], list[str]] | None = Field(default=None, exclude=True)
+  """
+  The names of the shards the queries can be limited to (see `select_shards()`); not set when the vector store is not sharded.
+  """
+
+  llm_concurrency_limit: int | None = None
+  """
+  The max. number of concurrent LLM calls made by `aquery()` across all the concurrently running queries.
+  """
+
+  on_stage: Callable[[str, float], None] | None = Field(default=None, exclude=True)
+  """
+  Called with the name and the duration (wall time, in seconds) of each stage of a query:
+  "query_expansion", then "retrieval_{n}", "reranking_{n}", "postprocessing_{n}" and "generation_{n}"
+  for the first (n = 1) and the refinement (n = 2, ...) passes.
+  """
+
+  on_path: Callable[[str], None] | None = Field(default=None, exclude=True)
+  """
+  Called with the path each generated (not cached) answer took, e.g. "expert+refinement" or "confident+early_exit"
+  (see `RefinementPolicy`). The path is also recorded with the tracer.
+  """
+
+  _llm_semaphore: asyncio.Semaphore | None = PrivateAttr(default=None)
+
   @override
   def custom_query(self, query: str) -> STR_OR_RESPONSE_TYPE:
-    query_bundle1 = self.query_transform.run(query)
+    with tracer.span("query", profile=True):
+      answer_cache = self._get_answer_cache()
+      if answer_cache is not None:
+        cached_response = answer_cache.lookup(query)
+        if cached_response is not None:
+          return cached_response
 
-    context_nodes = self.retriever.retrieve(query_bundle1)
-    if self.reranker:
-      context_nodes = self.reranker.postprocess_nodes(nodes=context_nodes, query_bundle=query_bundle1)
-    context = self._format_context_nodes(context_nodes)
+      response = self._generate_response(query)
 
-    augmented_query = self.augmented_query_template1.format(context=context, query=query)
+      if answer_cache is not None:
+        answer_cache.store(query, response)
 
-    prompt = self.messages_to_prompt(
-        self.messages + [ChatMessage(role=MessageRole.USER, content=augmented_query)]
-    )
+      return response
 
-    response = str(self.llm.complete(prompt)).strip()
+  @override
+  async def acustom_query(self, query: str) -> STR_OR_RESPONSE_TYPE:
+    with tracer.span("query", profile=True):
+      answer_cache = self._get_answer_cache()
+      if answer_cache is not None:
+        cached_response = await asyncio.to_thread(answer_cache.lookup, query)
+        if cached_response is not None:
+          return cached_response
+
+      response = await self._agenerate_response(query)
+
+      if answer_cache is not None:
+        await asyncio.to_thread(answer_cache.store, query, response)
+
+      return response
+
+  def _generate_response(self, query: str) -> str:
+    with self._stage("query_expansion"):
+      query_bundle1 = self.query_transform.run(query)
+    retrieval_ctx = RetrievalContext()
+
+    context_nodes = self._get_context_nodes(query_bundle1, retrieval_ctx, 1)
+    first_pass = self.refinement_policy.get_first_pass(context_nodes)
+    path: list[str] = [first_pass]
+    seen_node_ids = {node.node.node_id for node in context_nodes}
+    prompt = self._make_first_prompt(query, context_nodes, first_pass)
+    with self._stage("generation_1"):
+      completion = self.llm.complete(prompt)
+    count_llm_tokens(prompt, completion, stage="generation_1")
+    response = str(completion).strip()
+
+    for pass_number in range(2, self.refinement_policy.max_iterations + 2):
+      query_bundle = self._make_refinement_query_bundle(query, query_bundle1, response)
+      context_nodes = self._get_context_nodes(query_bundle, retrieval_ctx, pass_number)
+      if not self._continue_refinement(path, context_nodes, seen_node_ids):
+        break
+      prompt = self._make_refinement_prompt(query, context_nodes, response, pass_number)
+      with self._stage(f"generation_{pass_number}"):
+        completion = self.llm.complete(prompt)
+      count_llm_tokens(prompt, completion, stage=f"generation_{pass_number}")
+      response = str(completion).strip()
+
+    self._record_path(path)
+    return response
 
-    # Refining the response
+  async def _agenerate_response(self, query: str) -> str:
+    # Query expansion is an LLM call as well.
+    with self._stage("query_expansion"):
+      query_bundle1 = await self._acall_llm(self.query_transform.run, query)
+    retrieval_ctx = RetrievalContext()
+
+    context_nodes = await self._aget_context_nodes(query_bundle1, retrieval_ctx, 1)
+    first_pass = self.refinement_policy.get_first_pass(context_nodes)
+    path: list[str] = [first_pass]
+    seen_node_ids = {node.node.node_id for node in context_nodes}
+    prompt = self._make_first_prompt(query, context_nodes, first_pass)
+    with self._stage("generation_1"):
+      completion = await self._acall_llm(self.llm.complete, prompt)
+    count_llm_tokens(prompt, completion, stage="generation_1")
+    response = str(completion).strip()
+
+    for pass_number in range(2, self.refinement_policy.max_iterations + 2):
+      query_bundle = self._make_refinement_query_bundle(query, query_bundle1, response)
+      context_nodes = await self._aget_context_nodes(query_bundle, retrieval_ctx, pass_number)
+      if not self._continue_refinement(path, context_nodes, seen_node_ids):
+        break
+      prompt = self._make_refinement_prompt(query, context_nodes, response, pass_number)
+      with self._stage(f"generation_{pass_number}"):
+        completion = await self._acall_llm(self.llm.complete, prompt)
+      count_llm_tokens(prompt, completion, stage=f"generation_{pass_number}")
+      response = str(completion).strip()
+
+    self._record_path(path)
+    return response
 
-    query_bundle2 = QueryBundle(
+  def stream_query(self, query: str, stream_expert_response: bool = False) -> Iterator[ResponseDelta]:
+    """
+    Same as `query()`, but yields the tokens of the final generation as they are generated.
+    With `stream_expert_response`, the tokens of the first-pass (expert group) generation are yielded too.
+
+    A cached answer (see `answer_cache`), or an answer that turns out to be final only after it was generated
+    (see `RefinementPolicy`), is yielded at once.
+    """
+
+    with tracer.span("query", profile=True, stream=True):
+      yield from self._stream_response(query, stream_expert_response)
+
+  def _stream_response(self, query: str, stream_expert_response: bool) -> Iterator[ResponseDelta]:
+    answer_cache = self._get_answer_cache()
+    if answer_cache is not None:
+      cached_response = answer_cache.lookup(query)
+      if cached_response is not None:
+        yield ResponseDelta(stage="response", delta=cached_response)
+        return
+
+    with self._stage("query_expansion"):
+      query_bundle1 = self.query_transform.run(query)
+    retrieval_ctx = RetrievalContext()
+    last_pass_number = self.refinement_policy.max_iterations + 1
+
+    context_nodes = self._get_context_nodes(query_bundle1, retrieval_ctx, 1)
+    first_pass = self.refinement_policy.get_first_pass(context_nodes)
+    path: list[str] = [first_pass]
+    seen_node_ids = {node.node.node_id for node in context_nodes}
+    prompt = self._make_first_prompt(query, context_nodes, first_pass)
+    delta_stage: Literal["expert_response", "response"] | None
+    if first_pass == "expert":
+      delta_stage = "expert_response" if stream_expert_response else None
+    else:
+      delta_stage = "response" if last_pass_number == 1 else None
+    response = yield from self._stream_completion(prompt, 1, delta_stage)
+    streamed = delta_stage == "response"
+
+    for pass_number in range(2, last_pass_number + 1):
+      query_bundle = self._make_refinement_query_bundle(query, query_bundle1, response)
+      context_nodes = self._get_context_nodes(query_bundle, retrieval_ctx, pass_number)
+      if not self._continue_refinement(path, context_nodes, seen_node_ids):
+        break
+      prompt = self._make_refinement_prompt(query, context_nodes, response, pass_number)
+      delta_stage = "response" if pass_number == last_pass_number else None
+      response = yield from self._stream_completion(prompt, pass_number, delta_stage)
+      streamed = delta_stage == "response"
+
+    if not streamed:
+      yield ResponseDelta(stage="response", delta=response)
+
+    self._record_path(path)
+    if answer_cache is not None:
+      answer_cache.store(query, response)
+
+  def _stream_completion(
+    self,
+    prompt: str,
+    pass_number: int,
+    delta_stage: Literal["expert_response", "response"] | None,
+  ) -> Generator[ResponseDelta, None, str]:
+    """
+    Generate the response of a pass, yielding its tokens as `delta_stage` deltas (if set). Returns the response.
+    """
+
+    # The streamed generation stages include the time the consumer takes to process the deltas.
+    with self._stage(f"generation_{pass_number}"):
+      if delta_stage is None:
+        completion = self.llm.complete(prompt)
+        response = str(completion).strip()
+      else:
+        deltas = []
+        completion = None
+        for completion in self.llm.stream_complete(prompt):
+          if completion.delta:
+            deltas.append(completion.delta)
+            yield ResponseDelta(stage=delta_stage, delta=completion.delta)
+        response = "".join(deltas).strip()
+    # The last chunk holds the whole completion (and, from Ollama, the token counts).
+    count_llm_tokens(prompt, completion, stage=f"generation_{pass_number}")
+    return response
+
+  def _get_answer_cache(self) -> SemanticAnswerCache | None:
+    # The answers are cached for the queries searching all the shards.
+    return self.answer_cache if get_selected_shards() is None else None
+
+  def _continue_refinement(self, path: list[str], context_nodes: list[NodeWithScore], seen_node_ids: set[str]) -> bool:
+    """
+    Whether to generate a refinement pass with the context (records the decision in the `path`).
+    """
+
+    # The expert group discussion is not an answer yet.
+    if path[-1] != "expert" and not self.refinement_policy.has_new_context(context_nodes, seen_node_ids):
+      path.append("early_exit")
+      return False
+
+    path.append("refinement")
+    seen_node_ids.update(node.node.node_id for node in context_nodes)
+    return True
+
+  def _record_path(self, path: list[str]):
+    path_str = "+".join(path)
+    tracer.set(path=path_str)
+    tracer.count("query_paths", path=path_str)
+    if self.on_path is not None:
+      self.on_path(path_str)
+
+  def _get_context_nodes(
+    self,
+    query_bundle: QueryBundle,
+    retrieval_ctx: RetrievalContext,
+    pass_number: int,
+  ) -> list[NodeWithScore]:
+    with self._stage(f"retrieval_{pass_number}"):
+      context_nodes = self._retrieve(query_bundle, retrieval_ctx)
+    tracer.count("retrieved_nodes", len(context_nodes), stage=f"retrieval_{pass_number}")
+    if self.reranker:
+      with self._stage(f"reranking_{pass_number}"):
+        context_nodes = self.reranker.postprocess_nodes(nodes=context_nodes, query_bundle=query_bundle)
+    with self._stage(f"postprocessing_{pass_number}"):
+      for node_postprocessor in self.node_postprocessors:
+        context_nodes = node_postprocessor.postprocess_nodes(nodes=context_nodes, query_bundle=query_bundle)
+    return context_nodes
+
+  async def _aget_context_nodes(
+    self,
+    query_bundle: QueryBundle,
+    retrieval_ctx: RetrievalContext,
+    pass_number: int,
+  ) -> list[NodeWithScore]:
+    with self._stage(f"retrieval_{pass_number}"):
+      context_nodes = await self._aretrieve(query_bundle, retrieval_ctx)
+    tracer.count("retrieved_nodes", len(context_nodes), stage=f"retrieval_{pass_number}")
+    if self.reranker:
+      with self._stage(f"reranking_{pass_number}"):
+        # The cross-encoder inference is CPU-bound; keep it off the event loop.
+        context_nodes = await asyncio.to_thread(self.reranker.postprocess_nodes, nodes=context_nodes, query_bundle=query_bundle)
+    with self._stage(f"postprocessing_{pass_number}"):
+      for node_postprocessor in self.node_postprocessors:
+        context_nodes = await asyncio.to_thread(node_postprocessor.postprocess_nodes, nodes=context_nodes, query_bundle=query_bundle)
+    return context_nodes
+
+  @contextmanager
+  def _stage(self, name: str) -> Iterator[None]:
+    with tracer.span(f"query.{name}"):
+      if self.on_stage is None:
+        yield
+        return
+
+      started_at = time.perf_counter()
+      try:
+        yield
+      finally:
+        self.on_stage(name, time.perf_counter() - started_at)
+
+  def _make_first_prompt(
+    self,
+    query: str,
+    context_nodes: list[NodeWithScore],
+    first_pass: Literal["single_pass", "confident", "expert"],
+  ) -> str:
+    context = self._format_context_nodes(context_nodes, 1)
+
+    if first_pass == "expert":
+      augmented_query = self.augmented_query_template1.format(context=context, query=query)
+    else:
+      augmented_query = self.augmented_query_template0.format(context=context, query=query)
+
+    return self.messages_to_prompt(
+        self.messages + [ChatMessage(role=MessageRole.USER, content=augmented_query)]
+    )
+
+  def _make_refinement_query_bundle(self, query: str, query_bundle1: QueryBundle, response: str) -> QueryBundle:
+    # With a `MultiQueryRetriever`, only the strings from the previous response (e.g. the expert group discussion)
+    # are embedded and searched in the refinement pass.
+    return QueryBundle(
       query_str=query,
       custom_embedding_strs=(query_bundle1.custom_embedding_strs or []) + split_expert_group_response(response),
     )
-    context_nodes = self.retriever.retrieve(query_bundle2)
-    if self.reranker:
-      context_nodes = self.reranker.postprocess_nodes(nodes=context_nodes, query_bundle=query_bundle2)
-    context = self._format_context_nodes(context_nodes)
+
+  def _make_refinement_prompt(self, query: str, context_nodes: list[NodeWithScore], response: str, pass_number: int) -> str:
+    context = self._format_context_nodes(context_nodes, pass_number)
 
     augmented_query = self.augmented_query_template2.format(context=context, response=response, query=query)
 
-    prompt = self.messages_to_prompt(
+    return self.messages_to_prompt(
         self.messages + [ChatMessage(role=MessageRole.USER, content=augmented_query)]
     )
 
-    response = str(self.llm.complete(prompt)).strip()
+  async def _acall_llm(self, f: Callable[..., _T], *args: Any) -> _T:
+    if self.llm_concurrency_limit is not None and self._llm_semaphore is None:
+      self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency_limit)
 
+    # `Ollama` has no native async implementation (its `acomplete()` blocks the event loop),
+    # so the blocking calls are made from worker threads.
+    if self._llm_semaphore is not None:
+      async with self._llm_semaphore:
+        return await asyncio.to_thread(f, *args)
+    else:
+      return await asyncio.to_thread(f, *args)
 
-    return response
+  def _retrieve(self, query_bundle: QueryBundle, retrieval_ctx: RetrievalContext) -> list[NodeWithScore]:
+    if isinstance(self.retriever, (MultiQueryRetriever, HybridRetriever)):
+      return self.retriever.retrieve_in_context(query_bundle, retrieval_ctx)
+    else:
+      return self.retriever.retrieve(query_bundle)
+
+  async def _aretrieve(self, query_bundle: QueryBundle, retrieval_ctx: RetrievalContext) -> list[NodeWithScore]:
+    if isinstance(self.retriever, (MultiQueryRetriever, HybridRetriever)):
+      return await self.retriever.aretrieve_in_context(query_bundle, retrieval_ctx)
+    else:
+      return await self.retriever.aretrieve(query_bundle)
 
-  def _format_context_nodes(self, nodes: list[NodeWithScore]) -> str:
-    # Put the most relevant entries in the end (of the prompt), where they may have more impact on the generation.
-    return "\n\n".join([self._format_context_node(node_with_score.node) for node_with_score in reversed(nodes)])
+  def _format_context_nodes(self, nodes: list[NodeWithScore], pass_number: int) -> str:
+    if self.context_packer is None:
+      # Put the most relevant entries in the end (of the prompt), where they may have more impact on the generation.
+      return "\n\n".join([self._format_context_entry(node_with_score.node, get_window(node_with_score.node)) for node_with_score in reversed(nodes)])
 
-  def _format_context_node(self, node: BaseNode):
+    packed_context = self.context_packer.pack(nodes, self._format_context_entry)
+    tracer.count("context_tokens", packed_context.token_count, stage=f"generation_{pass_number}")
+    tracer.count("context_tokens_saved", packed_context.saved_token_count, stage=f"generation_{pass_number}")
+    return self.context_packer.separator.join(packed_context.entries)
 
+  def _format_context_entry(self, node: BaseNode, content: str) -> str:
     source_node = node.source_node or node
     title = source_node.metadata.get("title") or self._file_name_without_ext(source_node.metadata.get("file_name")) or "Unknown"
 
-    return self.context_entry_template.format(
-      source=title,
-      content= node.metadata.get(sentence_window.DEFAULT_WINDOW_METADATA_KEY) or node.get_content()
-    )
+    return self.context_entry_template.format(source=title, content=content)
 
   def _file_name_without_ext(self, path: str | None) -> str | None:
     if path is not None:
@@ -0,0 +1,77 @@
+from threading import Lock
+from typing import Iterable
+import os
+import sqlite3
+
+class SentenceStore:
+  """
+  A persistent (SQLite) store of the sentences of the documents by their position (see `CompactSentenceWindowNodeParser`),
+  to rebuild the sentence windows from (see `SentenceWindowExpander`).
+
+  Unlike the vector store, it keeps all the sentences of the documents, including the ones that are not embedded
+  (e.g. dropped as tiny or duplicate), as they were split (before the clean-up), like the windows
+  `SentenceWindowNodeParser` stores.
+  """
+
+  _connection: sqlite3.Connection
+  _lock: Lock
+
+  def __init__(self, path: str | None = None):
+    """
+    - `path`: the SQLite database to persist the sentences in; in-memory only when not set
+    """
+
+    if path:
+      dir_name = os.path.dirname(path)
+      if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+    self._lock = Lock()
+    self._connection = sqlite3.connect(path or ":memory:", check_same_thread=False)
+    self._connection.execute("PRAGMA journal_mode=WAL")
+    self._connection.execute(
+      "CREATE TABLE IF NOT EXISTS sentences (document_id TEXT NOT NULL, sentence_index INTEGER NOT NULL, text TEXT NOT NULL, "
+      "PRIMARY KEY (document_id, sentence_index)) WITHOUT ROWID"
+    )
+    self._connection.commit()
+
+  def count(self) -> int:
+    with self._lock:
+      return self._connection.execute("SELECT COUNT(*) FROM sentences").fetchone()[0]
+
+  def add(self, sentences: Iterable[tuple[str, int, str]]):
+    """
+    Store the sentences given as (document ID, sentence index, text); the sentences stored before are replaced.
+    """
+
+    with self._lock:
+      self._connection.executemany("INSERT OR REPLACE INTO sentences (document_id, sentence_index, text) VALUES (?, ?, ?)", sentences)
+      self._connection.commit()
+
+  def remove_documents(self, document_ids: Iterable[str]):
+    with self._lock:
+      self._connection.executemany("DELETE FROM sentences WHERE document_id = ?", [(document_id,) for document_id in document_ids])
+      self._connection.commit()
+
+  def clear(self):
+    with self._lock:
+      self._connection.execute("DELETE FROM sentences")
+      self._connection.commit()
+
+  def get_sentences(self, ranges: dict[str, list[tuple[int, int]]]) -> dict[str, dict[int, str]]:
+    """
+    The sentences of the documents within the `[start, end)` ranges, by the document ID and the sentence index
+    (see `qas.batch_query.get_sentences()`). The documents without stored sentences are left out.
+    """
+
+    sentences: dict[str, dict[int, str]] = {}
+    with self._lock:
+      for document_id, document_ranges in ranges.items():
+        for start, end in document_ranges:
+          rows = self._connection.execute(
+            "SELECT sentence_index, text FROM sentences WHERE document_id = ? AND sentence_index >= ? AND sentence_index < ?",
+            (document_id, start, end),
+          )
+          for sentence_index, text in rows:
+            sentences.setdefault(document_id, {})[sentence_index] = text
+    return sentences
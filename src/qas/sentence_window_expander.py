@@ -0,0 +1,87 @@
+from typing import Any
+from typing_extensions import override
+
+from llama_index.bridge.pydantic import Field
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.schema import NodeWithScore, QueryBundle
+import llama_index.node_parser.text.sentence_window as sentence_window
+
+from qas.batch_query import get_sentences
+from qas.ingestion.compact_sentence_window import SENTENCE_INDEX_METADATA_KEY
+
+class SentenceWindowExpander(BaseNodePostprocessor):
+  """
+  Rebuilds the sentence windows of the nodes made by `CompactSentenceWindowNodeParser` from the neighbouring
+  sentences stored in the `sentence_store` (or in the vector store, one request for all the nodes) and puts them
+  in the node metadata under `DEFAULT_WINDOW_METADATA_KEY`, like `SentenceWindowNodeParser` does at ingestion.
+
+  The nodes with a stored window are left as is. Note that the windows rebuilt from the vector store only consist
+  of the sentences that made it to the collection (e.g. not of the ones dropped as tiny or duplicate); it is only
+  used for the documents missing from the `sentence_store` (e.g. ingested before it existed).
+  """
+
+  vector_store: Any = Field(exclude=True)
+  """
+  A `ChromaVectorStore` or a vector store providing the sentences with `get_sentences()` (see `qas.batch_query.get_sentences()`).
+  """
+
+  sentence_store: Any = Field(default=None, exclude=True)
+  """
+  The `SentenceStore` with all the sentences of the ingested documents, if any.
+  """
+
+  window_size: int = sentence_window.DEFAULT_WINDOW_SIZE
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "SentenceWindowExpander"
+
+  @override
+  def _postprocess_nodes(self, nodes: list[NodeWithScore], query_bundle: QueryBundle | None = None) -> list[NodeWithScore]:
+    # The same window as `SentenceWindowNodeParser` makes: [i - window_size, i + window_size).
+    ranges: dict[str, list[tuple[int, int]]] = {}
+    for node_with_score in nodes:
+      node = node_with_score.node
+      sentence_index = node.metadata.get(SENTENCE_INDEX_METADATA_KEY)
+      if sentence_window.DEFAULT_WINDOW_METADATA_KEY in node.metadata or sentence_index is None or not node.ref_doc_id:
+        continue
+      ranges.setdefault(node.ref_doc_id, []).append((sentence_index - self.window_size, sentence_index + self.window_size))
+
+    if not ranges:
+      return nodes
+
+    merged_ranges = {document_id: merge_ranges(document_ranges) for document_id, document_ranges in ranges.items()}
+    sentences = self.sentence_store.get_sentences(merged_ranges) if self.sentence_store is not None else {}
+    missing_ranges = {document_id: document_ranges for document_id, document_ranges in merged_ranges.items() if document_id not in sentences}
+    if missing_ranges:
+      sentences.update(get_sentences(self.vector_store, missing_ranges))
+
+    for node_with_score in nodes:
+      node = node_with_score.node
+      sentence_index = node.metadata.get(SENTENCE_INDEX_METADATA_KEY)
+      document_sentences = sentences.get(node.ref_doc_id or "")
+      if sentence_window.DEFAULT_WINDOW_METADATA_KEY in node.metadata or sentence_index is None or document_sentences is None:
+        continue
+
+      window = [
+        document_sentences[i]
+        for i in range(sentence_index - self.window_size, sentence_index + self.window_size)
+        if i in document_sentences
+      ]
+      node.metadata[sentence_window.DEFAULT_WINDOW_METADATA_KEY] = " ".join(window) or node.get_content()
+
+    return nodes
+
+def merge_ranges(ranges: list[tuple[int, int]]) -> list[tuple[int, int]]:
+  """
+  Merge the overlapping and adjacent `[start, end)` ranges.
+  """
+
+  merged: list[tuple[int, int]] = []
+  for start, end in sorted(ranges):
+    if merged and start <= merged[-1][1]:
+      merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+    else:
+      merged.append((start, end))
+  return merged
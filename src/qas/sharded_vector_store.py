@@ -0,0 +1,293 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from contextvars import ContextVar, copy_context
+from dataclasses import replace
+from hashlib import sha256
+from threading import Lock
+from typing import Any, Callable, Iterable, Iterator, TypeVar
+from typing_extensions import override
+import re
+
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings.base import Embedding
+from llama_index.schema import BaseNode
+from llama_index.vector_stores.types import (
+  BasePydanticVectorStore,
+  FilterCondition,
+  FilterOperator,
+  MetadataFilters,
+  VectorStoreQuery,
+  VectorStoreQueryResult,
+)
+
+from qas.batch_query import get_nodes, get_sentences, iter_nodes, query_vector_store
+from qas.tracing import tracer
+
+_T = TypeVar("_T")
+
+_INVALID_SHARD_NAME_CHARS = re.compile(r"[^A-Za-z0-9]+")
+
+_selected_shards: ContextVar[frozenset[str] | None] = ContextVar("selected_shards", default=None)
+
+@contextmanager
+def select_shards(shard_names: Iterable[str] | None) -> Iterator[None]:
+  """
+  Only search the given shards of the `ShardedVectorStore`s within the context (e.g. a query);
+  all the shards are searched when `None`.
+
+  The `BM25Retriever`s of a sharded store take their top-k from the nodes of these shards as well
+  (the nodes are indexed with their shard); the unknown shard names match no nodes.
+  """
+
+  token = _selected_shards.set(frozenset(shard_names) if shard_names is not None else None)
+  try:
+    yield
+  finally:
+    _selected_shards.reset(token)
+
+def get_selected_shards() -> frozenset[str] | None:
+  return _selected_shards.get()
+
+def make_shard_name(value: str) -> str:
+  """
+  A shard name made of the letters, digits and underscores of the value (also usable as a Chroma collection name suffix).
+  """
+
+  return _INVALID_SHARD_NAME_CHARS.sub("_", value).strip("_")[:48]
+
+class ShardedVectorStore(BasePydanticVectorStore):
+  """
+  Routes the nodes to a vector store (a shard) per value of the `shard_key` metadata key (e.g. the Confluence space),
+  or per hash bucket of the source (with `bucket_count`), and searches the shards concurrently,
+  merging the per-shard top-k results by similarity.
+
+  The shards are opened (and created) with `open_shard` and dropped with `remove_shard`, so a shard can be rebuilt
+  without touching the other ones. The searches can be limited to some of the shards (see `select_shards()`).
+
+  The similarities of the shards must be comparable, i.e. all the shards are of the same kind.
+  """
+
+  stores_text: bool = True
+  flat_metadata: bool = False
+
+  shard_key: str = "space"
+  bucket_count: int | None = None
+  """
+  Route the nodes by a hash of their source into this many shards instead of by `shard_key`.
+  """
+
+  default_shard_name: str = "default"
+  """
+  The shard of the nodes without the `shard_key` metadata.
+  """
+
+  _open_shard: Callable[[str], BasePydanticVectorStore] = PrivateAttr()
+  _remove_shard: Callable[[str], None] = PrivateAttr()
+  _shards: dict[str, BasePydanticVectorStore] = PrivateAttr()
+  _lock: Lock = PrivateAttr()
+  _executor: ThreadPoolExecutor = PrivateAttr()
+
+  def __init__(
+    self,
+    open_shard: Callable[[str], BasePydanticVectorStore],
+    remove_shard: Callable[[str], None],
+    shard_names: Iterable[str] = (),
+    concurrency: int = 8,
+    **kwargs: Any,
+  ):
+    """
+    - `open_shard`: opens the shard of the name, creating it if needed
+    - `remove_shard`: removes the stored shard of the name
+    - `shard_names`: the names of the existing shards
+    - `concurrency`: the max. number of shards searched at the same time
+    """
+
+    super().__init__(**kwargs)
+
+    self._open_shard = open_shard
+    self._remove_shard = remove_shard
+    self._lock = Lock()
+    self._executor = ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix="shard_query")
+    self._shards = {name: open_shard(name) for name in shard_names}
+
+  @classmethod
+  @override
+  def class_name(cls) -> str:
+    return "ShardedVectorStore"
+
+  @property
+  @override
+  def client(self) -> Any:
+    return None
+
+  @property
+  def shard_names(self) -> list[str]:
+    with self._lock:
+      return sorted(self._shards)
+
+  def __len__(self) -> int:
+    return sum(count for _, count in self._map(list(self._get_shards(selected_only=False).items()), _count_nodes))
+
+  def get_shard_name(self, metadata: dict[str, Any], source_id: str | None) -> str:
+    if self.bucket_count:
+      return f"bucket_{int(sha256((source_id or '').encode()).hexdigest()[:8], 16) % self.bucket_count}"
+
+    value = metadata.get(self.shard_key)
+    return (make_shard_name(str(value)) if value else "") or self.default_shard_name
+
+  def remove_shard(self, name: str):
+    """
+    Remove the shard with its nodes (e.g. to re-ingest its documents).
+    """
+
+    with self._lock:
+      shard = self._shards.pop(name, None)
+    close = getattr(shard, "close", None)
+    if close is not None:
+      close()
+    self._remove_shard(name)
+
+  @override
+  def add(self, nodes: list[BaseNode], **add_kwargs: Any) -> list[str]:
+    nodes_by_shard: dict[str, list[BaseNode]] = {}
+    for node in nodes:
+      nodes_by_shard.setdefault(self.get_shard_name(node.metadata, node.ref_doc_id), []).append(node)
+
+    for name, shard_nodes in nodes_by_shard.items():
+      self._get_or_open_shard(name).add(shard_nodes, **add_kwargs)
+    return [node.node_id for node in nodes]
+
+  @override
+  def delete(self, ref_doc_id: str, **delete_kwargs: Any) -> None:
+    # The shard of a source is not known (e.g. its space may have changed).
+    self._map(
+      list(self._get_shards(selected_only=False).items()),
+      lambda shard: shard.delete(ref_doc_id, **delete_kwargs),
+    )
+
+  @override
+  def query(self, query: VectorStoreQuery, **kwargs: Any) -> VectorStoreQueryResult:
+    if query.doc_ids or query.node_ids:
+      raise NotImplementedError("ShardedVectorStore does not support the document or node filters")
+    if query.query_embedding is None:
+      raise ValueError("Query embedding is required")
+
+    shards = self._get_shards()
+    # The shard key filters select the shards and are not passed on (e.g. `MmapVectorStore` supports no filters).
+    if query.filters is not None and query.filters.condition != FilterCondition.OR and not self.bucket_count:
+      other_filters = []
+      for metadata_filter in query.filters.filters:
+        if metadata_filter.key == self.shard_key and metadata_filter.operator in (FilterOperator.EQ, FilterOperator.IN):
+          values = metadata_filter.value if isinstance(metadata_filter.value, list) else [metadata_filter.value]
+          names = {make_shard_name(str(value)) for value in values}
+          shards = {name: shard for name, shard in shards.items() if name in names}
+        else:
+          other_filters.append(metadata_filter)
+
+      if len(other_filters) < len(query.filters.filters):
+        query = replace(
+          query,
+          filters=MetadataFilters(filters=other_filters, condition=query.filters.condition) if other_filters else None,
+        )
+
+    results = self._map(list(shards.items()), lambda shard: shard.query(query, **kwargs))
+    return merge_results([result for _, result in results], query.similarity_top_k)
+
+  def query_batch(self, embeddings: list[Embedding], similarity_top_k: int) -> list[VectorStoreQueryResult]:
+    """
+    Query the shards with multiple embeddings at once (see `qas.batch_query.query_vector_store()`).
+    """
+
+    shard_results = self._map(
+      list(self._get_shards().items()),
+      lambda shard: query_vector_store(shard, embeddings, similarity_top_k),
+    )
+    return [
+      merge_results([results[i] for _, results in shard_results], similarity_top_k)
+      for i in range(len(embeddings))
+    ]
+
+  def get_nodes(self, node_ids: list[str]) -> list[BaseNode]:
+    """
+    The nodes stored in the (selected) shards by their IDs (in the order of the IDs, the missing ones are skipped).
+    """
+
+    nodes_by_id = {
+      node.node_id: node
+      for _, nodes in self._map(list(self._get_shards().items()), lambda shard: get_nodes(shard, node_ids))
+      for node in nodes
+    }
+    return [nodes_by_id[node_id] for node_id in node_ids if node_id in nodes_by_id]
+
+  def get_sentences(self, ranges: dict[str, list[tuple[int, int]]]) -> dict[str, dict[int, str]]:
+    """
+    The stored sentences of the documents within the ranges (see `qas.batch_query.get_sentences()`).
+    """
+
+    sentences: dict[str, dict[int, str]] = {}
+    for _, shard_sentences in self._map(list(self._get_shards().items()), lambda shard: get_sentences(shard, ranges)):
+      for document_id, document_sentences in shard_sentences.items():
+        sentences.setdefault(document_id, {}).update(document_sentences)
+    return sentences
+
+  def iter_nodes(self, batch_size: int = 5000) -> Iterator[list[BaseNode]]:
+    """
+    All the stored nodes, in batches (shard by shard).
+    """
+
+    for shard in self._get_shards(selected_only=False).values():
+      yield from iter_nodes(shard, batch_size)
+
+  def _get_shards(self, selected_only: bool = True) -> dict[str, BasePydanticVectorStore]:
+    selected_shards = _selected_shards.get() if selected_only else None
+    with self._lock:
+      return {name: shard for name, shard in self._shards.items() if selected_shards is None or name in selected_shards}
+
+  def _get_or_open_shard(self, name: str) -> BasePydanticVectorStore:
+    with self._lock:
+      shard = self._shards.get(name)
+      if shard is None:
+        shard = self._shards[name] = self._open_shard(name)
+      return shard
+
+  def _map(
+    self,
+    shards: list[tuple[str, BasePydanticVectorStore]],
+    f: Callable[[BasePydanticVectorStore], _T],
+  ) -> list[tuple[str, _T]]:
+    """
+    Apply `f` to the shards concurrently (in the current context, e.g. within the current span).
+    """
+
+    def run(name: str, shard: BasePydanticVectorStore) -> _T:
+      with tracer.span("vector_store.shard", shard=name):
+        return f(shard)
+
+    if len(shards) <= 1:
+      return [(name, run(name, shard)) for name, shard in shards]
+
+    futures = [(name, self._executor.submit(copy_context().run, run, name, shard)) for name, shard in shards]
+    return [(name, future.result()) for name, future in futures]
+
+def merge_results(results: list[VectorStoreQueryResult], similarity_top_k: int) -> VectorStoreQueryResult:
+  """
+  The best `similarity_top_k` nodes of the results, by similarity.
+  """
+
+  scored_nodes = sorted(
+    (
+      (similarity, node)
+      for result in results
+      for node, similarity in zip(result.nodes or [], result.similarities or [])
+    ),
+    key=lambda scored_node: scored_node[0],
+    reverse=True,
+  )[:similarity_top_k]
+  return VectorStoreQueryResult(
+    nodes=[node for _, node in scored_nodes],
+    similarities=[similarity for similarity, _ in scored_nodes],
+    ids=[node.node_id for _, node in scored_nodes],
+  )
+
+def _count_nodes(shard: BasePydanticVectorStore) -> int:
+  return len(shard) if hasattr(shard, "__len__") else shard.client.count()
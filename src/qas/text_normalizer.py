@@ -0,0 +1,114 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import NamedTuple, Sequence
+import os
+import re
+
+# The whitespace runs (possibly) changed by the normalization within a stripped text: the ones with trailing whitespace
+# of a line, with multiple empty lines and with empty lines containing whitespace.
+# Starting each alternative with a whitespace character lets the regex engine skip the rest of the text quickly.
+_changed_whitespace_runs = r"[^\S\n]+\n\s*|\n(?:[^\S\n]*\n){2,}\s*|\n[^\S\n]+\n\s*"
+_whitespace_run = re.compile(_changed_whitespace_runs)
+# Also the single line breaks followed by a word character.
+_whitespace_run_joining_lines = re.compile(_changed_whitespace_runs + r"|\n(?=\w)")
+_word = re.compile(r"\w+")
+
+PARALLEL_MIN_TEXT_COUNT = 10_000
+"""
+Fewer texts are normalized in the calling process (starting the worker processes costs more).
+"""
+
+class OffsetMap:
+  """
+  Maps the character offsets of a normalized text to the offsets of the original text.
+
+  The normalized text is made of the parts of the original text copied as is and the replacements
+  of the whitespace runs; an offset within a replacement maps to the same offset within the replaced run
+  (clamped to its end).
+  """
+
+  _start: int
+  """
+  The length of the removed leading whitespace.
+  """
+  _edits: list[tuple[int, int, int]]
+  """
+  The replaced runs (the start and the end offsets in the original text) and the lengths of their replacements.
+  """
+
+  def __init__(self, start: int = 0, edits: list[tuple[int, int, int]] | None = None):
+    self._start = start
+    self._edits = edits or []
+
+  def to_original(self, offset: int) -> int:
+    # The offsets are only mapped occasionally (e.g. twice per node), so no lookup structure is built.
+    delta = self._start
+    for start, end, replacement_length in self._edits:
+      normalized_start = start - delta
+      if offset < normalized_start:
+        break
+      if offset < normalized_start + replacement_length:
+        return start + min(offset - normalized_start, end - start)
+      delta += end - start - replacement_length
+    return offset + delta
+
+class NormalizedText(NamedTuple):
+  text: str
+  offset_map: OffsetMap
+
+def normalize_text(s: str, join_lines: bool = False) -> NormalizedText:
+  """
+  Clean the whitespace of the text up in a single pass:
+
+  - remove the leading and trailing whitespace of the text and the trailing whitespace of the lines
+  - collapse multiple empty lines into one
+  - with `join_lines`, replace the single line breaks within sentences (e.g. of hard-wrapped text) with spaces
+  """
+
+  text_start = len(s) - len(s.lstrip())
+  text = s[text_start:len(s.rstrip())]
+  edits: list[tuple[int, int, int]] = []
+
+  def replace(match: re.Match[str]) -> str:
+    run = match.group()
+    indent = run[run.rfind("\n") + 1:]
+    if run.count("\n") > 1:
+      replacement = "\n\n" + indent
+    elif join_lines and not indent and (run[0] == " " or _is_word_char(text[match.start() - 1])) and _is_word_char(text[match.end()]):
+      replacement = " "
+    else:
+      replacement = "\n" + indent
+
+    if replacement != run:
+      edits.append((text_start + match.start(), text_start + match.end(), len(replacement)))
+    return replacement
+
+  text = (_whitespace_run_joining_lines if join_lines else _whitespace_run).sub(replace, text)
+
+  return NormalizedText(text, OffsetMap(text_start, edits))
+
+def _is_word_char(c: str) -> bool:
+  return c.isalnum() or c == "_"
+
+def normalize_texts(texts: Sequence[str], join_lines: bool = False, worker_count: int | None = None) -> list[NormalizedText]:
+  """
+  Same as `normalize_text()` for many texts; large lists are normalized in parallel
+  (`worker_count` processes, the number of CPUs by default).
+  """
+
+  worker_count = worker_count or os.cpu_count() or 1
+  if len(texts) < PARALLEL_MIN_TEXT_COUNT or worker_count == 1:
+    return [normalize_text(s, join_lines) for s in texts]
+
+  chunk_size = max(len(texts) // (4 * worker_count), 1)
+  with ProcessPoolExecutor(max_workers=worker_count) as executor:
+    return list(executor.map(normalize_text, texts, [join_lines] * len(texts), chunksize=chunk_size))
+
+def has_min_word_count(s: str, min_word_count: int) -> bool:
+  """
+  Whether the text has at least `min_word_count` words (stops counting once there are enough).
+  """
+
+  for i, _ in enumerate(_word.finditer(s), start=1):
+    if i >= min_word_count:
+      return True
+  return min_word_count <= 0
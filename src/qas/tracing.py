@@ -0,0 +1,314 @@
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from types import FrameType
+from typing import Any, Iterator
+import atexit
+import itertools
+import json
+import os
+import re
+import sys
+import threading
+import time
+
+class Span:
+  """
+  A timed operation: the wall time, the CPU time of the thread that opened it (when the span encloses `await`s,
+  this includes the CPU time of the other tasks run on that thread meanwhile) and the counters recorded within it
+  (including within its child spans).
+  """
+
+  name: str
+  attributes: dict[str, Any]
+  counters: Counter[str]
+  trace_id: int
+  span_id: int
+  parent: "Span | None"
+  started_at: float
+  wall_time: float | None
+  cpu_time: float | None
+
+  def __init__(self, name: str, attributes: dict[str, Any], span_id: int, parent: "Span | None"):
+    self.name = name
+    self.attributes = attributes
+    self.counters = Counter()
+    self.span_id = span_id
+    self.trace_id = parent.trace_id if parent is not None else span_id
+    self.parent = parent
+    self.started_at = time.time()
+    self.wall_time = None
+    self.cpu_time = None
+
+  def set(self, **attributes: Any):
+    self.attributes.update(attributes)
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+      "trace_id": self.trace_id,
+      "span_id": self.span_id,
+      "parent_id": self.parent.span_id if self.parent is not None else None,
+      "name": self.name,
+      "started_at": self.started_at,
+      "wall_time": self.wall_time,
+      "cpu_time": self.cpu_time,
+      "attributes": self.attributes,
+      "counters": dict(self.counters),
+    }
+
+_current_span: ContextVar[Span | None] = ContextVar("current_span", default=None)
+
+class SlowSpanProfiler:
+  """
+  Samples the stacks of all the threads every `interval` seconds while a profiled span is open, and dumps
+  the samples of the spans lasting longer than `threshold` seconds to `dir_path`, in the collapsed stack format
+  (one "thread;frame;frame... count" line per stack, e.g. for `flamegraph.pl` or speedscope).
+
+  The samples of the concurrently running spans (e.g. the queries served at the same time) are not told apart.
+  """
+
+  threshold: float
+  dir_path: str
+  interval: float
+
+  def __init__(self, threshold: float, dir_path: str, interval: float = 0.005):
+    self.threshold = threshold
+    self.dir_path = dir_path
+    self.interval = interval
+
+  @contextmanager
+  def profile(self, span: Span) -> Iterator[None]:
+    samples: Counter[str] = Counter()
+    stop_event = threading.Event()
+    sampler = threading.Thread(target=self._sample, args=(samples, stop_event), name="span_profiler", daemon=True)
+    sampler.start()
+    try:
+      yield
+    finally:
+      stop_event.set()
+      sampler.join()
+      if span.wall_time is not None and span.wall_time >= self.threshold:
+        self._dump(span, samples)
+
+  def _sample(self, samples: Counter[str], stop_event: threading.Event):
+    own_id = threading.get_ident()
+    thread_names = {}
+    frame: FrameType | None
+    while not stop_event.wait(self.interval):
+      frames = sys._current_frames()
+      if any(thread_id not in thread_names for thread_id in frames):
+        thread_names = {thread.ident: thread.name for thread in threading.enumerate()}
+      for thread_id, frame in frames.items():
+        if thread_id == own_id:
+          continue
+        stack = []
+        while frame is not None:
+          stack.append(f"{frame.f_code.co_name} ({os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno})")
+          frame = frame.f_back
+        stack.append(thread_names.get(thread_id, str(thread_id)))
+        samples[";".join(reversed(stack))] += 1
+
+  def _dump(self, span: Span, samples: Counter[str]):
+    os.makedirs(self.dir_path, exist_ok=True)
+    timestamp = time.strftime("%Y%m%d-%H%M%S", time.localtime(span.started_at))
+    path = os.path.join(self.dir_path, f"{timestamp}-{span.name}-{span.span_id}.folded")
+    with open(path, "w") as f:
+      for stack, count in samples.most_common():
+        f.write(f"{stack} {count}\n")
+    print(f"🟠 Slow {span.name} ({span.wall_time:.2f} s), stacks dumped to {path}")
+
+class Tracer:
+  """
+  Records nested spans (see `span()`) and counters (see `count()`).
+
+  The finished spans are appended to the `jsonl_path` file, one JSON object per line. The span durations
+  (as summaries by the span name) and the counters (by the counter name and labels) are written to
+  the `prometheus_path` file in the Prometheus text format (e.g. for the node exporter textfile collector)
+  whenever a root span finishes, and on exit.
+
+  Without any of the outputs, the spans are not recorded at all.
+  """
+
+  jsonl_path: str | None
+  prometheus_path: str | None
+  profiler: SlowSpanProfiler | None
+
+  _lock: threading.Lock
+  _span_ids: Iterator[int]
+  _span_stats: dict[str, list[float]]
+  _counters: Counter[tuple[str, tuple[tuple[str, str], ...]]]
+
+  def __init__(
+    self,
+    jsonl_path: str | None = None,
+    prometheus_path: str | None = None,
+    profiler: SlowSpanProfiler | None = None,
+  ):
+    self._lock = threading.Lock()
+    self._span_ids = itertools.count(int(time.time() * 1000) << 16)
+    self._span_stats = {}
+    self._counters = Counter()
+    self.configure(jsonl_path, prometheus_path, profiler)
+    atexit.register(self.flush)
+
+  @property
+  def enabled(self) -> bool:
+    return bool(self.jsonl_path or self.prometheus_path or self.profiler)
+
+  def configure(
+    self,
+    jsonl_path: str | None = None,
+    prometheus_path: str | None = None,
+    profiler: SlowSpanProfiler | None = None,
+  ):
+    for path in (jsonl_path, prometheus_path):
+      dir_name = os.path.dirname(path) if path else None
+      if dir_name:
+        os.makedirs(dir_name, exist_ok=True)
+
+    self.jsonl_path = jsonl_path
+    self.prometheus_path = prometheus_path
+    self.profiler = profiler
+
+  @contextmanager
+  def span(self, name: str, profile: bool = False, **attributes: Any) -> Iterator[Span | None]:
+    """
+    Time the enclosed code as a child of the current span. With `profile`, the stacks are sampled
+    while the span is open and dumped if it turns out to be slow (see `SlowSpanProfiler`).
+    """
+
+    if not self.enabled:
+      yield None
+      return
+
+    span = Span(name, attributes, next(self._span_ids), _current_span.get())
+    token = _current_span.set(span)
+    started_at = time.perf_counter()
+    cpu_started_at = time.thread_time()
+    try:
+      if profile and self.profiler is not None:
+        with self.profiler.profile(span):
+          try:
+            yield span
+          finally:
+            span.wall_time = time.perf_counter() - started_at
+      else:
+        yield span
+    except BaseException as e:
+      span.set(error=type(e).__name__)
+      raise
+    finally:
+      span.wall_time = time.perf_counter() - started_at
+      span.cpu_time = time.thread_time() - cpu_started_at
+      _current_span.reset(token)
+      self._finish(span)
+
+  def count(self, name: str, value: int = 1, **labels: Any):
+    """
+    Increment the counter `name` (with the `labels`, if any) and the counter of the current span and its ancestors.
+    """
+
+    if not self.enabled:
+      return
+
+    span = _current_span.get()
+    while span is not None:
+      span.counters[name] += value
+      span = span.parent
+
+    with self._lock:
+      self._counters[(name, tuple(sorted((key, str(label)) for key, label in labels.items())))] += value
+
+  def set(self, **attributes: Any):
+    """
+    Set the attributes of the current span (if any).
+    """
+
+    span = _current_span.get()
+    if span is not None:
+      span.set(**attributes)
+
+  def current_span(self) -> Span | None:
+    return _current_span.get()
+
+  def flush(self):
+    """
+    Write the Prometheus metrics file.
+    """
+
+    if not self.prometheus_path:
+      return
+
+    with self._lock:
+      span_stats = {name: list(stats) for name, stats in self._span_stats.items()}
+      counters = dict(self._counters)
+
+    lines = [
+      "# HELP qas_span_seconds The wall time of the spans.",
+      "# TYPE qas_span_seconds summary",
+    ]
+    for name, (count, wall_time, _) in sorted(span_stats.items()):
+      lines.append(f"qas_span_seconds_sum{{span=\"{_escape(name)}\"}} {wall_time}")
+      lines.append(f"qas_span_seconds_count{{span=\"{_escape(name)}\"}} {int(count)}")
+    lines.append("# HELP qas_span_cpu_seconds_total The CPU time of the spans.")
+    lines.append("# TYPE qas_span_cpu_seconds_total counter")
+    for name, (_, _, cpu_time) in sorted(span_stats.items()):
+      lines.append(f"qas_span_cpu_seconds_total{{span=\"{_escape(name)}\"}} {cpu_time}")
+
+    metric_names = sorted({name for name, _ in counters})
+    for metric_name in metric_names:
+      prometheus_name = f"qas_{re.sub(r'[^a-zA-Z0-9_]', '_', metric_name)}_total"
+      lines.append(f"# TYPE {prometheus_name} counter")
+      for (name, labels), value in sorted(counters.items()):
+        if name == metric_name:
+          label_str = ",".join(f"{key}=\"{_escape(label)}\"" for key, label in labels)
+          lines.append(f"{prometheus_name}{{{label_str}}} {value}" if label_str else f"{prometheus_name} {value}")
+
+    tmp_path = f"{self.prometheus_path}.tmp"
+    with open(tmp_path, "w") as f:
+      f.write("\n".join(lines) + "\n")
+    os.replace(tmp_path, self.prometheus_path)
+
+  def _finish(self, span: Span):
+    with self._lock:
+      stats = self._span_stats.setdefault(span.name, [0.0, 0.0, 0.0])
+      stats[0] += 1
+      stats[1] += span.wall_time or 0.0
+      stats[2] += span.cpu_time or 0.0
+
+      if self.jsonl_path:
+        with open(self.jsonl_path, "a") as f:
+          f.write(json.dumps(span.to_dict(), default=str) + "\n")
+
+    if span.parent is None:
+      self.flush()
+
+def count_llm_tokens(prompt: str, completion: Any, **labels: Any):
+  """
+  Count the prompt and completion tokens of an LLM call with the `tracer`: as reported by Ollama
+  (in the raw response of the `CompletionResponse`), or as estimated with the llama_index tokenizer.
+  """
+
+  if not tracer.enabled or completion is None:
+    return
+
+  raw = getattr(completion, "raw", None) or {}
+  prompt_token_count = raw.get("prompt_eval_count")
+  completion_token_count = raw.get("eval_count")
+  if prompt_token_count is None or completion_token_count is None:
+    from llama_index.utils import get_tokenizer
+
+    tokenize = get_tokenizer()
+    prompt_token_count = len(tokenize(prompt))
+    completion_token_count = len(tokenize(getattr(completion, "text", None) or str(completion)))
+
+  tracer.count("llm_prompt_tokens", prompt_token_count, **labels)
+  tracer.count("llm_completion_tokens", completion_token_count, **labels)
+
+def _escape(s: str) -> str:
+  return s.replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+tracer = Tracer()
+"""
+The tracer used throughout the app; disabled until configured (see `Tracer.configure()`).
+"""
@@ -1,7 +1,14 @@
 from typing_extensions import override
-from contextlib import AbstractContextManager
+from contextlib import AbstractContextManager, contextmanager
+from threading import Lock
+from typing import Callable, Iterator, ParamSpec, TypeVar
 import time
 
+from qas.tracing import tracer
+
+_P = ParamSpec("_P")
+_T = TypeVar("_T")
+
 class Mark(AbstractContextManager):
   """
   A context manager class that announces a task (by printing the "prefix" string)
@@ -23,3 +30,49 @@ class Mark(AbstractContextManager):
   def __exit__(self, exc_type, exc_value, exc_tb):
     elapsed = time.perf_counter() - self.t
     print(self.suffix.format(elapsed))
+
+class PhaseTimer:
+  """
+  Records the durations of named phases, possibly running concurrently (e.g. the models loaded in parallel),
+  to report them together instead of printing each one as it ends (see `Mark`).
+  """
+
+  _started_at: float
+  _phases: dict[str, tuple[float, float | None]]
+  _lock: Lock
+
+  def __init__(self):
+    self._started_at = time.perf_counter()
+    self._phases = {}
+    self._lock = Lock()
+
+  @contextmanager
+  def phase(self, name: str) -> Iterator[None]:
+    started_at = time.perf_counter()
+    with self._lock:
+      self._phases[name] = (started_at, None)
+    try:
+      with tracer.span(f"startup.{name}"):
+        yield
+    finally:
+      with self._lock:
+        self._phases[name] = (started_at, time.perf_counter())
+
+  def measure(self, name: str, f: Callable[_P, _T], *args: _P.args, **kwargs: _P.kwargs) -> _T:
+    """
+    Call `f` as the phase `name` (e.g. in an executor: `executor.submit(timer.measure, name, f, ...)`).
+    """
+
+    with self.phase(name):
+      return f(*args, **kwargs)
+
+  def format_stats(self, title: str = "Startup") -> str:
+    with self._lock:
+      phases = sorted(self._phases.items(), key=lambda item: item[1][0])
+
+    entries = [
+      f"{name} {ended_at - started_at:.2f} s" if ended_at is not None else f"{name} (in progress)"
+      for name, (started_at, ended_at) in phases
+    ]
+    ended_at = max((ended_at for _, (_, ended_at) in phases if ended_at is not None), default=self._started_at)
+    return f"{title}: {', '.join(entries)} (total {ended_at - self._started_at:.2f} s)"
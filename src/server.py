@@ -0,0 +1,167 @@
+from http import HTTPStatus
+from typing import Any
+import asyncio
+import json
+
+from pydantic import BaseModel
+
+from engine import make_query_engine
+from qas.query_engine import QueryEngine
+from qas.sharded_vector_store import select_shards
+from qas.utils import PhaseTimer
+import config
+
+MAX_REQUEST_BODY_SIZE = 64 * 1024
+
+class QueryRequest(BaseModel):
+  query: str
+  shards: list[str] | None = None
+
+class _Job:
+  query: str
+  shards: list[str] | None
+  future: asyncio.Future
+
+  def __init__(self, query: str, shards: list[str] | None, future: asyncio.Future):
+    self.query = query
+    self.shards = shards
+    self.future = future
+
+class Server:
+  """
+  A minimal HTTP/1.1 server answering queries with a shared `QueryEngine`.
+
+  - `POST /query` with a JSON body `{"query": "..."}` responds with `{"response": "..."}`;
+    with `"shards": ["..."]`, only these shards are searched (see `ShardedVectorStore`); the unknown shards,
+    or any shards when the vector store is not sharded, are answered with "400 Bad Request"
+  - `GET /health` responds with the queue state
+
+  The queries are processed by a fixed number of workers; when all of them are busy,
+  the queries wait in a bounded queue. When the queue is full, the server responds
+  with "503 Service Unavailable" right away instead of accumulating the load.
+  """
+
+  _query_engine: QueryEngine
+  _queue: asyncio.Queue[_Job]
+  _worker_count: int
+
+  def __init__(self, query_engine: QueryEngine, worker_count: int, queue_size: int):
+    self._query_engine = query_engine
+    self._queue = asyncio.Queue(maxsize=queue_size)
+    self._worker_count = worker_count
+
+  async def serve(self, host: str, port: int):
+    workers = [asyncio.create_task(self._work()) for _ in range(self._worker_count)]
+    server = await asyncio.start_server(self._handle_connection, host=host, port=port)
+    print(f"Listening on http://{host}:{port}")
+    try:
+      async with server:
+        await server.serve_forever()
+    finally:
+      for worker in workers:
+        worker.cancel()
+
+  async def _work(self):
+    while True:
+      job = await self._queue.get()
+      try:
+        if not job.future.cancelled():
+          with select_shards(job.shards):
+            response = await self._query_engine.aquery(job.query)
+          if not job.future.cancelled():
+            job.future.set_result(str(response))
+      except Exception as e:
+        if not job.future.cancelled():
+          job.future.set_exception(e)
+      finally:
+        self._queue.task_done()
+
+  async def _handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+      status, body = await self._handle_request(reader)
+    except Exception as e:
+      status, body = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": str(e)}
+
+    try:
+      await self._write_response(writer, status, body)
+    finally:
+      writer.close()
+
+  async def _handle_request(self, reader: asyncio.StreamReader) -> tuple[HTTPStatus, dict[str, Any]]:
+    request_line = (await reader.readline()).decode("latin-1").strip()
+    method, path, *_ = request_line.split(" ") + ["", ""]
+
+    headers: dict[str, str] = {}
+    while True:
+      line = (await reader.readline()).decode("latin-1").strip()
+      if not line:
+        break
+      name, _, value = line.partition(":")
+      headers[name.strip().lower()] = value.strip()
+
+    if path == "/health" and method == "GET":
+      return HTTPStatus.OK, {"status": "ok", "queued": self._queue.qsize(), "queue_size": self._queue.maxsize}
+
+    if path != "/query":
+      return HTTPStatus.NOT_FOUND, {"error": "Not found"}
+    if method != "POST":
+      return HTTPStatus.METHOD_NOT_ALLOWED, {"error": "Method not allowed"}
+
+    try:
+      content_length = int(headers.get("content-length", "0"))
+      if content_length > MAX_REQUEST_BODY_SIZE:
+        return HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {"error": "Request body too large"}
+
+      request = QueryRequest.model_validate_json(await reader.readexactly(content_length))
+    except asyncio.IncompleteReadError:
+      return HTTPStatus.BAD_REQUEST, {"error": "Request body shorter than Content-Length"}
+    except ValueError as e:
+      return HTTPStatus.BAD_REQUEST, {"error": str(e)}
+
+    # The queries limited to no existing shard would be answered without context.
+    if request.shards is not None:
+      if self._query_engine.shard_names is None:
+        return HTTPStatus.BAD_REQUEST, {"error": "The vector store is not sharded"}
+      if not request.shards:
+        return HTTPStatus.BAD_REQUEST, {"error": "No shards given"}
+      unknown_shards = sorted(set(request.shards) - set(self._query_engine.shard_names()))
+      if unknown_shards:
+        return HTTPStatus.BAD_REQUEST, {"error": f"Unknown shard(s): {', '.join(unknown_shards)}"}
+
+    future = asyncio.get_running_loop().create_future()
+    try:
+      self._queue.put_nowait(_Job(query=request.query.strip(), shards=request.shards, future=future))
+    except asyncio.QueueFull:
+      return HTTPStatus.SERVICE_UNAVAILABLE, {"error": "Too many queries, retry later"}
+
+    return HTTPStatus.OK, {"response": await future}
+
+  async def _write_response(self, writer: asyncio.StreamWriter, status: HTTPStatus, body: dict[str, Any]):
+    payload = json.dumps(body).encode()
+    headers = [
+      f"HTTP/1.1 {status.value} {status.phrase}",
+      "Content-Type: application/json",
+      f"Content-Length: {len(payload)}",
+      "Connection: close",
+    ]
+    if status == HTTPStatus.SERVICE_UNAVAILABLE:
+      headers.append("Retry-After: 5")
+
+    writer.write(("\r\n".join(headers) + "\r\n\r\n").encode("latin-1") + payload)
+    await writer.drain()
+
+def main():
+  settings = config.Settings()
+  startup_timer = PhaseTimer()
+  query_engine = make_query_engine(settings, startup_timer)
+  print(startup_timer.format_stats())
+
+  server = Server(
+    query_engine,
+    worker_count=settings.server_worker_count,
+    queue_size=settings.server_queue_size,
+  )
+  asyncio.run(server.serve(host=settings.server_host, port=settings.server_port))
+
+if __name__ == "__main__":
+  main()
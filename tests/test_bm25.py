@@ -0,0 +1,49 @@
+import os.path as p
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
+
+from qas.bm25 import BM25Index
+
+class BM25IndexTest(unittest.TestCase):
+  def make_index(self) -> BM25Index:
+    index = BM25Index()
+    # The shorter ENG nodes rank first.
+    index.add(
+      [(f"eng_{i}", f"eng_doc_{i}", "error 0x80070005", "ENG") for i in range(4)]
+      + [(f"ops_{i}", f"ops_doc_{i}", f"runbook {i}: error 0x80070005 in the OPS space", "OPS") for i in range(4)]
+      + [(f"other_{i}", f"other_doc_{i}", f"unrelated text {i}", "OPS") for i in range(8)]
+    )
+    return index
+
+  def test_searches_the_given_shards_only(self):
+    index = self.make_index()
+
+    self.assertEqual({node_id[:3] for node_id, _ in index.search("error 0x80070005", 4)}, {"eng"})
+    ops_matches = index.search("error 0x80070005", 4, shards={"OPS"})
+    self.assertEqual(len(ops_matches), 4)
+    self.assertTrue(all(node_id.startswith("ops_") for node_id, _ in ops_matches))
+    self.assertEqual(index.search("error", 4, shards={"UNKNOWN"}), [])
+    self.assertEqual(index.search("error", 4, shards=set()), [])
+
+  def test_adds_the_shard_column_to_an_older_index(self):
+    with tempfile.TemporaryDirectory() as dir_name:
+      path = p.join(dir_name, "bm25.sqlite3")
+      connection = sqlite3.connect(path)
+      connection.execute(
+        "CREATE TABLE nodes (id INTEGER PRIMARY KEY, node_id TEXT NOT NULL UNIQUE, source_id TEXT NOT NULL, length INTEGER NOT NULL)"
+      )
+      connection.execute("INSERT INTO nodes (node_id, source_id, length) VALUES ('old', 'old_doc', 0)")
+      connection.commit()
+      connection.close()
+
+      index = BM25Index(path)
+      self.assertEqual(index.count_unsharded(), 1)
+      index.add([("new", "new_doc", "some text", "ENG")])
+      self.assertEqual(index.count_unsharded(), 1)
+
+if __name__ == "__main__":
+  unittest.main()
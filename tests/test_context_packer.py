@@ -0,0 +1,72 @@
+import os.path as p
+import sys
+import unittest
+
+sys.path.insert(0, p.join(p.dirname(p.dirname(p.abspath(__file__))), "src"))
+
+from llama_index.schema import NodeRelationship, NodeWithScore, RelatedNodeInfo, TextNode
+import llama_index.node_parser.text.sentence_window as sentence_window
+
+from qas.context_packer import ContextPacker
+from qas.ingestion.compact_sentence_window import SENTENCE_INDEX_METADATA_KEY
+
+WINDOW_SIZE = 3
+
+SENTENCES = [f"s{i} " + " ".join(f"w{i}" for _ in range(5)) for i in range(20)]
+"""
+The sentences of the document, 6 tokens each (with the whitespace tokenizer).
+"""
+
+def make_node(sentence_index: int) -> NodeWithScore:
+  window = SENTENCES[max(sentence_index - WINDOW_SIZE, 0):sentence_index + WINDOW_SIZE + 1]
+  return NodeWithScore(
+    node=TextNode(
+      text=SENTENCES[sentence_index],
+      metadata={
+        sentence_window.DEFAULT_WINDOW_METADATA_KEY: " ".join(window),
+        SENTENCE_INDEX_METADATA_KEY: sentence_index,
+      },
+      relationships={NodeRelationship.SOURCE: RelatedNodeInfo(node_id="document")},
+    ),
+  )
+
+def format_entry(node, content: str) -> str:
+  return content
+
+class ContextPackerTest(unittest.TestCase):
+  def make_packer(self, token_budget: int | None) -> ContextPacker:
+    return ContextPacker(token_budget=token_budget, tokenize=str.split, window_size=WINDOW_SIZE, separator="\n")
+
+  def test_merges_overlapping_windows(self):
+    packed = self.make_packer(None).pack([make_node(10), make_node(11), make_node(12), make_node(5)], format_entry)
+
+    self.assertEqual(packed.entries, [" ".join(SENTENCES[2:16])])
+    self.assertEqual(packed.token_count, 14 * 6)
+    self.assertEqual(packed.unpacked_token_count, 4 * 7 * 6)
+
+  def test_falls_back_to_unmerged_windows(self):
+    # The merged window (sentences 2..15) does not fit, the window of the most relevant node (7..13) does.
+    packed = self.make_packer(60).pack([make_node(10), make_node(11), make_node(12), make_node(5)], format_entry)
+
+    self.assertEqual(packed.entries, [" ".join(SENTENCES[7:14])])
+    self.assertLessEqual(packed.token_count, 60)
+
+  def test_truncates_around_the_sentence_of_the_most_relevant_node(self):
+    packed = self.make_packer(20).pack([make_node(10), make_node(5)], format_entry)
+
+    self.assertEqual(len(packed.entries), 1)
+    self.assertIn(SENTENCES[10], packed.entries[0])
+    self.assertNotIn("s7", packed.entries[0])
+    self.assertLessEqual(packed.token_count, 20)
+
+  def test_keeps_the_most_relevant_entries_that_fit(self):
+    other_node = make_node(10)
+    other_node.node.relationships[NodeRelationship.SOURCE] = RelatedNodeInfo(node_id="other_document")
+    # Separate windows of 7, 7 and 6 sentences: the second one does not fit after the first one, the third one does.
+    packed = self.make_packer(80).pack([make_node(3), other_node, make_node(17)], format_entry)
+
+    self.assertEqual(packed.entries, [" ".join(SENTENCES[14:20]), " ".join(SENTENCES[0:7])])
+    self.assertLessEqual(packed.token_count, 80)
+
+if __name__ == "__main__":
+  unittest.main()